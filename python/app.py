@@ -1,21 +1,25 @@
-from flask import Flask, jsonify, request, send_from_directory
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
+import atexit
 import os
 import json
 import base64
+import uuid
 import logging
+from urllib.parse import urlencode
 from generate_token import generate_token
-from google.cloud.sql.connector import Connector
-import sqlalchemy
 from datetime import datetime
-from storage_handler import StorageHandler
-from google.cloud import storage
-from google.cloud import bigquery
 
 # Import security services
-from kms_manager import KMSManager
-from audit_logger import AuditLogger
-from dlp_manager import DLPManager
 from security_middleware import SecurityMiddleware
+from rate_limiter import MemoryRateLimiter, SQLiteRateLimiter
+from streaming_upload import StreamingUploadManager, UnknownUpload, UploadTooLarge, UploadOffsetMismatch
+from request_pipeline import StagePipeline
+from service_registry import ServiceRegistry
+from health_monitor import HealthMonitor
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -24,57 +28,149 @@ logger = logging.getLogger(__name__)
 # Create Flask app
 app = Flask(__name__)
 
-# Initialize security middleware
-security = SecurityMiddleware(app)
+# Constants
+BUCKET_NAME = 'healthcare_audio_analyzer_fhir'
+DATASET_ID = 'healthcare_audio_data'
+TABLE_ID = 'audio_records'
+FHIR_DEFAULT_PAGE_SIZE = 50
+FHIR_MAX_PAGE_SIZE = 1000
+FHIR_MAX_STREAM_PAGE_SIZE = 50000
+FHIR_STREAM_HYDRATE_BATCH = 500
+MAX_BATCH_REGISTRATIONS = 500
+FHIR_MAX_BUNDLE_ENTRIES = 1000
+ALLOWED_AUDIO_EXTENSIONS = {'.mp3', '.wav', '.ogg', '.m4a'}
+MAX_INGEST_RECORDS = 50000
+DATA_RECORDS_DEFAULT_PAGE_SIZE = 50
+DATA_RECORDS_MAX_PAGE_SIZE = 1000
 
-# Initialize the connector
-connector = Connector()
+# Initialize security middleware; the SQLite limiter shares limits across gunicorn workers
+if os.environ.get('RATE_LIMIT_BACKEND') == 'sqlite':
+    rate_limiter = SQLiteRateLimiter(os.environ.get('RATE_LIMIT_DB_PATH', '/tmp/rate-limits.db'))
+else:
+    rate_limiter = MemoryRateLimiter()
+# Bulk endpoints (MAX_INGEST_RECORDS records, FHIR_MAX_BUNDLE_ENTRIES entries,
+# MAX_BATCH_REGISTRATIONS files) carry far more string content than the default cap
+security = SecurityMiddleware(
+    app,
+    rate_limiter=rate_limiter,
+    route_scan_limits={
+        '/store-data': int(os.environ.get('STORE_DATA_MAX_SCAN_CHARS', 64 * 1024 * 1024)),
+        '/fhir': int(os.environ.get('FHIR_MAX_SCAN_CHARS', 16 * 1024 * 1024)),
+        '/register-upload-fhir/batch': int(os.environ.get('BATCH_REGISTRATION_MAX_SCAN_CHARS', 8 * 1024 * 1024))
+    },
+    exempt_paths={'/livez', '/readyz'}
+)
 
-# Initialize Google Cloud clients with credentials
-credentials, project_id = generate_token()
-if not credentials or not project_id:
-    raise Exception("Failed to initialize Google Cloud credentials")
+# Google Cloud clients are built on first use, once per process (and again in each
+# forked worker), so importing the app does no client setup or network calls.
+# Key ring, crypto key and bucket encryption are provisioned once with provision.py.
+services = ServiceRegistry()
 
-storage_client = storage.Client(credentials=credentials, project=project_id)
-bigquery_client = bigquery.Client(credentials=credentials, project=project_id)
+def _create_credentials():
+    credentials, project_id = generate_token()
+    if not credentials or not project_id:
+        raise Exception("Failed to initialize Google Cloud credentials")
+    return credentials, project_id
 
-# Initialize StorageHandler with credentials
-storage_handler = StorageHandler(credentials=credentials)
+def _create_connector():
+    from google.cloud.sql.connector import Connector
+    return Connector()
 
-# Initialize security services
-kms_manager = KMSManager(project_id)
-audit_logger = AuditLogger(project_id)
-dlp_manager = DLPManager(project_id)
+def _create_storage_client():
+    from google.cloud import storage
+    credentials, project_id = services.get('credentials')
+    return storage.Client(credentials=credentials, project=project_id)
 
-# Configure KMS encryption for storage bucket
-try:
-    kms_manager.setup_storage_encryption(BUCKET_NAME)
-    logger.info("KMS encryption configured for storage bucket")
-except Exception as e:
-    logger.warning(f"Could not configure KMS encryption: {e}")
+def _create_bigquery_client():
+    from google.cloud import bigquery
+    credentials, project_id = services.get('credentials')
+    return bigquery.Client(credentials=credentials, project=project_id)
 
-# Constants
-BUCKET_NAME = 'healthcare_audio_analyzer_fhir'
-DATASET_ID = 'healthcare_audio_data'
-TABLE_ID = 'audio_records'
+def _create_storage_handler():
+    from storage_handler import StorageHandler
+    credentials, _ = services.get('credentials')
+    return StorageHandler(
+        credentials=credentials,
+        storage_client=services.get('storage_client'),
+        bigquery_client=services.get('bigquery_client'),
+        resource_cache_path=os.environ.get('FHIR_CACHE_PATH'),
+        composite_threshold=int(os.environ.get('COMPOSITE_UPLOAD_THRESHOLD', 32 * 1024 * 1024)),
+        composite_workers=int(os.environ.get('COMPOSITE_UPLOAD_WORKERS', 8)),
+        bundle_storage=os.environ.get('FHIR_BUNDLE_STORAGE', 'embedded'),
+        display_columns=os.environ.get('FHIR_DISPLAY_COLUMNS', '').lower() in ('1', 'true', 'yes'),
+        # false: registration returns once rows are buffered, before BigQuery accepts them
+        confirm_writes=os.environ.get('BQ_CONFIRM_WRITES', 'true').lower() in ('1', 'true', 'yes')
+    )
+
+def _create_kms_manager():
+    from kms_manager import KMSManager
+    _, project_id = services.get('credentials')
+    return KMSManager(project_id)
+
+def _create_audit_logger():
+    from audit_logger import AuditLogger
+    _, project_id = services.get('credentials')
+    return AuditLogger(project_id)
+
+def _create_dlp_manager():
+    from dlp_manager import DLPManager
+    _, project_id = services.get('credentials')
+    return DLPManager(
+        project_id,
+        prescreen_policy=os.environ.get('DLP_PRESCREEN_POLICY', 'local_first'),
+        clear_threshold=float(os.environ.get('DLP_PRESCREEN_CLEAR_THRESHOLD', '0.3')),
+        positive_threshold=float(os.environ.get('DLP_PRESCREEN_POSITIVE_THRESHOLD', '0.9'))
+    )
+
+def _create_streaming_uploads():
+    # Streaming uploads: request bodies go to GCS resumable sessions chunk by chunk
+    return StreamingUploadManager(
+        services.get('storage_client'),
+        BUCKET_NAME,
+        chunk_size=int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)),
+        max_size=int(os.environ.get('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024)),
+        session_ttl=float(os.environ.get('UPLOAD_SESSION_TTL', 6 * 3600))
+    )
+
+services.register('credentials', _create_credentials)
+services.register('connector', _create_connector, close=lambda connector: connector.close())
+storage_client = services.register('storage_client', _create_storage_client)
+bigquery_client = services.register('bigquery_client', _create_bigquery_client)
+storage_handler = services.register('storage_handler', _create_storage_handler)
+kms_manager = services.register('kms_manager', _create_kms_manager)
+audit_logger = services.register('audit_logger', _create_audit_logger)
+dlp_manager = services.register('dlp_manager', _create_dlp_manager)
+streaming_uploads = services.register('streaming_uploads', _create_streaming_uploads)
+
+# Shared, bounded pool for the per-request stage pipelines
+pipeline_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('PIPELINE_WORKERS', 32)),
+    thread_name_prefix="request-stage"
+)
+PIPELINE_TIMEOUT_SECONDS = float(os.environ.get('PIPELINE_TIMEOUT_SECONDS', 30))
+
+# Cloud SQL: one pooled engine per worker process, built on first use
+def _create_db_engine():
+    import sqlalchemy
+
+    instance_connection_name = os.environ.get('INSTANCE_CONNECTION_NAME')
+    db_user = os.environ.get('DB_USER')
+    db_pass = os.environ.get('DB_PASS')
+    db_name = os.environ.get('DB_NAME')
+    
+    # Check if all required environment variables are set
+    if not all([instance_connection_name, db_user, db_pass, db_name]):
+        missing_vars = [var for var in ['INSTANCE_CONNECTION_NAME', 'DB_USER', 'DB_PASS', 'DB_NAME'] 
+                      if not os.environ.get(var)]
+        raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+    
+    # Built before the engine so it is closed after it
+    cloud_sql = services.get('connector')
 
-# Function to get database connection
-def get_db_connection():
     def getconn():
-        instance_connection_name = os.environ.get('INSTANCE_CONNECTION_NAME')
-        db_user = os.environ.get('DB_USER')
-        db_pass = os.environ.get('DB_PASS')
-        db_name = os.environ.get('DB_NAME')
-        
-        # Check if all required environment variables are set
-        if not all([instance_connection_name, db_user, db_pass, db_name]):
-            missing_vars = [var for var in ['INSTANCE_CONNECTION_NAME', 'DB_USER', 'DB_PASS', 'DB_NAME'] 
-                          if not os.environ.get(var)]
-            raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
-        
         logger.debug(f"Attempting to connect to database: {instance_connection_name}")
         try:
-            conn = connector.connect(
+            conn = cloud_sql.connect(
                 instance_connection_name,
                 "pg8000",
                 user=db_user,
@@ -87,36 +183,118 @@ def get_db_connection():
             logger.error(f"Failed to connect to database: {str(e)}")
             raise
 
-    # Create connection pool
-    try:
-        pool = sqlalchemy.create_engine(
-            "postgresql+pg8000://",
-            creator=getconn,
-        )
-        # Test the connection
-        with pool.connect() as conn:
-            conn.execute(sqlalchemy.text("SELECT 1"))
-        return pool
-    except Exception as e:
-        logger.error(f"Failed to create database pool: {str(e)}")
-        raise
+    # Connections are opened on demand; pre-ping replaces ones the server has dropped
+    return sqlalchemy.create_engine(
+        "postgresql+pg8000://",
+        creator=getconn,
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 8)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 4)),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        pool_pre_ping=True
+    )
+
+def _create_data_records():
+    from data_records import DataRecordStore
+    return DataRecordStore(
+        services.get('db_engine'),
+        batch_size=int(os.environ.get('DATA_RECORDS_BATCH_SIZE', 1000))
+    )
+
+services.register('db_engine', _create_db_engine, close=lambda engine: engine.dispose())
+data_records = services.register('data_records', _create_data_records)
+atexit.register(services.close_all)
+
+def get_db_connection():
+    """Shared connection pool for this worker process"""
+    return services.get('db_engine')
+
+# Dependency checks for /readyz: constant-cost calls, run in the background
+health_monitor = HealthMonitor(
+    interval=float(os.environ.get('HEALTH_CHECK_INTERVAL', 15)),
+    timeout=float(os.environ.get('HEALTH_CHECK_TIMEOUT', 5))
+)
+
+def _check_storage():
+    """Bucket metadata get"""
+    storage_client.bucket(BUCKET_NAME).reload(timeout=health_monitor.timeout)
+
+def _check_bigquery():
+    """Dry-run query: validates access to the table without running or billing anything"""
+    from google.cloud import bigquery
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    bigquery_client.query(
+        f"SELECT 1 FROM `{bigquery_client.project}.{DATASET_ID}.{TABLE_ID}` LIMIT 1",
+        job_config=job_config,
+        timeout=health_monitor.timeout
+    )
+
+def _check_kms():
+    """Crypto key metadata get"""
+    kms_manager.client.get_crypto_key(request={"name": kms_manager.key_name}, timeout=health_monitor.timeout)
+
+def _check_database():
+    """SELECT 1 on a pooled connection"""
+    import sqlalchemy
+    with get_db_connection().connect() as conn:
+        conn.execute(sqlalchemy.text("SELECT 1"))
+
+health_monitor.add_check('storage', _check_storage)
+health_monitor.add_check('bigquery', _check_bigquery)
+health_monitor.add_check('kms', _check_kms)
+if os.environ.get('INSTANCE_CONNECTION_NAME'):
+    health_monitor.add_check('database', _check_database)
+
+@app.route('/livez', methods=['GET'])
+def liveness_check():
+    """Liveness: the worker is serving requests; dependencies are not consulted"""
+    return jsonify({
+        'status': 'alive',
+        'pid': os.getpid(),
+        'health_monitor_running': health_monitor.is_alive()
+    })
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    """Readiness from the cached background dependency checks, with per-dependency latency"""
+    snapshot = health_monitor.snapshot()
+    snapshot['status'] = 'ready' if snapshot['ready'] else 'not ready'
+    return jsonify(snapshot), 200 if snapshot['ready'] else 503
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify the application is running correctly"""
-    try:
-        # List files to test GCS connection
-        storage_handler.list_files()
+    # Served from the cached dependency checks; listing the bucket here scaled with the archive
+    snapshot = health_monitor.snapshot()
+    if snapshot['ready']:
         return jsonify({
             'status': 'healthy',
-            'storage': 'connected'
+            'storage': 'connected',
+            'checks': snapshot['checks']
         })
-    except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
+    # Checks that have not reported yet are not failures; only /readyz holds traffic back
+    statuses = [check['status'] for check in snapshot['checks'].values() if check['critical']]
+    if all(status in ('ok', 'pending') for status in statuses):
         return jsonify({
-            'status': 'unhealthy',
-            'error': str(e)
-        }), 500
+            'status': 'starting',
+            'checks': snapshot['checks']
+        })
+    return jsonify({
+        'status': 'unhealthy',
+        'checks': snapshot['checks']
+    }), 500
+
+@app.route('/metrics/dlp', methods=['GET'])
+def dlp_metrics():
+    """Local PHI pre-screen counters, Cloud DLP escalation rate and scan cache hit rate"""
+    metrics = dlp_manager.get_prescreen_metrics()
+    metrics['cache'] = dlp_manager.get_cache_metrics()
+    return jsonify(metrics)
+
+@app.route('/metrics/startup', methods=['GET'])
+def startup_metrics():
+    """App import time and per-service construction times for this worker process"""
+    return jsonify(services.report())
 
 @app.route('/get-token', methods=['GET'])
 def get_token_endpoint():
@@ -407,12 +585,10 @@ def generate_upload_url():
         gcs_url = f"gs://{BUCKET_NAME}/audio_files/{unique_filename}"
         
         # Generate signed URL for direct upload (valid for 15 minutes)
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(f"audio_files/{unique_filename}")
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.now() + datetime.timedelta(minutes=15),
+        signed_url = storage_handler.url_factory.sign(
+            f"audio_files/{unique_filename}",
             method="PUT",
+            expiration=15 * 60,
             content_type="audio/*"
         )
         
@@ -426,6 +602,33 @@ def generate_upload_url():
         print(f"Error generating URL: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def record_audio_upload(user_id, filename):
+    """Insert the audio_records row for an uploaded file; returns (errors, response body)"""
+    # Get the URLs
+    gcs_url = f"gs://{BUCKET_NAME}/audio_files/{filename}"
+    public_url = f"https://storage.googleapis.com/{BUCKET_NAME}/audio_files/{filename}"
+    
+    # Insert record into BigQuery
+    table_ref = bigquery_client.dataset(DATASET_ID).table(TABLE_ID)
+    table = bigquery_client.get_table(table_ref)
+    
+    rows_to_insert = [{
+        'user_id': user_id,
+        'file_name': filename,
+        'gcs_url': gcs_url,
+        'upload_timestamp': datetime.now().isoformat()
+    }]
+    
+    errors = bigquery_client.insert_rows_json(table, rows_to_insert)
+    
+    return errors, {
+        'message': 'Upload successful',
+        'file_name': filename,
+        'gcs_url': gcs_url,
+        'public_url': public_url,
+        'user_id': user_id
+    }
+
 @app.route('/upload', methods=['POST'])
 def upload_audio():
     """Upload an audio file and store metadata."""
@@ -448,38 +651,16 @@ def upload_audio():
         
         try:
             # Upload to Google Cloud Storage
-            bucket = storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(f"audio_files/{filename}")
-            blob.upload_from_file(audio_file)
+            # Large recordings are split into parts uploaded in parallel
+            storage_handler.upload_file(audio_file, f"audio_files/{filename}", audio_file.content_type)
             
-            # Get the URLs
-            gcs_url = f"gs://{BUCKET_NAME}/audio_files/{filename}"
-            public_url = f"https://storage.googleapis.com/{BUCKET_NAME}/audio_files/{filename}"
-            
-            # Insert record into BigQuery
-            table_ref = bigquery_client.dataset(DATASET_ID).table(TABLE_ID)
-            table = bigquery_client.get_table(table_ref)
-            
-            rows_to_insert = [{
-                'user_id': user_id,
-                'file_name': filename,
-                'gcs_url': gcs_url,
-                'upload_timestamp': datetime.now().isoformat()
-            }]
-            
-            errors = bigquery_client.insert_rows_json(table, rows_to_insert)
+            errors, response = record_audio_upload(user_id, filename)
             
             if errors:
                 print(f"BigQuery insert errors: {errors}")
                 return jsonify({'error': f'BigQuery insert error: {errors}'}), 500
                 
-            return jsonify({
-                'message': 'Upload successful',
-                'file_name': filename,
-                'gcs_url': gcs_url,
-                'public_url': public_url,
-                'user_id': user_id
-            }), 200
+            return jsonify(response), 200
             
         except Exception as e:
             print(f"Error during upload: {str(e)}")
@@ -489,6 +670,111 @@ def upload_audio():
         print(f"General error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/stream', methods=['POST'])
+def start_streaming_upload():
+    """Open a streaming upload; the audio is then sent with PUT /upload/stream/<upload_id>"""
+    try:
+        data = request.get_json(silent=True) or request.form
+        user_id = data.get('user_id')
+        file_name = data.get('file_name')
+        content_type = data.get('content_type', 'application/octet-stream')
+        
+        if not user_id or not file_name:
+            return jsonify({'error': 'Both user_id and file_name are required'}), 400
+        
+        file_ext = '.' + file_name.split('.')[-1].lower()
+        if file_ext not in ALLOWED_AUDIO_EXTENSIONS:
+            return jsonify({'error': f'Invalid file type: {file_name}'}), 400
+        
+        # Generate a unique filename
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"{user_id}_{timestamp}_{file_name}"
+        
+        upload_id = streaming_uploads.start(
+            f"audio_files/{filename}",
+            content_type=content_type,
+            metadata={'user_id': user_id, 'file_name': filename}
+        )
+        
+        return jsonify({
+            'upload_id': upload_id,
+            'file_name': filename,
+            'upload_url': f"{request.host_url.rstrip('/')}/upload/stream/{upload_id}",
+            'chunk_size': streaming_uploads.chunk_size,
+            'max_size': streaming_uploads.max_size,
+            'instructions': {
+                'method': 'PUT',
+                'query': 'offset=<committed_offset>&final=<true on the last request>',
+                'headers': {'Content-Type': 'application/octet-stream'}
+            }
+        }), 201
+        
+    except Exception as e:
+        logger.error(f"Error starting streaming upload: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/stream/<upload_id>', methods=['PUT'])
+def write_streaming_upload(upload_id):
+    """Stream the request body into the upload from ?offset=N; ?final=true completes it"""
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'offset must be an integer'}), 400
+    
+    try:
+        final = request.args.get('final', '').lower() in ('1', 'true', 'yes')
+        
+        result = streaming_uploads.write(upload_id, request.stream, offset=offset, final=final)
+        if not result['complete']:
+            return jsonify({
+                'complete': False,
+                'committed_offset': result['committed_offset']
+            }), 200
+        
+        metadata = result['metadata']
+        errors, response = record_audio_upload(metadata['user_id'], metadata['file_name'])
+        if errors:
+            logger.error(f"BigQuery insert errors: {errors}")
+            return jsonify({'error': f'BigQuery insert error: {errors}'}), 500
+        
+        response.update({
+            'complete': True,
+            'size': result['object']['size'],
+            'crc32c': result['object']['crc32c'],
+            'md5': result['object']['md5']
+        })
+        return jsonify(response), 200
+        
+    except UnknownUpload:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    except UploadOffsetMismatch as e:
+        return jsonify({'error': str(e), 'committed_offset': e.committed_offset}), 409
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        logger.error(f"Error during streaming upload {upload_id}: {str(e)}")
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/upload/stream/<upload_id>', methods=['GET'])
+def get_streaming_upload_status(upload_id):
+    """Report the committed offset so an interrupted client knows where to resume"""
+    try:
+        return jsonify(streaming_uploads.status(upload_id))
+    except UnknownUpload:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+    except Exception as e:
+        logger.error(f"Error querying streaming upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/stream/<upload_id>', methods=['DELETE'])
+def cancel_streaming_upload(upload_id):
+    """Abandon a streaming upload"""
+    try:
+        streaming_uploads.cancel(upload_id)
+        return jsonify({'cancelled': True, 'upload_id': upload_id})
+    except UnknownUpload:
+        return jsonify({'error': 'Unknown or expired upload'}), 404
+
 @app.route('/', methods=['GET'])
 def serve_upload_page():
     """Serve the main upload page"""
@@ -532,9 +818,45 @@ def register_upload_fhir():
                     'error': f'Missing required field: {field}'
                 }), 400
         
-        # Scan for PHI in the request data
-        request_text = json.dumps(data)
-        phi_scan = dlp_manager.scan_text_for_phi(request_text)
+        # Independent calls run in parallel; the writes start once their inputs are ready:
+        #   phi_scan, encrypt_patient, encrypt_operator, read_url -> store_metadata, store_fhir
+        pipeline = StagePipeline(pipeline_executor, name="register_upload_fhir")
+        pipeline.add('phi_scan', lambda: dlp_manager.scan_text_for_phi(json.dumps(data)))
+        pipeline.add('encrypt_patient', lambda: (
+            kms_manager.encrypt_sensitive_data(data['patient_id']) if data.get('patient_id') else None
+        ))
+        pipeline.add('encrypt_operator', lambda: (
+            kms_manager.encrypt_sensitive_data(data['operator_name']) if data.get('operator_name') else None
+        ))
+        pipeline.add('read_url', lambda: storage_handler.get_signed_url(data['file_name']))
+        
+        # Nothing is written unless the PHI scan completed
+        pipeline.add(
+            'store_metadata',
+            lambda phi_scan, read_url: storage_handler.store_audio_file_metadata(
+                data['file_name'], read_url, data['file_size'], data['file_type']
+            ),
+            depends_on=['phi_scan', 'read_url']
+        )
+        pipeline.add(
+            'store_fhir',
+            lambda phi_scan, encrypt_patient, encrypt_operator, read_url: storage_handler.store_audio_fhir_resources(
+                file_name=data['file_name'],
+                file_data=read_url,
+                file_size=data['file_size'],
+                file_type=data['file_type'],
+                patient_id=encrypt_patient,  # Use encrypted version
+                operator_name=encrypt_operator,  # Use encrypted version
+                duration_seconds=data.get('duration_seconds'),
+                reason=data.get('reason')
+            ),
+            depends_on=['phi_scan', 'encrypt_patient', 'encrypt_operator', 'read_url']
+        )
+        
+        stages = pipeline.run(timeout=PIPELINE_TIMEOUT_SECONDS)
+        phi_scan = stages['phi_scan']
+        read_url = stages['read_url']
+        result = {'fhir_bundle': stages['store_fhir']}
         
         # Log PHI detection
         if phi_scan['has_phi']:
@@ -551,32 +873,6 @@ def register_upload_fhir():
                 }
             )
         
-        # Encrypt sensitive data if present
-        encrypted_data = data.copy()
-        if data.get('patient_id'):
-            encrypted_data['patient_id_encrypted'] = kms_manager.encrypt_sensitive_data(data['patient_id'])
-            # Replace the original patient_id with encrypted version
-            encrypted_data['patient_id'] = encrypted_data['patient_id_encrypted']
-        if data.get('operator_name'):
-            encrypted_data['operator_name_encrypted'] = kms_manager.encrypt_sensitive_data(data['operator_name'])
-            # Replace the original operator_name with encrypted version
-            encrypted_data['operator_name'] = encrypted_data['operator_name_encrypted']
-
-        # Generate a read URL for the file
-        read_url = storage_handler.get_signed_url(data['file_name'])
-        
-        # Store the metadata with FHIR resources using encrypted data
-        result = storage_handler.store_audio_file_with_fhir(
-            file_name=data['file_name'],
-            file_data=read_url,
-            file_size=data['file_size'],
-            file_type=data['file_type'],
-            patient_id=encrypted_data.get('patient_id'),  # Use encrypted version
-            operator_name=encrypted_data.get('operator_name'),  # Use encrypted version
-            duration_seconds=data.get('duration_seconds'),
-            reason=data.get('reason')
-        )
-        
         # Log successful FHIR resource creation (use original unencrypted values for audit)
         audit_logger.log_fhir_access(
             user_id=data.get('operator_name', 'system'),
@@ -586,7 +882,7 @@ def register_upload_fhir():
             patient_id=data.get('patient_id')  # Original patient_id for audit trail
         )
 
-        return jsonify({
+        response = jsonify({
             'success': True,
             'message': 'Upload registered with FHIR resources successfully',
             'read_url': read_url,
@@ -597,6 +893,8 @@ def register_upload_fhir():
                 'risk_level': phi_scan['risk_level']
             }
         })
+        response.headers['Server-Timing'] = pipeline.server_timing()
+        return response
         
     except Exception as e:
         # Log error with audit trail
@@ -616,103 +914,185 @@ def register_upload_fhir():
             'error': str(e)
         }), 500
 
+@app.route('/register-upload-fhir/batch', methods=['POST'])
+def register_upload_fhir_batch():
+    """Register many uploaded files with FHIR resources in one request"""
+    try:
+        data = request.get_json()
+        files = data.get('files') if isinstance(data, dict) else None
+        if not isinstance(files, list) or not files:
+            return jsonify({
+                'success': False,
+                'error': 'files must be a non-empty list of file descriptors'
+            }), 400
+        if len(files) > MAX_BATCH_REGISTRATIONS:
+            return jsonify({
+                'success': False,
+                'error': f'At most {MAX_BATCH_REGISTRATIONS} files per batch'
+            }), 400
+        
+        required_fields = ['file_name', 'file_size', 'file_type']
+        results = [None] * len(files)
+        valid = []  # indices of well-formed descriptors
+        for index, item in enumerate(files):
+            missing = [field for field in required_fields if not isinstance(item, dict) or field not in item]
+            if missing:
+                results[index] = {
+                    'index': index,
+                    'file_name': item.get('file_name') if isinstance(item, dict) else None,
+                    'success': False,
+                    'error': f'Missing required field: {missing[0]}'
+                }
+            else:
+                valid.append(index)
+        
+        # One PHI scan pass: cached and locally cleared items skip Cloud DLP, the rest share one table inspection
+        phi_scans = dict(zip(valid, dlp_manager.scan_texts_for_phi([json.dumps(files[index]) for index in valid])))
+        for index, phi_scan in phi_scans.items():
+            if phi_scan['has_phi']:
+                audit_logger.log_data_access(
+                    event_type="PHI_DETECTION",
+                    user_id=files[index].get('operator_name', 'unknown'),
+                    resource_type="REQUEST_DATA",
+                    resource_id=files[index]['file_name'],
+                    action="SCAN",
+                    patient_id=files[index].get('patient_id'),
+                    additional_context={
+                        'phi_findings': phi_scan['findings_count'],
+                        'risk_level': phi_scan['risk_level']
+                    }
+                )
+        
+        # One encryption call for every sensitive value in the batch
+        sensitive = [(index, field) for index in valid for field in ('patient_id', 'operator_name')
+                     if files[index].get(field)]
+        encrypted = kms_manager.encrypt_many([files[index][field] for index, field in sensitive])
+        encrypted_fields = {}
+        for (index, field), outcome in zip(sensitive, encrypted):
+            if outcome['error']:
+                results[index] = {
+                    'index': index,
+                    'file_name': files[index]['file_name'],
+                    'success': False,
+                    'error': f"Encryption failed: {outcome['error']}"
+                }
+            encrypted_fields[(index, field)] = outcome['ciphertext']
+        valid = [index for index in valid if results[index] is None]
+        
+        # Read URLs for every file, signed in-process
+        read_urls = storage_handler.get_signed_urls([files[index]['file_name'] for index in valid])
+        
+        stored = storage_handler.store_audio_files_with_fhir_batch([
+            {
+                'file_name': files[index]['file_name'],
+                'file_data': read_urls[files[index]['file_name']],
+                'file_size': files[index]['file_size'],
+                'file_type': files[index]['file_type'],
+                'patient_id': encrypted_fields.get((index, 'patient_id')),  # Use encrypted version
+                'operator_name': encrypted_fields.get((index, 'operator_name')),  # Use encrypted version
+                'duration_seconds': files[index].get('duration_seconds'),
+                'reason': files[index].get('reason')
+            }
+            for index in valid
+        ])
+        
+        for index, outcome in zip(valid, stored):
+            item = files[index]
+            if not outcome['success']:
+                results[index] = {
+                    'index': index,
+                    'file_name': item['file_name'],
+                    'success': False,
+                    'error': outcome['error']
+                }
+                continue
+            
+            # Log successful FHIR resource creation (use original unencrypted values for audit)
+            audit_logger.log_fhir_access(
+                user_id=item.get('operator_name', 'system'),
+                fhir_resource_type="Bundle",
+                fhir_resource_id=outcome['fhir_bundle']['id'],
+                operation="CREATE",
+                patient_id=item.get('patient_id')  # Original patient_id for audit trail
+            )
+            results[index] = {
+                'index': index,
+                'file_name': item['file_name'],
+                'success': True,
+                'read_url': read_urls[item['file_name']],
+                'fhir_bundle_id': outcome['fhir_bundle']['id'],
+                'fhir_resources_created': len(outcome['fhir_bundle']['entry']),
+                'security_scan': {
+                    'phi_detected': phi_scans[index]['has_phi'],
+                    'risk_level': phi_scans[index]['risk_level']
+                }
+            }
+        
+        return jsonify({
+            'success': all(result['success'] for result in results),
+            'registered': sum(1 for result in results if result['success']),
+            'failed': sum(1 for result in results if not result['success']),
+            'results': results
+        })
+        
+    except Exception as e:
+        audit_logger.log_data_access(
+            event_type="ERROR",
+            user_id='unknown',
+            resource_type="FHIR_REGISTRATION",
+            resource_id='batch',
+            action="CREATE",
+            success=False,
+            error_message=str(e)
+        )
+        logger.error(f"Error registering upload batch with FHIR: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/get-medical-records', methods=['GET'])
 def get_medical_records():
     """Retrieve and decrypt medical records for display in Flutter app"""
     try:
-        # Query BigQuery for encrypted medical records
-        query = """
-        SELECT 
-            file_name,
-            patient_id,
-            resource_id,
-            created_at,
-            fhir_resource
-        FROM `app-audio-analyzer.healthcare_audio_data.fhir_resources`
-        WHERE patient_id IS NOT NULL
-        ORDER BY created_at DESC
-        LIMIT 20
-        """
-        
-        query_job = bigquery_client.query(query)
-        results = query_job.result()
+        # Display fields are extracted in BigQuery; only small scalar columns come back
+        results = storage_handler.list_medical_records(limit=20)
         
-        decrypted_records = []
+        # First pass: collect every value that needs decrypting
+        parsed_rows = []
+        ciphertexts = []
         
         for row in results:
             try:
-                # Decrypt patient ID
-                decrypted_patient_id = "Unknown Patient"
-                if row.patient_id and len(row.patient_id) > 50:  # Encrypted data
-                    try:
-                        decrypted_patient_id = kms_manager.decrypt_sensitive_data(row.patient_id)
-                    except Exception:
-                        decrypted_patient_id = "Decryption Failed"
-                else:
-                    decrypted_patient_id = row.patient_id or "Unknown Patient"
+                is_encrypted = len(row.patient_id or '') > 50  # Encrypted data
+                if is_encrypted:
+                    ciphertexts.append(row.patient_id)
                 
-                # Parse FHIR resource to extract operator name and reason
-                doctor_name = "Unknown Doctor"
-                reason = "Not specified"
+                doctor_name = row.practitioner_name or "Unknown Doctor"
+                reason = row.reason_text or "Not specified"
                 
-                if row.fhir_resource:
-                    try:
-                        fhir_data = json.loads(row.fhir_resource)
-                        
-                        # Extract data from FHIR bundle
-                        if 'entry' in fhir_data:
-                            for entry in fhir_data['entry']:
-                                resource = entry.get('resource', {})
-                                
-                                # Look for Practitioner (doctor) information
-                                if resource.get('resourceType') == 'Practitioner':
-                                    if 'name' in resource and len(resource['name']) > 0:
-                                        name_parts = resource['name'][0]
-                                        given_names = name_parts.get('given', [])
-                                        family_name = name_parts.get('family', '')
-                                        
-                                        if given_names or family_name:
-                                            full_name = f"{' '.join(given_names)} {family_name}".strip()
-                                            
-                                            # If the name looks encrypted (long base64), decrypt it
-                                            if len(full_name) > 50:  # Likely encrypted
-                                                try:
-                                                    doctor_name = kms_manager.decrypt_sensitive_data(full_name)
-                                                except Exception:
-                                                    doctor_name = "Decryption Failed"
-                                            else:
-                                                doctor_name = full_name
-                                
-                                # Look for DiagnosticReport (reason)
-                                elif resource.get('resourceType') == 'DiagnosticReport':
-                                    if 'code' in resource and 'text' in resource['code']:
-                                        reason = resource['code']['text']
-                                    elif 'conclusion' in resource:
-                                        reason = resource['conclusion']
-                                
-                                # Look for Media resource for additional info
-                                elif resource.get('resourceType') == 'Media':
-                                    if 'reasonCode' in resource and len(resource['reasonCode']) > 0:
-                                        if 'text' in resource['reasonCode'][0]:
-                                            reason = resource['reasonCode'][0]['text']
-                    
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse FHIR resource for {row.resource_id}")
+                # If the name looks encrypted (long base64), decrypt it with the batch
+                doctor_encrypted = len(row.practitioner_name or '') > 50  # Likely encrypted
+                if doctor_encrypted:
+                    ciphertexts.append(doctor_name)
                 
-                record = {
-                    'id': row.resource_id,
-                    'file_name': row.file_name,
-                    'patient_id': decrypted_patient_id,
-                    'doctor': doctor_name,
-                    'reason': reason,
-                    'date': row.created_at.isoformat() if row.created_at else None,
-                    'is_encrypted': len(row.patient_id or '') > 50  # Show if data was encrypted
-                }
-                
-                decrypted_records.append(record)
+                parsed_rows.append((row, is_encrypted, doctor_name, doctor_encrypted, reason, None))
                 
-            except Exception as decrypt_error:
-                logger.warning(f"Failed to process record {row.resource_id}: {decrypt_error}")
+            except Exception as parse_error:
+                parsed_rows.append((row, False, None, False, None, parse_error))
+        
+        # Decrypt the whole page at once: duplicates collapse and KMS calls run in parallel
+        decrypted = {}
+        if ciphertexts:
+            for ciphertext, outcome in zip(ciphertexts, kms_manager.decrypt_many(ciphertexts)):
+                decrypted[ciphertext] = outcome['plaintext'] if outcome['error'] is None else "Decryption Failed"
+        
+        # Second pass: build the response records
+        decrypted_records = []
+        
+        for row, is_encrypted, doctor_name, doctor_encrypted, reason, row_error in parsed_rows:
+            if row_error is not None:
+                logger.warning(f"Failed to process record {row.resource_id}: {row_error}")
                 # Include record with error indication
                 decrypted_records.append({
                     'id': row.resource_id or 'unknown',
@@ -723,6 +1103,25 @@ def get_medical_records():
                     'date': row.created_at.isoformat() if row.created_at else None,
                     'error': True
                 })
+                continue
+            
+            if is_encrypted:
+                decrypted_patient_id = decrypted[row.patient_id]
+            else:
+                decrypted_patient_id = row.patient_id or "Unknown Patient"
+            
+            if doctor_encrypted:
+                doctor_name = decrypted[doctor_name]
+            
+            decrypted_records.append({
+                'id': row.resource_id,
+                'file_name': row.file_name,
+                'patient_id': decrypted_patient_id,
+                'doctor': doctor_name,
+                'reason': reason,
+                'date': row.created_at.isoformat() if row.created_at else None,
+                'is_encrypted': is_encrypted  # Show if data was encrypted
+            })
         
         # Log the access for audit trail
         audit_logger.log_data_access(
@@ -761,25 +1160,238 @@ def get_medical_records():
             'message': 'Failed to retrieve medical records'
         }), 500
 
-@app.route('/fhir/Media', methods=['GET'])
-def get_fhir_media_resources():
-    """Retrieve FHIR Media resources"""
+def fhir_search_links(search_args, page_token, next_page_token):
+    """Self and next links for a searchset page, carrying the same search parameters"""
+    self_args = dict(search_args, _page_token=page_token) if page_token else search_args
+    links = [{'relation': 'self', 'url': f"{request.base_url}?{urlencode(self_args)}"}]
+    if next_page_token:
+        next_args = dict(search_args, _page_token=next_page_token)
+        links.append({'relation': 'next', 'url': f"{request.base_url}?{urlencode(next_args)}"})
+    return links
+
+def fhir_search_stream(resource_type, patient_id, file_name, count, page_token, search_args):
+    """
+    Stream a searchset Bundle entry by entry straight from the BigQuery row iterator
+    
+    Stored fhir_resource JSON strings are written through without being parsed,
+    except Bundles stored with bundle_storage="references", which are hydrated
+    FHIR_STREAM_HYDRATE_BATCH rows at a time. The links (which depend on the
+    last row) are written after the entries.
+    """
+    # Run the query up front so query errors still produce a normal error response
+    rows = storage_handler.query_fhir_rows(
+        patient_id=patient_id,
+        resource_type=resource_type,
+        file_name=file_name,
+        limit=count + 1,
+        page_token=page_token
+    )
+    
+    def generate():
+        yield '{"resourceType":"Bundle","type":"searchset","entry":['
+        written = 0
+        seen = 0
+        last_row = None
+        next_page_token = None
+        batch = []
+        try:
+            for row in rows:
+                if seen == count:
+                    # The extra row only tells us there is another page
+                    next_page_token = storage_handler.encode_page_token(
+                        last_row.created_at, last_row.resource_id, patient_id, resource_type, file_name
+                    )
+                    break
+                seen += 1
+                last_row = row
+                if not row.fhir_resource:
+                    continue
+                batch.append(row)
+                if len(batch) < FHIR_STREAM_HYDRATE_BATCH:
+                    continue
+                # Bundles in references mode are hydrated a batch at a time, not row by row
+                for fhir_resource in storage_handler.hydrate_fhir_rows(batch):
+                    yield (',' if written else '') + '{"resource":' + fhir_resource + '}'
+                    written += 1
+                batch = []
+            for fhir_resource in storage_handler.hydrate_fhir_rows(batch):
+                yield (',' if written else '') + '{"resource":' + fhir_resource + '}'
+                written += 1
+        except Exception as e:
+            # Headers are already sent: re-raise so the server aborts the chunked response.
+            # Closing the document here would pass a truncated page off as the last one.
+            logger.error(f"Error streaming FHIR {resource_type} resources: {str(e)}")
+            raise
+        links = fhir_search_links(search_args, page_token, next_page_token)
+        yield '],"link":' + json.dumps(links) + '}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def fhir_search(resource_type):
+    """Build one page of a FHIR searchset Bundle for the given resource type"""
+    patient_id = request.args.get('patient')
+    file_name = request.args.get('file_name')
+    page_token = request.args.get('_page_token')
+    stream = request.args.get('_stream', '').lower() in ('1', 'true', 'yes')
+    
     try:
-        patient_id = request.args.get('patient')
-        file_name = request.args.get('file_name')
-        
-        resources = storage_handler.get_fhir_resources(
+        count = int(request.args.get('_count', FHIR_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': '_count must be an integer'}), 400
+    count = max(1, min(count, FHIR_MAX_STREAM_PAGE_SIZE if stream else FHIR_MAX_PAGE_SIZE))
+    
+    # Self and next links carry the same search parameters; total is omitted since it is unknown
+    search_args = {key: value for key, value in request.args.items() if key != '_page_token'}
+    search_args['_count'] = count
+    
+    if stream:
+        try:
+            return fhir_search_stream(resource_type, patient_id, file_name, count, page_token, search_args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    try:
+        resources, next_page_token = storage_handler.search_fhir_resources(
             patient_id=patient_id,
-            resource_type='Media',
-            file_name=file_name
+            resource_type=resource_type,
+            file_name=file_name,
+            count=count,
+            page_token=page_token
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'link': fhir_search_links(search_args, page_token, next_page_token),
+        'entry': [{'resource': res['fhir_resource']} for res in resources if res['fhir_resource']]
+    })
+
+def fhir_operation_outcome(diagnostics, code='invalid'):
+    """A single-issue FHIR OperationOutcome"""
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': code, 'diagnostics': diagnostics}]
+    }
+
+@app.route('/fhir', methods=['POST'])
+def process_fhir_bundle():
+    """Ingest a FHIR transaction or batch Bundle with one multi-row insert"""
+    try:
+        bundle = request.get_json(silent=True)
+        if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+            return jsonify(fhir_operation_outcome('Request body must be a FHIR Bundle')), 400
+        
+        bundle_type = bundle.get('type')
+        if bundle_type not in ('transaction', 'batch'):
+            return jsonify(fhir_operation_outcome('Bundle.type must be transaction or batch')), 400
+        if len(bundle.get('entry') or []) > FHIR_MAX_BUNDLE_ENTRIES:
+            return jsonify(fhir_operation_outcome(
+                f'At most {FHIR_MAX_BUNDLE_ENTRIES} entries per Bundle', code='too-costly'
+            )), 413
+        
+        prepared = storage_handler.fhir_converter.prepare_bundle_entries(bundle)
+        errors = {index: error for index, (_, error) in enumerate(prepared) if error}
+        
+        # A transaction succeeds or fails as a whole
+        if bundle_type == 'transaction' and errors:
+            index, error = next(iter(errors.items()))
+            return jsonify(fhir_operation_outcome(f'Bundle.entry[{index}]: {error}')), 400
+        
+        # Stored resources are immutable: PUT creates with the client's id but never updates.
+        # Read-through caches in every worker rely on this, so an existing id is a conflict.
+        put_keys = {
+            index: (prepared[index][0]['resourceType'], prepared[index][0]['id'])
+            for index, entry in enumerate(bundle.get('entry') or [])
+            if index not in errors and ((entry.get('request') or {}).get('method') or '').upper() == 'PUT'
+        }
+        conflicts = set()
+        if put_keys:
+            existing = storage_handler.existing_fhir_resources(put_keys.values())
+            # The same id twice in one Bundle would also store two versions
+            seen = set()
+            for index, key in sorted(put_keys.items()):
+                if key in existing or key in seen:
+                    conflicts.add(index)
+                seen.add(key)
+            for index in conflicts:
+                errors[index] = f"{'/'.join(put_keys[index])} already exists; updates are not supported"
+            if bundle_type == 'transaction' and conflicts:
+                index = min(conflicts)
+                return jsonify(fhir_operation_outcome(f'Bundle.entry[{index}]: {errors[index]}',
+                                                      code='conflict')), 409
+        
+        # Patient ids are stored KMS-encrypted, as on the registration path
+        valid = [index for index, (_, error) in enumerate(prepared) if not error]
+        subjects = {index: storage_handler.subject_patient_id(prepared[index][0]) for index in valid}
+        with_subject = [index for index in valid if subjects[index]]
+        encrypted_ids = {}
+        for index, outcome in zip(with_subject, kms_manager.encrypt_many([subjects[index] for index in with_subject])):
+            if outcome['error']:
+                errors[index] = f"Encryption failed: {outcome['error']}"
+            encrypted_ids[index] = outcome['ciphertext']
+        
+        if bundle_type == 'transaction' and errors:
+            return jsonify(fhir_operation_outcome('Transaction failed; no resources were stored',
+                                                  code='exception')), 500
+        
+        valid = [index for index in valid if index not in errors]
+        failed = storage_handler.store_fhir_resources(
+            [prepared[index][0] for index in valid],
+            patient_ids=[encrypted_ids.get(index) for index in valid],
+            atomic=bundle_type == 'transaction'
+        )
+        for position in failed:
+            errors[valid[position]] = 'BigQuery rejected the resource'
+        
+        if bundle_type == 'transaction' and failed:
+            return jsonify(fhir_operation_outcome('Transaction failed; no resources were stored',
+                                                  code='exception')), 500
+        
+        # Build the response Bundle, one entry per request entry in order
+        response_entries = []
+        for index, (resource, _) in enumerate(prepared):
+            if index in errors:
+                response_entries.append({
+                    'response': {
+                        'status': '409 Conflict' if index in conflicts else '400 Bad Request',
+                        'outcome': fhir_operation_outcome(errors[index])
+                    }
+                })
+                continue
+            response_entries.append({
+                'response': {
+                    'status': '201 Created',
+                    'location': f"{resource['resourceType']}/{resource['id']}/_history/1",
+                    'etag': 'W/"1"',
+                    'lastModified': resource['meta']['lastUpdated']
+                }
+            })
+        
+        audit_logger.log_fhir_access(
+            user_id='system',
+            fhir_resource_type="Bundle",
+            fhir_resource_id=bundle.get('id') or 'unidentified',
+            operation=bundle_type.upper()
         )
         
         return jsonify({
             'resourceType': 'Bundle',
-            'type': 'searchset',
-            'total': len(resources),
-            'entry': [{'resource': res['fhir_resource']} for res in resources if res['fhir_resource']]
-        })
+            'id': str(uuid.uuid4()),
+            'type': f'{bundle_type}-response',
+            'entry': response_entries
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error processing FHIR Bundle: {str(e)}")
+        return jsonify(fhir_operation_outcome(str(e), code='exception')), 500
+
+@app.route('/fhir/Media', methods=['GET'])
+def get_fhir_media_resources():
+    """Retrieve FHIR Media resources"""
+    try:
+        return fhir_search('Media')
         
     except Exception as e:
         logger.error(f"Error retrieving FHIR Media resources: {str(e)}")
@@ -791,21 +1403,7 @@ def get_fhir_media_resources():
 def get_fhir_document_references():
     """Retrieve FHIR DocumentReference resources"""
     try:
-        patient_id = request.args.get('patient')
-        file_name = request.args.get('file_name')
-        
-        resources = storage_handler.get_fhir_resources(
-            patient_id=patient_id,
-            resource_type='DocumentReference',
-            file_name=file_name
-        )
-        
-        return jsonify({
-            'resourceType': 'Bundle',
-            'type': 'searchset',
-            'total': len(resources),
-            'entry': [{'resource': res['fhir_resource']} for res in resources if res['fhir_resource']]
-        })
+        return fhir_search('DocumentReference')
         
     except Exception as e:
         logger.error(f"Error retrieving FHIR DocumentReference resources: {str(e)}")
@@ -817,21 +1415,7 @@ def get_fhir_document_references():
 def get_fhir_bundles():
     """Retrieve FHIR Bundle resources"""
     try:
-        patient_id = request.args.get('patient')
-        file_name = request.args.get('file_name')
-        
-        resources = storage_handler.get_fhir_resources(
-            patient_id=patient_id,
-            resource_type='Bundle',
-            file_name=file_name
-        )
-        
-        return jsonify({
-            'resourceType': 'Bundle',
-            'type': 'searchset',
-            'total': len(resources),
-            'entry': [{'resource': res['fhir_resource']} for res in resources if res['fhir_resource']]
-        })
+        return fhir_search('Bundle')
         
     except Exception as e:
         logger.error(f"Error retrieving FHIR Bundle resources: {str(e)}")
@@ -843,29 +1427,21 @@ def get_fhir_bundles():
 def get_fhir_media_by_id(resource_id):
     """Retrieve a specific FHIR Media resource by ID"""
     try:
-        query = f"""
-        SELECT fhir_resource
-        FROM `{storage_handler.dataset_id}.{storage_handler.fhir_table_id}`
-        WHERE resource_type = 'Media' AND resource_id = @resource_id
-        LIMIT 1
-        """
-        
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("resource_id", "STRING", resource_id)
-            ]
-        )
+        cached = storage_handler.get_fhir_resource_json('Media', resource_id)
         
-        query_job = storage_handler.bigquery_client.query(query, job_config=job_config)
-        results = list(query_job.result())
-        
-        if not results:
+        if cached is None:
             return jsonify({
                 'error': 'Resource not found'
             }), 404
         
-        fhir_resource = json.loads(results[0].fhir_resource)
-        return jsonify(fhir_resource)
+        body, etag = cached
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            # Serve the stored JSON bytes directly
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
         
     except Exception as e:
         logger.error(f"Error retrieving FHIR Media resource by ID: {str(e)}")
@@ -873,6 +1449,100 @@ def get_fhir_media_by_id(resource_id):
             'error': str(e)
         }), 500
 
+@app.route('/store-data', methods=['POST'])
+def store_data():
+    """Store a JSON document, or a JSON array of documents in bulk, in data_records"""
+    try:
+        payload = request.get_json(silent=True)
+        if payload is None:
+            return jsonify({'error': 'Request body must be a JSON document or array of documents'}), 400
+        
+        documents = payload if isinstance(payload, list) else [payload]
+        if not documents:
+            return jsonify({'error': 'No records provided'}), 400
+        if len(documents) > MAX_INGEST_RECORDS:
+            return jsonify({'error': f'At most {MAX_INGEST_RECORDS} records per request'}), 413
+        
+        # ?method=copy streams the rows with COPY: fastest for large loads, but returns no ids
+        if request.args.get('method') == 'copy':
+            stored = data_records.copy_many(documents)
+            return jsonify({'success': True, 'stored': stored}), 201
+        
+        ids = data_records.insert_many(documents)
+        if isinstance(payload, list):
+            return jsonify({'success': True, 'stored': len(ids), 'ids': ids}), 201
+        return jsonify({'success': True, 'id': ids[0]}), 201
+        
+    except Exception as e:
+        logger.error(f"Error storing data records: {str(e)}")
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+@app.route('/data-records', methods=['GET'])
+def query_data_records():
+    """
+    Query data_records, newest first, one keyset page at a time
+    
+    Query parameters:
+        contains: JSON the document must contain, e.g. {"status": "active"}
+        field.<key>: text value a top-level key must equal, e.g. field.status=active
+        created_after / created_before: ISO timestamps bounding created_at
+        _count: page size
+        _page_token: next_page_token from the previous page
+    """
+    try:
+        contains = request.args.get('contains')
+        if contains is not None:
+            try:
+                contains = json.loads(contains)
+            except ValueError:
+                return jsonify({'error': 'contains must be valid JSON'}), 400
+        
+        fields = {key[len('field.'):]: value for key, value in request.args.items() if key.startswith('field.')}
+        
+        try:
+            created_after = request.args.get('created_after')
+            created_after = datetime.fromisoformat(created_after) if created_after else None
+            created_before = request.args.get('created_before')
+            created_before = datetime.fromisoformat(created_before) if created_before else None
+            count = int(request.args.get('_count', DATA_RECORDS_DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'created_after/created_before must be ISO timestamps and _count an integer'}), 400
+        count = max(1, min(count, DATA_RECORDS_MAX_PAGE_SIZE))
+        
+        try:
+            records, next_page_token = data_records.query(
+                contains=contains,
+                fields=fields,
+                created_after=created_after,
+                created_before=created_before,
+                limit=count,
+                page_token=request.args.get('_page_token')
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'records': records,
+            'count': len(records),
+            'next_page_token': next_page_token
+        })
+        
+    except Exception as e:
+        logger.error(f"Error querying data records: {str(e)}")
+        return jsonify({
+            'error': str(e)
+        }), 500
+
+services.record_phase('app_import', (time.perf_counter() - _IMPORT_STARTED) * 1000)
+
+# Build the clients in the background once the worker is up, so neither the import
+# nor the first request pays for them; SERVICE_WARMUP=false defers them to first use
+if os.environ.get('SERVICE_WARMUP', 'true').lower() in ('1', 'true', 'yes'):
+    services.warm(['storage_handler', 'kms_manager', 'dlp_manager', 'audit_logger', 'streaming_uploads'])
+    health_monitor.start()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 else:
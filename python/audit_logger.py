@@ -1,13 +1,24 @@
 from google.cloud import logging as cloud_logging
 from datetime import datetime
+import atexit
 import json
 import logging
-from typing import Dict, Any, Optional
+import os
+import queue
+import threading
+import time
+from typing import Dict, Any, List, Optional
 
 class AuditLogger:
     """Centralized audit logging for healthcare data access compliance"""
     
-    def __init__(self, project_id: str):
+    def __init__(self, project_id: str,
+                 async_shipping: bool = True,
+                 max_queue_size: int = 10000,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 enqueue_timeout: float = 0.05,
+                 spill_path: Optional[str] = None):
         self.project_id = project_id
         self.client = cloud_logging.Client(project=project_id)
         self.client.setup_logging()
@@ -15,6 +26,163 @@ class AuditLogger:
         # Create structured logger for audit events
         self.audit_logger = self.client.logger("healthcare-audit-log")
         
+        # Background shipping: bounded queue -> batched Cloud Logging writes,
+        # with an append-only local spill file whenever the backend falls behind
+        self.async_shipping = async_shipping
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        # Spilled events carry PHI identifiers: keep them in a private directory, not shared /tmp
+        self.spill_path = spill_path or os.environ.get("AUDIT_SPILL_PATH") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "audit_spill", "audit-spill.jsonl"
+        )
+        os.makedirs(os.path.dirname(self.spill_path), mode=0o700, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._spill_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._next_replay = 0.0
+        self.stats = {"enqueued": 0, "shipped": 0, "spilled": 0, "replayed": 0, "batches": 0,
+                      "quarantined": 0, "flusher_errors": 0}
+        
+        if async_shipping:
+            self._flusher = threading.Thread(target=self._run_flusher, name="audit-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+    
+    def _emit(self, event: Dict[str, Any], severity: str, labels: Dict[str, str]):
+        """Ship an audit event, off the request thread when async shipping is enabled"""
+        if not self.async_shipping:
+            self.audit_logger.log_struct(event, severity=severity, labels=labels)
+            return
+        
+        entry = {"event": event, "severity": severity, "labels": labels}
+        try:
+            # Backpressure: wait briefly for room, then spill to disk rather than drop
+            self._queue.put(entry, timeout=self.enqueue_timeout)
+            self.stats["enqueued"] += 1
+        except queue.Full:
+            self._spill([entry])
+    
+    def _run_flusher(self):
+        """Drain the queue in batches until stopped; an error never ends the loop"""
+        while not self._stop.is_set():
+            try:
+                batch = self._take_batch(wait=self.flush_interval)
+                if batch:
+                    self._ship(batch)
+                elif self._queue.empty():
+                    self._replay_spill()
+            except Exception as e:
+                self.stats["flusher_errors"] += 1
+                logging.error(f"Audit flusher error, continuing: {e}")
+                self._stop.wait(1.0)
+    
+    def _take_batch(self, wait: float) -> List[Dict[str, Any]]:
+        """Collect up to batch_size entries, waiting at most ``wait`` seconds for the first"""
+        batch = []
+        deadline = time.monotonic() + wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _ship(self, batch: List[Dict[str, Any]]) -> bool:
+        """Write a batch with one Cloud Logging call, spilling it to disk on failure"""
+        try:
+            log_batch = self.audit_logger.batch()
+            for entry in batch:
+                log_batch.log_struct(entry["event"], severity=entry["severity"], labels=entry["labels"])
+            log_batch.commit()
+            self.stats["shipped"] += len(batch)
+            self.stats["batches"] += 1
+            return True
+        except Exception as e:
+            logging.error(f"Error shipping {len(batch)} audit events, spilling to disk: {e}")
+            self._spill(batch)
+            return False
+    
+    def _spill(self, entries: List[Dict[str, Any]]):
+        """Append entries to the local spill file"""
+        with self._spill_lock:
+            fd = os.open(self.spill_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "a") as spill_file:
+                for entry in entries:
+                    spill_file.write(json.dumps(entry, default=str) + "\n")
+                spill_file.flush()
+                os.fsync(spill_file.fileno())
+        self.stats["spilled"] += len(entries)
+    
+    def _replay_spill(self):
+        """Re-ship spilled entries once the backend has caught up"""
+        if time.monotonic() < self._next_replay:
+            return
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, replay_path)
+        
+        entries, bad_lines = [], []
+        with open(replay_path, errors="replace") as replay_file:
+            for line in replay_file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    if not isinstance(entry, dict) or "event" not in entry:
+                        raise ValueError("not an audit entry")
+                    entries.append(entry)
+                except ValueError:
+                    # Truncated write or corruption: set it aside rather than block the replay
+                    bad_lines.append(line if line.endswith("\n") else line + "\n")
+        if bad_lines:
+            self._quarantine(bad_lines)
+        
+        for start in range(0, len(entries), self.batch_size):
+            chunk = entries[start:start + self.batch_size]
+            if not self._ship(chunk):
+                # _ship re-spilled this chunk; keep the rest on disk and back off
+                self._spill(entries[start + self.batch_size:])
+                self._next_replay = time.monotonic() + 30
+                break
+            self.stats["replayed"] += len(chunk)
+        try:
+            os.remove(replay_path)
+        except FileNotFoundError:
+            pass
+    
+    def _quarantine(self, lines: List[str]):
+        """Keep unparseable spill lines for manual inspection"""
+        quarantine_path = self.spill_path + ".bad"
+        fd = os.open(quarantine_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "a") as quarantine_file:
+            quarantine_file.writelines(lines)
+        self.stats["quarantined"] += len(lines)
+        logging.error(f"Quarantined {len(lines)} unreadable audit spill lines in {quarantine_path}")
+    
+    def flush(self):
+        """Synchronously ship everything currently queued"""
+        while True:
+            batch = self._take_batch(wait=0)
+            if not batch:
+                return
+            self._ship(batch)
+    
+    def close(self):
+        """Stop the flusher and drain the queue on shutdown"""
+        if not self.async_shipping or self._stop.is_set():
+            return
+        self._stop.set()
+        self._flusher.join(timeout=self.flush_interval + 5)
+        self.flush()
+        
     def log_data_access(self, 
                        event_type: str,
                        user_id: str,
@@ -51,7 +219,7 @@ class AuditLogger:
         # Log to Cloud Logging with appropriate severity
         severity = "ERROR" if not success else "INFO"
         
-        self.audit_logger.log_struct(
+        self._emit(
             audit_event,
             severity=severity,
             labels={
@@ -83,7 +251,7 @@ class AuditLogger:
             "changes_made": changes_made or {}
         }
         
-        self.audit_logger.log_struct(
+        self._emit(
             admin_event,
             severity="NOTICE",
             labels={
@@ -113,7 +281,7 @@ class AuditLogger:
         
         severity = "WARNING" if not success else "INFO"
         
-        self.audit_logger.log_struct(
+        self._emit(
             auth_event,
             severity=severity,
             labels={
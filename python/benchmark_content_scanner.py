@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for SecurityMiddleware request content scanning
+
+Compares the previous approach (str() of the whole JSON body, lowercased,
+then one uncompiled re.search per pattern) with the single compiled
+alternation applied to the JSON string leaves.
+
+Usage:
+    python benchmark_content_scanner.py [--entries N] [--repeat N]
+"""
+import argparse
+import re
+import timeit
+import uuid
+from security_middleware import SecurityMiddleware
+
+def build_registration_body(entries: int) -> dict:
+    """A large, clean FHIR-registration-like body"""
+    return {
+        "file_name": "recording_20240101_120000.wav",
+        "file_size": 1048576,
+        "file_type": "audio/wav",
+        "patient_id": "PAT-1234567",
+        "operator_name": "Ward 4 Nurse Station",
+        "reason": "Respiratory assessment follow-up",
+        "entry": [
+            {
+                "resource": {
+                    "resourceType": "Media",
+                    "id": str(uuid.uuid4()),
+                    "status": "completed",
+                    "content": {
+                        "contentType": "audio/wav",
+                        "url": f"https://storage.googleapis.com/bucket/audio_files/file_{index}.wav",
+                        "title": f"file_{index}.wav",
+                        "size": 1048576
+                    },
+                    "note": [{"text": "Patient resting, normal breath sounds bilaterally. " * 4}]
+                }
+            }
+            for index in range(entries)
+        ]
+    }
+
+def legacy_scan(patterns, json_data) -> bool:
+    """The pre-compiled-scanner implementation, kept here for comparison"""
+    content_lower = str(json_data).lower()
+    for pattern in patterns:
+        if re.search(pattern, content_lower, re.IGNORECASE):
+            return True
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request content scanning")
+    parser.add_argument("--entries", type=int, default=200, help="FHIR entries in the test body")
+    parser.add_argument("--repeat", type=int, default=200, help="Scans per measurement")
+    args = parser.parse_args()
+
+    security = SecurityMiddleware()
+    body = build_registration_body(args.entries)
+    body_chars = len(str(body))
+
+    # Both implementations must agree on the clean body and on a malicious one
+    malicious = dict(body, reason="<script>alert(1)</script>")
+    assert legacy_scan(security.suspicious_patterns, body) is False
+    assert security.scan_json(body) is None
+    assert legacy_scan(security.suspicious_patterns, malicious) is True
+    assert security.scan_json(malicious) == "xss_script_tag"
+
+    legacy = timeit.timeit(lambda: legacy_scan(security.suspicious_patterns, body), number=args.repeat)
+    compiled = timeit.timeit(lambda: security.scan_json(body), number=args.repeat)
+
+    print(f"Body: {args.entries} entries, ~{body_chars / 1024:.0f} KB as text")
+    print(f"Legacy per-pattern scan:   {legacy / args.repeat * 1e6:10.1f} us/request")
+    print(f"Compiled alternation scan: {compiled / args.repeat * 1e6:10.1f} us/request")
+    print(f"Speedup: {legacy / compiled:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for FHIRConverter audio bundle construction
+
+Compares the dict-literal path (build Media, DocumentReference and Bundle,
+then json.dumps each resource and splice it into the Bundle text) with the
+precompiled-template path, which produces the dicts and their JSON together.
+
+Usage:
+    python benchmark_fhir_converter.py [--repeat N]
+"""
+import argparse
+import json
+import timeit
+from fhir_converter import FHIRConverter
+
+SAMPLE = {
+    "file_name": "recording_20240101_120000.wav",
+    "file_path": "https://storage.googleapis.com/healthcare_audio_analyzer_fhir/recording_20240101_120000.wav",
+    "file_size_bytes": 1048576,
+    "content_type": "audio/wav",
+    "patient_id": "PAT-1234567",
+    "operator_name": "Ward 4 Nurse Station",
+    "duration_seconds": 42.5,
+    "reason": "Respiratory assessment follow-up"
+}
+
+def check_identical(legacy: FHIRConverter, templated: FHIRConverter):
+    """The template path must produce the same structure and the same bytes as json.dumps"""
+    for sample in (SAMPLE, dict(SAMPLE, patient_id=None, operator_name=None, duration_seconds=None,
+                                reason=None, file_name='résumé "quoted".wav')):
+        expected, _ = legacy.convert_audio_metadata_to_fhir_with_json(**sample)
+        bundle, json_by_id = templated.convert_audio_metadata_to_fhir_with_json(**sample)
+
+        # Ids and timestamps differ between calls; compare with them normalized
+        def normalize(text):
+            for resource in [bundle] + [entry["resource"] for entry in bundle["entry"]]:
+                text = text.replace(resource["id"], "ID")
+            return text.replace(bundle["meta"]["lastUpdated"], "NOW")
+
+        assert json.dumps(bundle) == json_by_id[bundle["id"]]
+        for entry in bundle["entry"]:
+            assert json.dumps(entry["resource"]) == json_by_id[entry["resource"]["id"]]
+
+        legacy_text = json.dumps(expected)
+        for resource in [expected] + [entry["resource"] for entry in expected["entry"]]:
+            legacy_text = legacy_text.replace(resource["id"], "ID")
+        legacy_text = legacy_text.replace(expected["meta"]["lastUpdated"], "NOW")
+        for entry in expected["entry"]:
+            legacy_text = legacy_text.replace(entry["resource"]["meta"]["lastUpdated"], "NOW")
+        assert normalize(json_by_id[bundle["id"]]) == legacy_text
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FHIR bundle construction")
+    parser.add_argument("--repeat", type=int, default=20000, help="Bundles per measurement")
+    args = parser.parse_args()
+
+    legacy = FHIRConverter()
+    templated = FHIRConverter(use_templates=True)
+    check_identical(legacy, templated)
+
+    legacy_time = timeit.timeit(
+        lambda: legacy.convert_audio_metadata_to_fhir_with_json(**SAMPLE), number=args.repeat
+    )
+    template_time = timeit.timeit(
+        lambda: templated.convert_audio_metadata_to_fhir_with_json(**SAMPLE), number=args.repeat
+    )
+
+    print(f"Bundles: {args.repeat} (dict + JSON for bundle, Media and DocumentReference)")
+    print(f"Dict literals + json.dumps: {legacy_time / args.repeat * 1e6:8.1f} us/bundle")
+    print(f"Precompiled templates:      {template_time / args.repeat * 1e6:8.1f} us/bundle")
+    print(f"Speedup: {legacy_time / template_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
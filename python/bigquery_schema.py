@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+BigQuery schema management for the healthcare audio dataset
+
+Defines the partitioned and clustered layout of the fhir_resources and
+audio_files tables, and provides a migration command that copies an existing
+ad-hoc table into that layout and reports the bytes scanned by the
+StorageHandler queries before and after.
+
+Usage:
+    python bigquery_schema.py create
+    python bigquery_schema.py migrate fhir_resources [--measure] [--swap]
+    python bigquery_schema.py add-display-columns
+"""
+import argparse
+import logging
+from datetime import datetime
+from google.cloud import bigquery
+from generate_token import generate_token
+from storage_handler import MEDICAL_RECORD_DISPLAY_SQL
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATASET_ID = "healthcare_audio_data"
+
+# Table layouts: every StorageHandler query filters on the clustering columns
+# and sorts by the partitioning column
+TABLE_LAYOUTS = {
+    "fhir_resources": {
+        "schema": [
+            bigquery.SchemaField("resource_type", "STRING"),
+            bigquery.SchemaField("resource_id", "STRING"),
+            bigquery.SchemaField("fhir_resource", "STRING"),
+            bigquery.SchemaField("created_at", "TIMESTAMP"),
+            bigquery.SchemaField("patient_id", "STRING"),
+            bigquery.SchemaField("file_name", "STRING"),
+            # Materialized medical-records display fields (StorageHandler display_columns)
+            bigquery.SchemaField("practitioner_name", "STRING"),
+            bigquery.SchemaField("reason_text", "STRING"),
+        ],
+        "partition_field": "created_at",
+        "clustering_fields": ["resource_type", "patient_id", "file_name"],
+    },
+    "audio_files": {
+        # Union of the columns written by store_audio_file_metadata and the
+        # columns read by get_file_metadata / get_pending_analyses
+        "schema": [
+            bigquery.SchemaField("file_name", "STRING"),
+            bigquery.SchemaField("file_path", "STRING"),
+            bigquery.SchemaField("upload_timestamp", "TIMESTAMP"),
+            bigquery.SchemaField("file_size_bytes", "INT64"),
+            bigquery.SchemaField("file_data", "STRING"),
+            bigquery.SchemaField("file_size", "INT64"),
+            bigquery.SchemaField("file_type", "STRING"),
+            bigquery.SchemaField("user_id", "STRING"),
+            bigquery.SchemaField("upload_date", "TIMESTAMP"),
+            bigquery.SchemaField("analysis_status", "STRING"),
+            bigquery.SchemaField("analysis_result", "STRING"),
+        ],
+        "partition_field": "upload_timestamp",
+        "clustering_fields": ["analysis_status", "file_name"],
+    },
+}
+
+# Representative copies of the StorageHandler queries, with {table} left open.
+# Each entry: (description, query, sample column used to pick a parameter value)
+REPRESENTATIVE_QUERIES = {
+    "fhir_resources": [
+        ("FHIR search page by patient",
+         "SELECT resource_type, resource_id, fhir_resource, created_at FROM `{table}` "
+         "WHERE patient_id = @value ORDER BY created_at DESC, resource_id DESC LIMIT 51",
+         "patient_id"),
+        ("FHIR search page by resource type",
+         "SELECT resource_type, resource_id, fhir_resource, created_at FROM `{table}` "
+         "WHERE resource_type = @value ORDER BY created_at DESC, resource_id DESC LIMIT 51",
+         "resource_type"),
+        ("FHIR search page by file",
+         "SELECT resource_type, resource_id, fhir_resource, created_at FROM `{table}` "
+         "WHERE file_name = @value ORDER BY created_at DESC, resource_id DESC LIMIT 51",
+         "file_name"),
+    ],
+    "audio_files": [
+        ("get_file_metadata",
+         "SELECT * FROM `{table}` WHERE file_name = @value",
+         "file_name"),
+        ("get_pending_analyses",
+         "SELECT * FROM `{table}` WHERE analysis_status = @value ORDER BY upload_date ASC",
+         "analysis_status"),
+    ],
+}
+
+def build_table(client: bigquery.Client, table_name: str, table_id: str = None) -> bigquery.Table:
+    """Build a Table object with the managed partitioning and clustering"""
+    layout = TABLE_LAYOUTS[table_name]
+    table = bigquery.Table(f"{client.project}.{DATASET_ID}.{table_id or table_name}", schema=layout["schema"])
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY,
+        field=layout["partition_field"]
+    )
+    table.clustering_fields = layout["clustering_fields"]
+    return table
+
+def ensure_tables(client: bigquery.Client):
+    """Create any managed table that does not exist yet"""
+    for table_name in TABLE_LAYOUTS:
+        table = client.create_table(build_table(client, table_name), exists_ok=True)
+        print(f"✅ {table.full_table_id}: partitioned by {table.time_partitioning.field}, "
+              f"clustered on {', '.join(table.clustering_fields or [])}")
+
+def sample_value(client: bigquery.Client, table_ref: str, column: str):
+    """Pick an existing value of ``column`` to parameterize the representative queries"""
+    query = f"SELECT {column} AS value FROM `{table_ref}` WHERE {column} IS NOT NULL LIMIT 1"
+    for row in client.query(query).result():
+        return row.value
+    return None
+
+def bytes_scanned(client: bigquery.Client, table_name: str, table_ref: str, measure: bool) -> list:
+    """Dry-run (and optionally run) the representative queries against one table"""
+    results = []
+    for description, template, column in REPRESENTATIVE_QUERIES[table_name]:
+        value = sample_value(client, table_ref, column)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("value", "STRING", value)],
+            use_query_cache=False
+        )
+        query = template.format(table=table_ref)
+
+        dry_run_config = bigquery.QueryJobConfig(
+            query_parameters=job_config.query_parameters,
+            dry_run=True,
+            use_query_cache=False
+        )
+        estimate = client.query(query, job_config=dry_run_config).total_bytes_processed
+
+        # Dry runs cannot see cluster pruning, so the real figure needs an actual run
+        actual = None
+        if measure:
+            job = client.query(query, job_config=job_config)
+            job.result()
+            actual = job.total_bytes_billed
+
+        results.append((description, estimate, actual))
+    return results
+
+def format_bytes(num_bytes) -> str:
+    if num_bytes is None:
+        return "-"
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} PB"
+
+def migrate_table(client: bigquery.Client, table_name: str, measure: bool = False, swap: bool = False):
+    """Copy an existing table into the managed layout and report bytes scanned before and after"""
+    layout = TABLE_LAYOUTS[table_name]
+    source_ref = f"{client.project}.{DATASET_ID}.{table_name}"
+    target_id = f"{table_name}_partitioned"
+    target_ref = f"{client.project}.{DATASET_ID}.{target_id}"
+
+    print(f"\n📦 Migrating {source_ref} -> {target_ref}")
+    print("=" * 60)
+
+    # Copy with CTAS so partitioning and clustering apply to the existing rows
+    copy_query = f"""
+    CREATE OR REPLACE TABLE `{target_ref}`
+    PARTITION BY DATE({layout["partition_field"]})
+    CLUSTER BY {", ".join(layout["clustering_fields"])}
+    AS SELECT * FROM `{source_ref}`
+    """
+    client.query(copy_query).result()
+    target = client.get_table(target_ref)
+    print(f"✅ Copied {target.num_rows} rows ({format_bytes(target.num_bytes)})")
+
+    before = bytes_scanned(client, table_name, source_ref, measure)
+    after = bytes_scanned(client, table_name, target_ref, measure)
+
+    print(f"\n📊 BYTES SCANNED (estimate / billed{'' if measure else ', run with --measure'})")
+    print("-" * 60)
+    for (description, est_before, act_before), (_, est_after, act_after) in zip(before, after):
+        print(f"{description}:")
+        print(f"   before: {format_bytes(est_before)} / {format_bytes(act_before)}")
+        print(f"   after:  {format_bytes(est_after)} / {format_bytes(act_after)}")
+
+    if swap:
+        # Tables with an active streaming buffer cannot be renamed; pause writers first
+        legacy_id = f"{table_name}_legacy_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        client.query(f"ALTER TABLE `{source_ref}` RENAME TO `{legacy_id}`").result()
+        client.query(f"ALTER TABLE `{target_ref}` RENAME TO `{table_name}`").result()
+        print(f"\n🔁 Swapped tables: {table_name} is now partitioned, old data kept in {legacy_id}")
+    else:
+        print(f"\n💡 Re-run with --swap to replace {table_name} with {target_id}")
+
+def add_display_columns(client: bigquery.Client):
+    """Add the materialized display columns to fhir_resources and backfill them from fhir_resource"""
+    table_ref = f"{client.project}.{DATASET_ID}.fhir_resources"
+
+    for column in MEDICAL_RECORD_DISPLAY_SQL:
+        client.query(f"ALTER TABLE `{table_ref}` ADD COLUMN IF NOT EXISTS {column} STRING").result()
+    print(f"✅ {table_ref}: columns {', '.join(MEDICAL_RECORD_DISPLAY_SQL)} present")
+
+    # Rows still in the streaming buffer cannot be updated; re-run later to cover them
+    assignments = ",\n    ".join(f"{column} = {expression}" for column, expression in MEDICAL_RECORD_DISPLAY_SQL.items())
+    job = client.query(f"""
+    UPDATE `{table_ref}`
+    SET {assignments}
+    WHERE resource_type = 'Bundle' AND practitioner_name IS NULL AND reason_text IS NULL
+    """)
+    job.result()
+    print(f"✅ Backfilled {job.num_dml_affected_rows} Bundle rows")
+    print("💡 Set FHIR_DISPLAY_COLUMNS=true so new rows are written with these columns")
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage BigQuery table layouts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("create", help="Create missing tables with the managed layout")
+
+    migrate_parser = subparsers.add_parser("migrate", help="Copy an existing table into the managed layout")
+    migrate_parser.add_argument("table", choices=sorted(TABLE_LAYOUTS))
+    migrate_parser.add_argument("--measure", action="store_true",
+                                help="Also run the representative queries and report billed bytes")
+    migrate_parser.add_argument("--swap", action="store_true",
+                                help="Rename the migrated table into place, keeping the old one as *_legacy_*")
+
+    subparsers.add_parser("add-display-columns",
+                          help="Add and backfill the medical-records display columns on fhir_resources")
+
+    args = parser.parse_args()
+
+    credentials, project_id = generate_token()
+    client = bigquery.Client(credentials=credentials, project=project_id)
+
+    if args.command == "create":
+        ensure_tables(client)
+    elif args.command == "migrate":
+        migrate_table(client, args.table, measure=args.measure, swap=args.swap)
+    elif args.command == "add-display-columns":
+        add_display_columns(client)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+from google.cloud import bigquery
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class BufferedBigQueryWriter:
+    """Background write buffer that coalesces streaming inserts per table.
+
+    Rows are enqueued on the request thread and shipped to BigQuery by a
+    single flusher thread, either when a table's buffer reaches
+    ``max_batch_rows`` or when a buffered row reaches its deadline:
+    ``max_latency`` seconds for ``enqueue``d rows, ``confirm_latency`` for
+    rows passed to ``write``. ``enqueue`` returns as soon as the row is
+    buffered, so its failures only reach ``on_row_error``; ``write`` waits
+    for the batch and reports which rows BigQuery rejected. Batches are sent
+    with ``skip_invalid_rows`` so one bad row does not fail its neighbours.
+    ``on_rows_written`` is called with the rows of each batch that BigQuery
+    accepted.
+    """
+
+    def __init__(self,
+                 bigquery_client: bigquery.Client,
+                 max_batch_rows: int = 500,
+                 max_latency: float = 1.0,
+                 on_row_error: Optional[Callable[[str, Dict[str, Any], List[Dict]], None]] = None,
+                 confirm_latency: float = 0.05,
+                 on_rows_written: Optional[Callable[[str, List[Dict[str, Any]]], None]] = None):
+        self.bigquery_client = bigquery_client
+        self.max_batch_rows = max_batch_rows
+        self.max_latency = max_latency
+        self.confirm_latency = confirm_latency
+        self.on_row_error = on_row_error or self._log_row_error
+        self.on_rows_written = on_rows_written
+
+        # Per-table buffers of (insert_id, row, deadline, future) and each table's earliest deadline
+        self._buffers = defaultdict(deque)
+        self._deadlines = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+
+        self._stats = {"rows_enqueued": 0, "rows_written": 0, "rows_failed": 0, "insert_calls": 0}
+
+        self._thread = threading.Thread(target=self._run, name="bigquery-writer", daemon=True)
+        self._thread.start()
+
+        # Flush whatever is still buffered when the process exits
+        atexit.register(self.close)
+
+    def enqueue(self, table_ref: str, row: Dict[str, Any]) -> str:
+        """Buffer a row for ``table_ref`` and return its insert ID"""
+        return self._buffer(table_ref, [row], self.max_latency, None)[0]
+
+    def enqueue_many(self, table_ref: str, rows: List[Dict[str, Any]]) -> List[str]:
+        """Buffer several rows for ``table_ref`` under one lock and return their insert IDs"""
+        return self._buffer(table_ref, rows, self.max_latency, None)
+
+    def write(self, table_ref: str, rows: List[Dict[str, Any]], timeout: Optional[float] = 30.0) -> List[int]:
+        """
+        Buffer rows and wait until BigQuery has accepted or rejected them
+
+        The rows still share insert calls with other buffered rows, but are
+        flushed within ``confirm_latency`` seconds.
+
+        Returns:
+            Indices of the rows BigQuery rejected
+        """
+        return self.write_many([(table_ref, rows)], timeout=timeout)[0]
+
+    def write_many(self, writes: List[Tuple[str, List[Dict[str, Any]]]],
+                   timeout: Optional[float] = 30.0) -> List[List[int]]:
+        """
+        Buffer rows for several tables and wait once for all of them
+
+        Every table's rows get the same ``confirm_latency`` deadline, so they
+        are flushed in the same round instead of one confirmed wait per table.
+
+        Returns:
+            For each (table_ref, rows) pair, the indices of the rows BigQuery rejected
+        """
+        pending = []
+        for table_ref, rows in writes:
+            futures = [Future() for _ in rows]
+            self._buffer(table_ref, rows, self.confirm_latency, futures)
+            pending.append((table_ref, futures))
+
+        results = []
+        for table_ref, futures in pending:
+            failed = []
+            for index, future in enumerate(futures):
+                try:
+                    future.result(timeout=timeout)
+                except FutureTimeoutError:
+                    raise TimeoutError(f"BigQuery write to {table_ref} not confirmed within {timeout}s")
+                except Exception:
+                    failed.append(index)
+            results.append(failed)
+        return results
+
+    def _buffer(self, table_ref: str, rows: List[Dict[str, Any]], latency: float,
+                futures: Optional[List[Future]]) -> List[str]:
+        insert_ids = [str(uuid.uuid4()) for _ in rows]
+        if not rows:
+            return insert_ids
+        deadline = time.monotonic() + latency
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BigQuery writer is closed")
+            buffer = self._buffers[table_ref]
+            buffer.extend(zip(insert_ids, rows, [deadline] * len(rows), futures or [None] * len(rows)))
+            self._deadlines[table_ref] = min(self._deadlines.get(table_ref, deadline), deadline)
+            self._stats["rows_enqueued"] += len(rows)
+            if len(buffer) >= self.max_batch_rows or futures:
+                # Size trigger, or a confirmed write with an earlier deadline than the flusher expects
+                self._wakeup.notify()
+        return insert_ids
+
+    def flush(self):
+        """Synchronously write every buffered row"""
+        with self._lock:
+            batches = self._take_batches(force=True)
+        self._write_batches(batches)
+
+    def close(self, timeout: float = 10.0):
+        """Stop the flusher thread and drain the buffers"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        """Flusher loop: wake on size trigger or at the next deadline"""
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                batches = self._take_batches(force=False)
+                if not batches:
+                    self._wakeup.wait(timeout=self._next_deadline())
+                    continue
+            self._write_batches(batches)
+
+    def _next_deadline(self) -> float:
+        """Seconds until the earliest buffered row is due"""
+        if not self._deadlines:
+            return self.max_latency
+        return max(min(self._deadlines.values()) - time.monotonic(), 0.0)
+
+    def _take_batches(self, force: bool) -> List[tuple]:
+        """Pop ready batches from the buffers; caller must hold the lock"""
+        now = time.monotonic()
+        batches = []
+        for table_ref, buffer in self._buffers.items():
+            while buffer:
+                due = now >= self._deadlines.get(table_ref, now)
+                if not (force or due or len(buffer) >= self.max_batch_rows):
+                    break
+                count = min(len(buffer), self.max_batch_rows)
+                batches.append((table_ref, [buffer.popleft() for _ in range(count)]))
+                # The rows left behind carry their own deadlines
+                if buffer:
+                    self._deadlines[table_ref] = min(item[2] for item in buffer)
+            if not buffer:
+                self._deadlines.pop(table_ref, None)
+        return batches
+
+    def _write_batches(self, batches: List[tuple]):
+        """Issue one ``insert_rows_json`` call per batch"""
+        for table_ref, items in batches:
+            row_ids = [item[0] for item in items]
+            rows = [item[1] for item in items]
+            try:
+                errors = self.bigquery_client.insert_rows_json(
+                    table_ref, rows, row_ids=row_ids, skip_invalid_rows=True
+                )
+            except Exception as e:
+                logger.error(f"Error writing batch of {len(rows)} rows to {table_ref}: {str(e)}")
+                errors = [{"index": index, "errors": [{"message": str(e)}]} for index in range(len(rows))]
+
+            failed = {}
+            for error in errors or []:
+                index = error.get("index")
+                if index is not None and 0 <= index < len(rows):
+                    failed[index] = error.get("errors", [])
+
+            with self._lock:
+                self._stats["insert_calls"] += 1
+                self._stats["rows_failed"] += len(failed)
+                self._stats["rows_written"] += len(rows) - len(failed)
+
+            if self.on_rows_written is not None and len(failed) < len(rows):
+                try:
+                    self.on_rows_written(table_ref, [row for index, row in enumerate(rows) if index not in failed])
+                except Exception as e:
+                    logger.error(f"Rows written callback failed: {str(e)}")
+
+            for index, (_, row, _, future) in enumerate(items):
+                if index in failed:
+                    try:
+                        self.on_row_error(table_ref, row, failed[index])
+                    except Exception as e:
+                        logger.error(f"Row error callback failed: {str(e)}")
+                    if future is not None:
+                        future.set_exception(Exception(f"BigQuery rejected row: {failed[index]}"))
+                elif future is not None:
+                    future.set_result(row_ids[index])
+
+            logger.debug(f"Flushed {len(rows)} rows to {table_ref} ({len(failed)} failed)")
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    @staticmethod
+    def _log_row_error(table_ref: str, row: Dict[str, Any], errors: List[Dict]):
+        """Default per-row error callback"""
+        logger.error(f"Errors inserting row into {table_ref}: {errors}")
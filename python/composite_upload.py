@@ -0,0 +1,143 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# GCS compose accepts at most 32 source objects per request
+MAX_COMPOSE_SOURCES = 32
+
+
+class ParallelCompositeUploader:
+    """Upload large files to GCS as parallel parts assembled with compose.
+
+    Files at or below ``threshold`` bytes go up as a single upload. Larger
+    files are read in ``part_size`` pieces, each uploaded on its own
+    connection from a thread pool, then composed into the destination object.
+    At most ``max_workers`` parts are held in memory at once. Temporary part
+    objects are deleted whether the upload succeeds or fails.
+    """
+
+    def __init__(self, storage_client, bucket_name: str,
+                 threshold: int = 32 * 1024 * 1024,
+                 part_size: int = 16 * 1024 * 1024,
+                 max_workers: int = 8):
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.threshold = threshold
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcs-part")
+
+    def upload(self, file_obj, blob_name: str, content_type: Optional[str] = None):
+        """Upload a seekable file object to ``blob_name`` and return the resulting blob"""
+        stream = getattr(file_obj, "stream", file_obj)  # unwrap werkzeug FileStorage
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(0)
+
+        bucket = self.storage_client.bucket(self.bucket_name)
+        blob = bucket.blob(blob_name)
+        if size <= self.threshold:
+            blob.upload_from_file(stream, size=size, content_type=content_type)
+            return blob
+
+        prefix = f"{blob_name}.parts/{uuid.uuid4().hex}/"
+        created = []  # every temporary object name, for cleanup
+        created_lock = threading.Lock()
+
+        def upload_part(name: str, data: bytes):
+            part = bucket.blob(name)
+            with created_lock:
+                created.append(name)
+            part.upload_from_string(data, content_type=content_type, checksum="crc32c")
+            return part
+
+        try:
+            parts = self._upload_parts(stream, prefix, upload_part)
+            self._compose(bucket, blob, parts, prefix, content_type, created, created_lock)
+            logger.info(f"Uploaded {blob_name} ({size} bytes) as {len(parts)} parallel parts")
+            return blob
+        except Exception as e:
+            logger.error(f"Parallel composite upload of {blob_name} failed: {str(e)}")
+            raise
+        finally:
+            self._cleanup(bucket, created)
+
+    def _upload_parts(self, stream, prefix: str, upload_part) -> List:
+        """Read the stream into parts and upload them concurrently, preserving order"""
+        # Bound the parts in flight so memory stays at max_workers * part_size
+        slots = threading.BoundedSemaphore(self.max_workers)
+        failed = threading.Event()
+        futures = []
+
+        def release(future):
+            if future.cancelled() or future.exception() is not None:
+                failed.set()
+            slots.release()
+
+        try:
+            index = 0
+            while True:
+                slots.acquire()
+                if failed.is_set():
+                    # Stop reading once any part has failed; result() below re-raises it
+                    slots.release()
+                    break
+                data = stream.read(self.part_size)
+                if not data:
+                    slots.release()
+                    break
+                future = self._executor.submit(upload_part, f"{prefix}{index:05d}", data)
+                future.add_done_callback(release)
+                futures.append(future)
+                index += 1
+            return [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            # Let in-flight parts finish so cleanup sees every object they created
+            for future in futures:
+                if not future.cancelled():
+                    future.exception()
+            raise
+
+    def _compose(self, bucket, destination, parts: List, prefix: str,
+                 content_type: Optional[str], created: List[str], created_lock: threading.Lock):
+        """Compose parts into ``destination``, via intermediate objects above 32 parts"""
+        level = 0
+        while len(parts) > MAX_COMPOSE_SOURCES:
+            groups = [parts[i:i + MAX_COMPOSE_SOURCES] for i in range(0, len(parts), MAX_COMPOSE_SOURCES)]
+            names = [f"{prefix}compose-{level}-{i:05d}" for i in range(len(groups))]
+            with created_lock:
+                created.extend(names)
+
+            def compose_group(name, group):
+                intermediate = bucket.blob(name)
+                intermediate.content_type = content_type
+                intermediate.compose(group)
+                return intermediate
+
+            parts = list(self._executor.map(compose_group, names, groups))
+            level += 1
+
+        destination.content_type = content_type
+        destination.compose(parts)
+
+    def _cleanup(self, bucket, names: List[str]):
+        """Delete temporary part objects, logging (not raising) on failure"""
+        if not names:
+            return
+
+        def delete(name):
+            try:
+                bucket.blob(name).delete()
+            except Exception as e:
+                # Parts that never finished uploading do not exist
+                if getattr(e, "code", None) != 404:
+                    logger.warning(f"Could not delete temporary part {name}: {e}")
+
+        list(self._executor.map(delete, names))
@@ -0,0 +1,183 @@
+import base64
+import csv
+import hashlib
+import io
+import json
+import logging
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import sqlalchemy
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# PostgreSQL accepts at most 65535 bind parameters per statement
+MAX_BATCH_SIZE = 10000
+
+# Top-level keys usable in field filters and expression indexes. Field filters are
+# inlined as data ->> 'key' so they match the expression indexes; the pattern keeps
+# that safe and the derived index name valid.
+FIELD_KEY_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,40}$")
+
+
+@lru_cache(maxsize=32)
+def _values_statement(table: str, rows: int):
+    """INSERT of ``rows`` documents in one statement, returning their ids in input order"""
+    values = ", ".join(f"(CAST(:d{i} AS JSONB))" for i in range(rows))
+    return sqlalchemy.text(f"INSERT INTO {table} (data) VALUES {values} RETURNING id")
+
+
+class DataRecordStore:
+    """Bulk writes of JSON documents to the data_records table.
+
+    ``insert_many`` sends multi-row ``INSERT ... VALUES`` statements of
+    ``batch_size`` documents and returns the new ids. ``copy_many`` streams
+    the documents through ``COPY ... FROM STDIN``, which is faster for large
+    loads but does not return ids. Either way a call is one transaction:
+    every document is stored or none is.
+
+    ``query`` filters with JSONB containment (GIN index), equality on
+    top-level keys (expression indexes) and created_at ranges (BRIN index),
+    and pages newest first with an id keyset cursor, so each page costs the
+    same however deep it is. The indexes come from data_records_schema.py.
+    """
+
+    def __init__(self, engine, table: str = "data_records", batch_size: int = 1000):
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+
+    def insert_many(self, documents: Iterable[Any]) -> List[int]:
+        """Insert documents with batched multi-row INSERTs and return their ids"""
+        serialized = [json.dumps(document) for document in documents]
+        ids = []
+        try:
+            with self.engine.begin() as conn:
+                for start in range(0, len(serialized), self.batch_size):
+                    batch = serialized[start:start + self.batch_size]
+                    params = {f"d{i}": text for i, text in enumerate(batch)}
+                    ids.extend(conn.execute(_values_statement(self.table, len(batch)), params).scalars())
+        except Exception as e:
+            logger.error(f"Bulk insert of {len(serialized)} records failed: {str(e)}")
+            raise
+        return ids
+
+    def copy_many(self, documents: Iterable[Any]) -> int:
+        """Load documents with COPY FROM STDIN and return the number of rows written"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        count = 0
+        for document in documents:
+            writer.writerow([json.dumps(document)])
+            count += 1
+        buffer.seek(0)
+
+        raw = self.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(f"COPY {self.table} (data) FROM STDIN WITH (FORMAT csv)", stream=buffer)
+            raw.commit()
+        except Exception as e:
+            raw.rollback()
+            logger.error(f"COPY of {count} records failed: {str(e)}")
+            raise
+        finally:
+            raw.close()
+        return count
+
+    @staticmethod
+    def _filters_fingerprint(contains, fields, created_after, created_before) -> str:
+        """Short hash binding a page token to the query it was issued for"""
+        filters = json.dumps([
+            contains,
+            sorted((fields or {}).items()),
+            created_after.isoformat() if created_after else None,
+            created_before.isoformat() if created_before else None
+        ], sort_keys=True)
+        return hashlib.sha256(filters.encode('utf-8')).hexdigest()[:16]
+
+    def encode_page_token(self, record_id: int, fingerprint: str) -> str:
+        """Opaque keyset cursor pointing just past ``record_id``"""
+        cursor = {"i": record_id, "f": fingerprint}
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('utf-8').rstrip("=")
+
+    def decode_page_token(self, page_token: str, fingerprint: str) -> int:
+        """Decode a page token, raising ValueError if it is malformed or from another query"""
+        try:
+            padded = page_token + "=" * (-len(page_token) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')))
+            record_id = int(cursor["i"])
+            token_fingerprint = cursor["f"]
+        except Exception:
+            raise ValueError("Invalid page token")
+
+        if token_fingerprint != fingerprint:
+            raise ValueError("Page token does not match the query parameters")
+
+        return record_id
+
+    def query(self, contains: Optional[Any] = None, fields: Optional[Dict[str, str]] = None,
+              created_after: Optional[datetime] = None, created_before: Optional[datetime] = None,
+              limit: int = 50, page_token: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Return one page of records matching every filter, newest first
+
+        Args:
+            contains: JSON value the document must contain (data @> contains)
+            fields: top-level key -> text value the key must equal (data ->> key = value)
+            created_after / created_before: half-open created_at range
+            limit: page size
+            page_token: cursor from the previous page
+
+        Returns:
+            (records, next_page_token); next_page_token is None on the last page
+        """
+        fingerprint = self._filters_fingerprint(contains, fields, created_after, created_before)
+        conditions = []
+        params = {"limit": limit + 1}
+
+        if contains is not None:
+            conditions.append("data @> CAST(:contains AS JSONB)")
+            params["contains"] = json.dumps(contains)
+        for index, (key, value) in enumerate(sorted((fields or {}).items())):
+            if not FIELD_KEY_PATTERN.match(key):
+                raise ValueError(f"Invalid field name: {key}")
+            conditions.append(f"data ->> '{key}' = :field{index}")
+            params[f"field{index}"] = str(value)
+        if created_after is not None:
+            conditions.append("created_at >= :created_after")
+            params["created_after"] = created_after
+        if created_before is not None:
+            conditions.append("created_at < :created_before")
+            params["created_before"] = created_before
+        if page_token:
+            conditions.append("id < :after_id")
+            params["after_id"] = self.decode_page_token(page_token, fingerprint)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        statement = sqlalchemy.text(
+            f"SELECT id, data, created_at FROM {self.table} {where} ORDER BY id DESC LIMIT :limit"
+        )
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(statement, params).all()
+        except Exception as e:
+            logger.error(f"data_records query failed: {str(e)}")
+            raise
+
+        # One extra row tells whether another page exists
+        next_page_token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_page_token = self.encode_page_token(rows[-1].id, fingerprint)
+
+        records = [
+            {"id": row.id, "data": row.data, "created_at": row.created_at.isoformat()}
+            for row in rows
+        ]
+        return records, next_page_token
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Cloud SQL schema management for the data_records table
+
+Migrates data_records from JSON to JSONB and creates its indexes: a GIN
+(jsonb_path_ops) index for containment filters, a BRIN index on created_at,
+and optional expression indexes on frequently queried top-level keys. Every
+step is idempotent. Indexes are built CONCURRENTLY so writes continue; the
+JSON -> JSONB conversion rewrites the table and holds an exclusive lock
+while it runs, so schedule it for a quiet period on large tables.
+
+Usage:
+    python data_records_schema.py migrate [--index-key KEY ...] [--measure]
+    python data_records_schema.py explain [--index-key KEY ...]
+
+Requires INSTANCE_CONNECTION_NAME, DB_USER, DB_PASS and DB_NAME.
+"""
+import argparse
+import json
+import logging
+import os
+import sqlalchemy
+from google.cloud.sql.connector import Connector
+from data_records import FIELD_KEY_PATTERN
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TABLE = "data_records"
+
+INDEXES = {
+    "data_records_data_path_idx": f"ON {TABLE} USING GIN (data jsonb_path_ops)",
+    "data_records_created_at_brin": f"ON {TABLE} USING BRIN (created_at)",
+}
+
+def expression_index(key: str):
+    """(name, definition) of the expression index serving `data ->> 'key' = ...` filters"""
+    if not FIELD_KEY_PATTERN.match(key):
+        raise ValueError(f"Invalid field name: {key}")
+    return f"data_records_data_{key.lower()}_idx", f"ON {TABLE} ((data ->> '{key}'))"
+
+def expression_indexes(keys):
+    """(name, definition, key literal) per distinct key, rejecting keys whose index names collide
+
+    PostgreSQL folds unquoted names to lowercase, so "Status" and "status" would
+    share an index name and CREATE INDEX IF NOT EXISTS would silently skip one.
+    """
+    indexes = {}
+    for key in dict.fromkeys(keys):
+        name, definition = expression_index(key)
+        if name in indexes:
+            raise ValueError(f"Index keys {indexes[name][0]!r} and {key!r} map to the same index name {name}")
+        indexes[name] = (key, definition)
+    return [(name, definition, f"'{key}'") for name, (key, definition) in indexes.items()]
+
+def create_engine(connector: Connector):
+    """Single-connection engine in autocommit mode, as CREATE INDEX CONCURRENTLY requires"""
+    settings = {var: os.environ.get(var) for var in ['INSTANCE_CONNECTION_NAME', 'DB_USER', 'DB_PASS', 'DB_NAME']}
+    missing_vars = [var for var, value in settings.items() if not value]
+    if missing_vars:
+        raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
+
+    def getconn():
+        return connector.connect(
+            settings['INSTANCE_CONNECTION_NAME'],
+            "pg8000",
+            user=settings['DB_USER'],
+            password=settings['DB_PASS'],
+            db=settings['DB_NAME'],
+            enable_iam_auth=False
+        )
+
+    return sqlalchemy.create_engine("postgresql+pg8000://", creator=getconn,
+                                    isolation_level="AUTOCOMMIT", pool_size=1)
+
+def column_type(conn) -> str:
+    return conn.execute(sqlalchemy.text("""
+    SELECT data_type FROM information_schema.columns
+    WHERE table_name = :table AND column_name = 'data'
+    """), {"table": TABLE}).scalar()
+
+def create_index(conn, name: str, definition: str, expected: str = None):
+    """
+    CREATE INDEX CONCURRENTLY, replacing an invalid leftover of an interrupted build
+
+    An existing index whose definition lacks ``expected`` was built for something
+    else under the same name (e.g. another key's case) and is an error, not a skip.
+    """
+    existing = conn.execute(sqlalchemy.text("""
+    SELECT i.indisvalid, pg_get_indexdef(i.indexrelid) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE c.relname = :name
+    """), {"name": name}).first()
+    valid = existing[0] if existing else None
+    if valid and expected and expected not in existing[1]:
+        raise ValueError(f"Index {name} already exists with a different definition: {existing[1]}")
+    if valid is False:
+        print(f"⚠️ Dropping invalid index {name} left by an interrupted build")
+        conn.execute(sqlalchemy.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    elif valid:
+        print(f"✅ Index {name} already exists")
+        return
+
+    conn.execute(sqlalchemy.text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}"))
+    print(f"✅ Created index {name}")
+
+def sample_filters(conn, index_keys):
+    """A containment filter and field filters built from the newest record, for EXPLAIN"""
+    data = conn.execute(sqlalchemy.text(f"SELECT data FROM {TABLE} ORDER BY id DESC LIMIT 1")).scalar()
+    if isinstance(data, str):
+        data = json.loads(data)
+    if not isinstance(data, dict):
+        return None, {}
+    scalars = {key: value for key, value in data.items() if not isinstance(value, (dict, list))}
+    contains = dict(list(scalars.items())[:1]) or None
+    fields = {key: str(scalars[key]) for key in index_keys if key in scalars}
+    return contains, fields
+
+def explain(conn, index_keys):
+    """EXPLAIN ANALYZE the query endpoint's statements for sample filters"""
+    contains, fields = sample_filters(conn, index_keys)
+    if contains is None and not fields:
+        print("ℹ️ No sample record with top-level scalar values; nothing to explain")
+        return
+
+    # Cast to JSONB works for both the legacy JSON column and the migrated one
+    statements = []
+    if contains is not None:
+        statements.append((f"data::jsonb @> '{json.dumps(contains)}'",
+                           "data::jsonb @> CAST(:value AS JSONB)", json.dumps(contains)))
+    for key, value in fields.items():
+        statements.append((f"data ->> '{key}' = '{value}'", f"data ->> '{key}' = :value", value))
+
+    for label, condition, value in statements:
+        plan = conn.execute(sqlalchemy.text(f"""
+        EXPLAIN (ANALYZE, BUFFERS)
+        SELECT id, data, created_at FROM {TABLE} WHERE {condition} ORDER BY id DESC LIMIT 50
+        """), {"value": value}).scalars().all()
+        print(f"\n📊 {label}")
+        for line in plan:
+            print(f"   {line}")
+
+def migrate(conn, index_keys, measure: bool = False):
+    conn.execute(sqlalchemy.text(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE} (
+        id SERIAL PRIMARY KEY,
+        data JSONB NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """))
+
+    if measure:
+        print("Before migration:")
+        explain(conn, index_keys)
+
+    if column_type(conn) == "json":
+        print(f"🔄 Converting {TABLE}.data from JSON to JSONB (rewrites the table)...")
+        conn.execute(sqlalchemy.text(f"ALTER TABLE {TABLE} ALTER COLUMN data TYPE JSONB USING data::jsonb"))
+    print(f"✅ {TABLE}.data is JSONB")
+
+    for name, definition in INDEXES.items():
+        create_index(conn, name, definition)
+    for name, definition, key_literal in expression_indexes(index_keys):
+        create_index(conn, name, definition, expected=key_literal)
+
+    conn.execute(sqlalchemy.text(f"ANALYZE {TABLE}"))
+    print(f"✅ Analyzed {TABLE}")
+
+    if measure:
+        print("\nAfter migration:")
+        explain(conn, index_keys)
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the data_records table layout")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Convert data to JSONB and create the indexes")
+    migrate_parser.add_argument("--index-key", action="append", default=[],
+                                help="Top-level key to give an expression index (repeatable)")
+    migrate_parser.add_argument("--measure", action="store_true",
+                                help="EXPLAIN ANALYZE sample queries before and after")
+
+    explain_parser = subparsers.add_parser("explain", help="EXPLAIN ANALYZE sample queries")
+    explain_parser.add_argument("--index-key", action="append", default=[],
+                                help="Top-level key to include a field filter for (repeatable)")
+
+    args = parser.parse_args()
+    expression_indexes(args.index_key)  # reject invalid or colliding keys before connecting
+
+    connector = Connector()
+    engine = create_engine(connector)
+    try:
+        with engine.connect() as conn:
+            if args.command == "migrate":
+                migrate(conn, args.index_key, measure=args.measure)
+            elif args.command == "explain":
+                explain(conn, args.index_key)
+    except Exception as e:
+        logger.error(f"data_records schema command failed: {str(e)}")
+        raise
+    finally:
+        engine.dispose()
+        connector.close()
+
+if __name__ == "__main__":
+    main()
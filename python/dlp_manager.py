@@ -1,12 +1,97 @@
 from google.cloud import dlp_v2
+from collections import OrderedDict
+import hashlib
+import hmac
 import json
 import logging
+import re
+import secrets
+import threading
+import time
 from typing import Dict, List, Any, Optional
 
+# Local first-stage detectors: info type -> (pattern, confidence weight)
+LOCAL_DETECTORS = {
+    "US_SOCIAL_SECURITY_NUMBER": (r"\b(?!000|666|9\d\d)\d{3}-(?!00)\d{2}-(?!0000)\d{4}\b", 0.95),
+    "EMAIL_ADDRESS": (r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b", 0.9),
+    "PHONE_NUMBER": (r"(?<!\d)(?:\+?1[ .-]?)?\(?\d{3}\)?[ .-]\d{3}[ .-]\d{4}(?!\d)", 0.75),
+    "MEDICAL_RECORD_NUMBER": (r"\bMRN[-:# ]?\d{5,12}\b", 0.85),
+    "DATE_OF_BIRTH": (r"\b(?:\d{1,2}[/-]\d{1,2}[/-](?:19|20)\d{2}|(?:19|20)\d{2}-\d{2}-\d{2})\b", 0.5),
+}
+
+# Dictionary terms that make a payload worth a closer look without being PHI on their own
+LOCAL_KEYWORDS = ["patient", "dob", "birth", "ssn", "social security", "mrn", "medical record",
+                  "dr.", "mr.", "mrs.", "ms.", "doctor", "nurse"]
+LOCAL_KEYWORD_WEIGHT = 0.35
+
+# Capitalized "First Last" sequences are likely person names, which only Cloud DLP can confirm
+LOCAL_NAME_PATTERN = r"\b[A-Z][a-z]+ [A-Z][a-z]+\b"
+LOCAL_NAME_WEIGHT = 0.4
+
+# Weight for matches of DLPManager.custom_patterns
+LOCAL_CUSTOM_PATTERN_WEIGHT = 0.6
+
+# Cloud DLP rejects inspect requests above 0.5 MB of content; leave room for the envelope
+DLP_MAX_REQUEST_BYTES = 450 * 1024
+
+# Larger texts are inspected as several overlapping segments; a finding no longer
+# than the overlap is seen whole in at least one of them
+DLP_SEGMENT_OVERLAP_BYTES = 1024
+
+class ScanResultCache:
+    """Bounded LRU/TTL cache of scan results keyed by content HMAC.
+
+    Callers must only store PHI-free values (hashes, counts, info types and
+    byte ranges); quotes and texts are re-derived from the caller's input.
+    """
+    
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] >= self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
 class DLPManager:
     """Cloud DLP manager for protecting sensitive healthcare data"""
     
-    def __init__(self, project_id: str):
+    def __init__(self, project_id: str,
+                 prescreen_policy: str = "local_first",
+                 clear_threshold: float = 0.3,
+                 positive_threshold: float = 0.9,
+                 escalate_on_positive: bool = True,
+                 cache_max_entries: int = 10000,
+                 cache_ttl_seconds: float = 3600):
         self.project_id = project_id
         self.client = dlp_v2.DlpServiceClient()
         self.parent = f"projects/{project_id}/locations/global"
@@ -31,6 +116,164 @@ class DLPManager:
             "MEDICAL_DEVICE_ID": r"MD-[A-Z0-9]{8,12}",
             "FHIR_RESOURCE_ID": r"[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}"
         }
+        
+        # Local pre-screen decision policy:
+        #   "local_first" - skip Cloud DLP when the local score is below clear_threshold
+        #   "always_dlp"  - always call Cloud DLP (local stage only feeds metrics)
+        #   "local_only"  - never call Cloud DLP
+        # Scores at or above positive_threshold are escalated unless escalate_on_positive is False,
+        # in which case the local findings are returned directly.
+        self.prescreen_policy = prescreen_policy
+        self.clear_threshold = clear_threshold
+        self.positive_threshold = positive_threshold
+        self.escalate_on_positive = escalate_on_positive
+        self._compile_local_detectors()
+        
+        # Content-addressed cache of scan results (hashes and findings metadata only). Keys are
+        # HMACs under a per-process random key, so a key cannot be confirmed by hashing a guess
+        self.scan_cache = ScanResultCache(max_entries=cache_max_entries, ttl_seconds=cache_ttl_seconds)
+        self._cache_secret = secrets.token_bytes(32)
+        
+        self._metrics_lock = threading.Lock()
+        self.prescreen_metrics = {
+            "scans": 0,
+            "local_clear": 0,
+            "local_positive": 0,
+            "escalations": 0,
+            "cache_hits": 0
+        }
+    
+    def _compile_local_detectors(self):
+        """Compile the local detectors and custom patterns into one pass-ready list"""
+        self._local_detectors = [
+            (info_type, re.compile(pattern), weight)
+            for info_type, (pattern, weight) in LOCAL_DETECTORS.items()
+        ]
+        self._local_detectors.extend(
+            (name, re.compile(pattern), LOCAL_CUSTOM_PATTERN_WEIGHT)
+            for name, pattern in self.custom_patterns.items()
+            if name != "FHIR_RESOURCE_ID"  # Resource IDs are generated UUIDs, not PHI
+        )
+        self._local_detectors.append(("PERSON_NAME", re.compile(LOCAL_NAME_PATTERN), LOCAL_NAME_WEIGHT))
+        self._keyword_pattern = re.compile(
+            r"(?<!\w)(?:" + "|".join(re.escape(keyword) for keyword in LOCAL_KEYWORDS) + r")(?!\w)",
+            re.IGNORECASE
+        )
+    
+    def prescreen_text(self, text_content: str) -> Dict[str, Any]:
+        """
+        Local first-stage PHI detector
+        
+        Returns:
+            Local findings (same shape as Cloud DLP findings), a confidence score
+            in [0, 1] that the text contains PHI, and the decision for this text
+            ("clear", "ambiguous" or "positive")
+        """
+        findings = []
+        miss_probability = 1.0
+        # ASCII text has byte offsets equal to character offsets
+        ascii_only = text_content.isascii()
+        
+        for info_type, pattern, weight in self._local_detectors:
+            matches = list(pattern.finditer(text_content))
+            if not matches:
+                continue
+            miss_probability *= (1 - weight)
+            # Matches come in order: advance a (character, byte) cursor instead of re-encoding the prefix
+            char_pos = byte_pos = 0
+            for match in matches:
+                if ascii_only:
+                    start = match.start()
+                else:
+                    byte_pos += len(text_content[char_pos:match.start()].encode('utf-8'))
+                    char_pos = match.start()
+                    start = byte_pos
+                findings.append({
+                    "info_type": info_type,
+                    "likelihood": "LIKELY" if weight >= self.positive_threshold else "POSSIBLE",
+                    "quote": match.group(0),
+                    "location": {
+                        "byte_range": {
+                            "start": start,
+                            "end": start + len(match.group(0).encode('utf-8'))
+                        }
+                    }
+                })
+        
+        if self._keyword_pattern.search(text_content):
+            miss_probability *= (1 - LOCAL_KEYWORD_WEIGHT)
+        
+        score = round(1 - miss_probability, 4)
+        if score >= self.positive_threshold:
+            decision = "positive"
+        elif score < self.clear_threshold:
+            decision = "clear"
+        else:
+            decision = "ambiguous"
+        
+        return {"score": score, "decision": decision, "findings": findings}
+    
+    def _should_escalate(self, decision: str) -> bool:
+        """Apply the pre-screen policy to a local decision"""
+        if self.prescreen_policy == "always_dlp":
+            return True
+        if self.prescreen_policy == "local_only":
+            return False
+        if decision == "positive":
+            return self.escalate_on_positive
+        return decision == "ambiguous"
+    
+    def get_prescreen_metrics(self) -> Dict[str, Any]:
+        """Counters and escalation rate for the local pre-screen"""
+        with self._metrics_lock:
+            metrics = dict(self.prescreen_metrics)
+        metrics["escalation_rate"] = (
+            round(metrics["escalations"] / metrics["scans"], 4) if metrics["scans"] else 0.0
+        )
+        metrics["policy"] = self.prescreen_policy
+        return metrics
+    
+    def _cache_key(self, operation: str, text_content: str, **options) -> str:
+        """Keyed hash (HMAC-SHA256) of the operation, the inspect configuration and the scanned text"""
+        config = json.dumps({
+            "operation": operation,
+            "info_types": self.healthcare_info_types,
+            "custom_patterns": self.custom_patterns,
+            "policy": [self.prescreen_policy, self.clear_threshold,
+                       self.positive_threshold, self.escalate_on_positive],
+            "options": options
+        }, sort_keys=True)
+        digest = hmac.new(self._cache_secret, config.encode('utf-8'), hashlib.sha256)
+        digest.update(b"\x00")
+        digest.update(text_content.encode('utf-8'))
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _strip_quotes(scan_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy of a scan result with the quoted PHI removed, safe to cache"""
+        cached = dict(scan_result)
+        cached["findings"] = [
+            {key: value for key, value in finding.items() if key != "quote"}
+            for finding in scan_result["findings"]
+        ]
+        return cached
+    
+    @staticmethod
+    def _restore_quotes(cached: Dict[str, Any], text_content: str) -> Dict[str, Any]:
+        """Rebuild finding quotes from the caller's text and the cached byte ranges"""
+        text_bytes = text_content.encode('utf-8')
+        result = dict(cached)
+        result["findings"] = []
+        for finding in cached["findings"]:
+            byte_range = finding["location"]["byte_range"]
+            restored = dict(finding)
+            restored["quote"] = text_bytes[byte_range["start"]:byte_range["end"]].decode('utf-8', errors='replace')
+            result["findings"].append(restored)
+        return result
+    
+    def get_cache_metrics(self) -> Dict[str, Any]:
+        """Hit/miss counters for the scan result cache"""
+        return self.scan_cache.stats()
     
     def create_inspection_template(self):
         """Create DLP inspection template for healthcare data"""
@@ -82,6 +325,226 @@ class DLPManager:
     def scan_text_for_phi(self, text_content: str) -> Dict[str, Any]:
         """Scan text content for Protected Health Information (PHI)"""
         
+        cache_key = self._cache_key("inspect", text_content)
+        cached = self.scan_cache.get(cache_key)
+        if cached is not None:
+            self._record_cached_screening(cached)
+            return self._restore_quotes(cached, text_content)
+        
+        result = self._scan_uncached(text_content)
+        self.scan_cache.put(cache_key, self._strip_quotes(result))
+        return result
+    
+    def _scan_uncached(self, text_content: str) -> Dict[str, Any]:
+        """Local pre-screen followed, if the policy says so, by Cloud DLP"""
+        
+        local_result, screening = self._local_screen(text_content)
+        if local_result is not None:
+            return local_result
+        
+        result = self._inspect_with_dlp(text_content)
+        result["screening"] = screening
+        return result
+    
+    def _local_screen(self, text_content: str):
+        """
+        Run the local pre-screen and record its metrics
+        
+        Returns:
+            (result, screening): result is the final scan result when the policy
+            does not escalate, otherwise None and Cloud DLP must inspect the text
+        """
+        prescreen = self.prescreen_text(text_content)
+        escalate = self._should_escalate(prescreen["decision"])
+        self._record_screening(prescreen["decision"], escalate)
+        
+        screening = {
+            "local_score": prescreen["score"],
+            "local_decision": prescreen["decision"],
+            "escalated": escalate
+        }
+        
+        if escalate:
+            return None, screening
+        
+        findings = prescreen["findings"] if prescreen["decision"] != "clear" else []
+        return {
+            "has_phi": len(findings) > 0,
+            "findings_count": len(findings),
+            "findings": findings,
+            "risk_level": self._calculate_risk_level(findings),
+            "screening": screening
+        }, screening
+    
+    def _record_screening(self, decision: str, escalated: bool, cache_hit: bool = False):
+        """Count one scan in the pre-screen metrics"""
+        with self._metrics_lock:
+            self.prescreen_metrics["scans"] += 1
+            if decision == "clear":
+                self.prescreen_metrics["local_clear"] += 1
+            elif decision == "positive":
+                self.prescreen_metrics["local_positive"] += 1
+            if escalated:
+                self.prescreen_metrics["escalations"] += 1
+            if cache_hit:
+                self.prescreen_metrics["cache_hits"] += 1
+    
+    def _record_cached_screening(self, cached: Dict[str, Any]):
+        """Count a scan answered from the cache; it made no Cloud DLP call, so it is no escalation"""
+        screening = cached.get("screening") or {}
+        self._record_screening(screening.get("local_decision"), False, cache_hit=True)
+    
+    def scan_texts_for_phi(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Scan many texts for PHI, in input order
+        
+        Each text goes through the cache and the local pre-screen as in
+        scan_text_for_phi; the texts that still need Cloud DLP are inspected
+        together as rows of one table item instead of one request each.
+        """
+        results = [None] * len(texts)
+        pending = OrderedDict()  # cache key -> (text, screening, indices)
+        
+        for index, text_content in enumerate(texts):
+            cache_key = self._cache_key("inspect", text_content)
+            if cache_key in pending:
+                self._record_screening(pending[cache_key][1]["local_decision"], False, cache_hit=True)
+                pending[cache_key][2].append(index)
+                continue
+            
+            cached = self.scan_cache.get(cache_key)
+            if cached is not None:
+                self._record_cached_screening(cached)
+                results[index] = self._restore_quotes(cached, text_content)
+                continue
+            
+            local_result, screening = self._local_screen(text_content)
+            if local_result is not None:
+                self.scan_cache.put(cache_key, self._strip_quotes(local_result))
+                results[index] = local_result
+                continue
+            pending[cache_key] = (text_content, screening, [index])
+        
+        if pending:
+            inspected = self._inspect_table_with_dlp([entry[0] for entry in pending.values()])
+            for (cache_key, (text_content, screening, indices)), result in zip(pending.items(), inspected):
+                result["screening"] = screening
+                stripped = self._strip_quotes(result)
+                self.scan_cache.put(cache_key, stripped)
+                for index in indices:
+                    results[index] = self._restore_quotes(stripped, text_content)
+        
+        return results
+    
+    @staticmethod
+    def _segments(text_content: str):
+        """(byte offset, segment) pairs covering a text, each within the DLP request size limit"""
+        data = text_content.encode('utf-8')
+        if len(data) <= DLP_MAX_REQUEST_BYTES:
+            return [(0, text_content)]
+        segments = []
+        start = 0
+        while True:
+            end = min(start + DLP_MAX_REQUEST_BYTES, len(data))
+            # Cut on a character boundary, never inside a UTF-8 sequence
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end -= 1
+            segments.append((start, data[start:end].decode('utf-8')))
+            if end == len(data):
+                return segments
+            start = end - DLP_SEGMENT_OVERLAP_BYTES
+            while data[start] & 0xC0 == 0x80:
+                start -= 1
+    
+    def _inspect_table_with_dlp(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        Inspect texts as rows of a one-column table, splitting at the DLP request size limit
+        
+        A text too large for one request is sent as overlapping segment rows;
+        their findings are shifted back to the text's byte offsets and merged.
+        """
+        
+        inspect_config = {
+            "info_types": [{"name": info_type} for info_type in self.healthcare_info_types],
+            "min_likelihood": dlp_v2.Likelihood.POSSIBLE,
+            "include_quote": True
+        }
+        
+        # (text index, byte offset, segment) per table row
+        rows = [
+            (index, offset, segment)
+            for index, text_content in enumerate(texts)
+            for offset, segment in self._segments(text_content)
+        ]
+        
+        # Group rows into requests below the 0.5 MB content limit
+        chunks = [[]]
+        chunk_bytes = 0
+        for row in rows:
+            size = len(row[2].encode('utf-8'))
+            if chunks[-1] and chunk_bytes + size > DLP_MAX_REQUEST_BYTES:
+                chunks.append([])
+                chunk_bytes = 0
+            chunks[-1].append(row)
+            chunk_bytes += size
+        
+        findings_by_row = [[] for _ in texts]
+        seen = [set() for _ in texts]  # findings reported twice by overlapping segments
+        try:
+            for chunk in chunks:
+                item = {
+                    "table": {
+                        "headers": [{"name": "content"}],
+                        "rows": [{"values": [{"string_value": segment}]} for _, _, segment in chunk]
+                    }
+                }
+                response = self.client.inspect_content(
+                    request={
+                        "parent": self.parent,
+                        "inspect_config": inspect_config,
+                        "item": item
+                    }
+                )
+                
+                for finding in response.result.findings:
+                    row_index = finding.location.content_locations[0].record_location.table_location.row_index
+                    index, offset, _ = chunk[row_index]
+                    start = offset + finding.location.byte_range.start
+                    end = offset + finding.location.byte_range.end
+                    if (finding.info_type.name, start, end) in seen[index]:
+                        continue
+                    seen[index].add((finding.info_type.name, start, end))
+                    findings_by_row[index].append({
+                        "info_type": finding.info_type.name,
+                        "likelihood": finding.likelihood.name,
+                        "quote": finding.quote,
+                        "location": {
+                            "byte_range": {
+                                "start": start,
+                                "end": end
+                            }
+                        }
+                    })
+        except Exception as e:
+            logging.error(f"Error scanning table for PHI: {e}")
+            raise
+        
+        return [
+            {
+                "has_phi": len(findings) > 0,
+                "findings_count": len(findings),
+                "findings": findings,
+                "risk_level": self._calculate_risk_level(findings)
+            }
+            for findings in findings_by_row
+        ]
+    
+    def _inspect_with_dlp(self, text_content: str) -> Dict[str, Any]:
+        """Scan text content for PHI with the Cloud DLP API"""
+        
+        if len(text_content.encode('utf-8')) > DLP_MAX_REQUEST_BYTES:
+            return self._inspect_table_with_dlp([text_content])[0]
+        
         # Configure inspection
         inspect_config = {
             "info_types": [{"name": info_type} for info_type in self.healthcare_info_types],
@@ -131,6 +594,19 @@ class DLPManager:
                             replacement_char: str = "*") -> Dict[str, Any]:
         """Redact sensitive data from text"""
         
+        # Cached redactions are stored as masked character spans, never as text
+        cache_key = self._cache_key("deidentify", text_content, replacement_char=replacement_char)
+        cached = self.scan_cache.get(cache_key)
+        if cached is not None:
+            redacted = list(text_content)
+            for start, end in cached["masked_spans"]:
+                redacted[start:end] = replacement_char * (end - start)
+            return {
+                "original_text": text_content,
+                "redacted_text": "".join(redacted),
+                "transformations_applied": cached["transformations_applied"]
+            }
+        
         # Configure deidentification
         deidentify_config = {
             "info_type_transformations": {
@@ -167,21 +643,45 @@ class DLPManager:
                 }
             )
             
-            return {
+            result = {
                 "original_text": text_content,
                 "redacted_text": response.item.value,
                 "transformations_applied": len(response.overview.transformation_summaries)
             }
             
+            # Character masking preserves length, so the redaction is fully described by its spans
+            if len(result["redacted_text"]) == len(text_content):
+                self.scan_cache.put(cache_key, {
+                    "masked_spans": self._diff_spans(text_content, result["redacted_text"]),
+                    "transformations_applied": result["transformations_applied"]
+                })
+            
+            return result
+            
         except Exception as e:
             logging.error(f"Error redacting sensitive data: {e}")
             raise
     
+    @staticmethod
+    def _diff_spans(original: str, redacted: str) -> List[List[int]]:
+        """Character spans where two equal-length strings differ"""
+        spans = []
+        start = None
+        for index, (a, b) in enumerate(zip(original, redacted)):
+            if a != b and start is None:
+                start = index
+            elif a == b and start is not None:
+                spans.append([start, index])
+                start = None
+        if start is not None:
+            spans.append([start, len(original)])
+        return spans
+    
     def scan_fhir_resource(self, fhir_resource: Dict[str, Any]) -> Dict[str, Any]:
         """Scan FHIR resource for sensitive data"""
         
-        # Convert FHIR resource to text for scanning
-        fhir_text = json.dumps(fhir_resource, indent=2)
+        # Convert FHIR resource to canonical text so re-serialized resources share a cache entry
+        fhir_text = json.dumps(fhir_resource, sort_keys=True, separators=(',', ':'))
         
         # Scan the JSON content
         scan_result = self.scan_text_for_phi(fhir_text)
@@ -203,6 +703,12 @@ class DLPManager:
     def create_data_classification(self, content: str) -> Dict[str, Any]:
         """Classify data sensitivity level"""
         
+        # The classification holds no PHI, so it is cached as-is
+        cache_key = self._cache_key("classify", content)
+        cached = self.scan_cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+        
         scan_result = self.scan_text_for_phi(content)
         
         # Determine classification based on findings
@@ -216,12 +722,14 @@ class DLPManager:
         else:
             classification = "PUBLIC"
         
-        return {
+        result = {
             "classification": classification,
             "confidence": self._calculate_confidence(scan_result),
             "handling_requirements": self._get_handling_requirements(classification),
             "retention_policy": self._get_retention_policy(classification)
         }
+        self.scan_cache.put(cache_key, result)
+        return dict(result)
     
     def _calculate_risk_level(self, findings: List[Dict]) -> str:
         """Calculate risk level based on findings"""
@@ -0,0 +1,113 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class FHIRResourceCache:
+    """Read-through cache of stored FHIR resources keyed by (resource_type, resource_id).
+
+    Resources written by FHIRConverter are immutable once stored (versionId "1"),
+    so entries never need invalidation. Entries are only added once BigQuery
+    has accepted the row (or on read), never for a write still in flight. The memory tier is an LRU bounded by
+    total bytes; the optional SQLite tier survives restarts and is shared by
+    every worker on the instance.
+    """
+
+    def __init__(self, max_memory_bytes: int = 64 * 1024 * 1024, disk_path: Optional[str] = None):
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()  # (resource_type, resource_id) -> (json bytes, etag)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.disk_path = disk_path
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS fhir_resources ("
+                "resource_type TEXT NOT NULL, resource_id TEXT NOT NULL, "
+                "body BLOB NOT NULL, etag TEXT NOT NULL, "
+                "PRIMARY KEY (resource_type, resource_id))"
+            )
+
+    @staticmethod
+    def make_etag(body: bytes) -> str:
+        """Strong (unquoted) ETag derived from the stored JSON bytes"""
+        return hashlib.sha256(body).hexdigest()[:32]
+
+    def get(self, resource_type: str, resource_id: str) -> Optional[Tuple[bytes, str]]:
+        """Return (json bytes, etag) for a cached resource, or None"""
+        key = (resource_type, resource_id)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT body, etag FROM fhir_resources WHERE resource_type = ? AND resource_id = ?",
+                    key
+                ).fetchone()
+                if row is not None:
+                    entry = (bytes(row[0]), row[1])
+                    self._remember(key, entry)
+                    self.stats["disk_hits"] += 1
+                    return entry
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, resource_type: str, resource_id: str, body: bytes) -> str:
+        """Cache the stored JSON bytes of a resource and return its ETag"""
+        key = (resource_type, resource_id)
+        etag = self.make_etag(body)
+        with self._lock:
+            self._remember(key, (body, etag))
+            if self._disk is not None:
+                try:
+                    self._disk.execute(
+                        "INSERT OR REPLACE INTO fhir_resources (resource_type, resource_id, body, etag) "
+                        "VALUES (?, ?, ?, ?)",
+                        (resource_type, resource_id, body, etag)
+                    )
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not write {resource_type}/{resource_id} to disk cache: {e}")
+        return etag
+
+    def evict(self, resource_type: str, resource_id: str):
+        """Drop a resource from both tiers"""
+        key = (resource_type, resource_id)
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[0])
+            if self._disk is not None:
+                try:
+                    self._disk.execute(
+                        "DELETE FROM fhir_resources WHERE resource_type = ? AND resource_id = ?", key
+                    )
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not evict {resource_type}/{resource_id} from disk cache: {e}")
+
+    def _remember(self, key: Tuple[str, str], entry: Tuple[bytes, str]):
+        """Insert into the memory tier and evict down to the byte budget; caller holds the lock"""
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous[0])
+        if len(entry[0]) > self.max_memory_bytes:
+            return
+        self._memory[key] = entry
+        self._memory_bytes += len(entry[0])
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted[0])
@@ -1,13 +1,18 @@
 import json
 import uuid
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from fhir_templates import AudioBundleTemplates, dumps_bundle
 
 class FHIRConverter:
     """Convert audio file metadata to FHIR Media resource format"""
     
-    def __init__(self):
+    def __init__(self, use_templates: bool = False):
         self.base_url = "https://data-api-887192895309.us-central1.run.app"
+        
+        # Precompiled-template fast path for audio bundles
+        self.use_templates = use_templates
+        self.templates = AudioBundleTemplates(self.base_url)
     
     def create_media_resource(
         self,
@@ -231,6 +236,126 @@ class FHIRConverter:
             
         return True
     
+    def validate_fhir_resources(self, resources: List[Dict[str, Any]]) -> List[Optional[str]]:
+        """
+        Validate many FHIR resources at once
+        
+        Returns:
+            One entry per resource: None when valid, otherwise the reason it was rejected
+        """
+        errors = []
+        for resource in resources:
+            if not isinstance(resource, dict):
+                errors.append("Entry has no resource")
+            elif self.validate_fhir_resource(resource):
+                errors.append(None)
+            else:
+                errors.append(
+                    f"Invalid {resource.get('resourceType', 'resource')}: requires resourceType "
+                    f"Media or DocumentReference, id and meta"
+                )
+        return errors
+    
+    def prepare_bundle_entries(self, bundle: Dict[str, Any]) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """
+        Turn the entries of a transaction or batch Bundle into storable resources
+        
+        POST entries get a server-assigned id, PUT entries keep the id from
+        request.url (create with a client id; stored resources are immutable,
+        so callers must refuse PUTs to ids that already exist), and every
+        resource gets versionId "1" meta. References to
+        another entry's urn:uuid fullUrl are rewritten to the assigned
+        "Type/id" so the stored resources link to each other.
+        
+        Returns:
+            One (resource, error) pair per entry, in Bundle order
+        """
+        now = datetime.now().isoformat() + "Z"
+        prepared = []
+        urn_map = {}
+        
+        for entry in bundle.get("entry") or []:
+            resource = entry.get("resource") if isinstance(entry, dict) else None
+            entry_request = (entry.get("request") or {}) if isinstance(entry, dict) else {}
+            method = (entry_request.get("method") or "POST").upper()
+            if method not in ("POST", "PUT"):
+                prepared.append((None, f"Unsupported request method: {method}"))
+                continue
+            if not isinstance(resource, dict):
+                prepared.append((None, "Entry has no resource"))
+                continue
+            
+            resource = dict(resource)
+            if method == "PUT":
+                # request.url is "Type/id"
+                url_parts = (entry_request.get("url") or "").split("/")
+                if len(url_parts) != 2 or url_parts[0] != resource.get("resourceType") or not url_parts[1]:
+                    prepared.append((None, "PUT entries require request.url of the form Type/id"))
+                    continue
+                resource["id"] = url_parts[1]
+            else:
+                resource["id"] = str(uuid.uuid4())
+            resource["meta"] = dict(resource.get("meta") or {}, versionId="1", lastUpdated=now)
+            
+            full_url = entry.get("fullUrl") or ""
+            if full_url.startswith("urn:uuid:"):
+                urn_map[full_url] = f"{resource.get('resourceType')}/{resource['id']}"
+            prepared.append((resource, None))
+        
+        if urn_map:
+            prepared = [
+                (self._rewrite_references(resource, urn_map) if resource else None, error)
+                for resource, error in prepared
+            ]
+        
+        resources = [resource for resource, error in prepared if resource is not None]
+        validation = iter(self.validate_fhir_resources(resources))
+        return [
+            (resource, next(validation)) if resource is not None else (None, error)
+            for resource, error in prepared
+        ]
+    
+    def _rewrite_references(self, value: Any, urn_map: Dict[str, str]) -> Any:
+        """Copy of value with {"reference": "urn:uuid:..."} pointing at the assigned ids"""
+        if isinstance(value, dict):
+            rewritten = {key: self._rewrite_references(item, urn_map) for key, item in value.items()}
+            reference = rewritten.get("reference")
+            if isinstance(reference, str) and reference in urn_map:
+                rewritten["reference"] = urn_map[reference]
+            return rewritten
+        if isinstance(value, list):
+            return [self._rewrite_references(item, urn_map) for item in value]
+        return value
+    
+    def extract_display_fields(self, fhir_resource: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Practitioner name and reason shown in the medical-records listing
+        
+        Only Bundle entries are considered; the last matching entry wins.
+        Mirrors MEDICAL_RECORD_DISPLAY_SQL in storage_handler.
+        
+        Returns:
+            (practitioner_name, reason), either of which may be None
+        """
+        practitioner_name = None
+        reason = None
+        for entry in fhir_resource.get("entry") or []:
+            resource = entry.get("resource") or {}
+            resource_type = resource.get("resourceType")
+            if resource_type == "Practitioner" and resource.get("name"):
+                name_parts = resource["name"][0]
+                full_name = f"{' '.join(name_parts.get('given', []))} {name_parts.get('family', '')}".strip()
+                if full_name:
+                    practitioner_name = full_name
+            elif resource_type == "DiagnosticReport":
+                code_text = (resource.get("code") or {}).get("text")
+                if code_text or resource.get("conclusion"):
+                    reason = code_text or resource["conclusion"]
+            elif resource_type == "Media" and resource.get("reasonCode"):
+                if resource["reasonCode"][0].get("text"):
+                    reason = resource["reasonCode"][0]["text"]
+        return practitioner_name, reason
+    
     def convert_audio_metadata_to_fhir(
         self,
         file_name: str,
@@ -249,6 +374,18 @@ class FHIRConverter:
             FHIR Bundle containing Media and DocumentReference resources
         """
         
+        if self.use_templates:
+            return self.templates.build(
+                file_name=file_name,
+                file_path=file_path,
+                file_size_bytes=file_size_bytes,
+                content_type=content_type,
+                patient_id=patient_id,
+                operator_name=operator_name,
+                duration_seconds=duration_seconds,
+                reason=reason
+            )[0]
+        
         # Create Media resource
         media_resource = self.create_media_resource(
             file_name=file_name,
@@ -289,4 +426,41 @@ class FHIRConverter:
             ]
         }
         
-        return bundle 
\ No newline at end of file
+        return bundle 
+    
+    def convert_audio_metadata_to_fhir_with_json(
+        self,
+        file_name: str,
+        file_path: str,
+        file_size_bytes: int,
+        content_type: str = "audio/mpeg",
+        patient_id: Optional[str] = None,
+        operator_name: Optional[str] = None,
+        duration_seconds: Optional[float] = None,
+        reason: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        Convert audio file metadata to a FHIR bundle plus the JSON of each resource
+        
+        Returns:
+            (bundle, json_by_id): the bundle, and the serialized bundle, Media and
+            DocumentReference keyed by resource id (identical to json.dumps output)
+        """
+        kwargs = dict(
+            file_name=file_name,
+            file_path=file_path,
+            file_size_bytes=file_size_bytes,
+            content_type=content_type,
+            patient_id=patient_id,
+            operator_name=operator_name,
+            duration_seconds=duration_seconds,
+            reason=reason
+        )
+        if self.use_templates:
+            return self.templates.build(**kwargs)
+        
+        # Serialize each resource once and splice the text into the Bundle
+        bundle = self.convert_audio_metadata_to_fhir(**kwargs)
+        json_by_id = {entry["resource"]["id"]: json.dumps(entry["resource"]) for entry in bundle["entry"]}
+        json_by_id[bundle["id"]] = dumps_bundle(bundle, json_by_id)
+        return bundle, json_by_id
@@ -0,0 +1,287 @@
+import json
+import uuid
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from typing import Any, Dict, List, Optional, Tuple
+
+# Placeholder values are strings of the form "\x00name\x00"; json.dumps escapes
+# them to "\u0000name\u0000", which cannot occur in any other serialized value
+_SENTINEL = "\x00"
+
+
+def _placeholder(name: str) -> str:
+    return f"{_SENTINEL}{name}{_SENTINEL}"
+
+
+def _encode(value: Any) -> str:
+    """Serialize one value exactly as json.dumps would"""
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+class JsonTemplate:
+    """A JSON document serialized once, with placeholder values spliced in per render.
+
+    The skeleton is any JSON-serializable structure whose variable values are
+    ``placeholder("name")`` strings. ``render`` produces the same text that
+    ``json.dumps`` gives for the filled-in structure. Values listed in ``raw``
+    are inserted as already-serialized JSON.
+    """
+
+    def __init__(self, skeleton: Any, raw: Tuple[str, ...] = ()):
+        text = json.dumps(skeleton)
+        self.fragments = []
+        self.names = []
+        self.raw = set(raw)
+        marker = json.dumps(_SENTINEL)[1:-1]  # "\u0000"
+        parts = text.split(f'"{marker}')
+        self.fragments.append(parts[0])
+        for part in parts[1:]:
+            name, rest = part.split(f'{marker}"', 1)
+            self.names.append(name)
+            self.fragments.append(rest)
+
+    def render(self, values: Dict[str, Any]) -> str:
+        out = [self.fragments[0]]
+        raw = self.raw
+        for name, fragment in zip(self.names, self.fragments[1:]):
+            value = values[name]
+            out.append(value if name in raw else _encode(value))
+            out.append(fragment)
+        return "".join(out)
+
+
+def _member_template(key: str, value: Any) -> JsonTemplate:
+    """Template for the text `, "key": value` appended inside an object"""
+    template = JsonTemplate({key: value})
+    template.fragments[0] = ", " + template.fragments[0][1:]
+    template.fragments[-1] = template.fragments[-1][:-1]
+    return template
+
+
+def _object_prefix(skeleton: Dict[str, Any]) -> JsonTemplate:
+    """Template for an object without its closing brace, so optional members can follow"""
+    template = JsonTemplate(skeleton)
+    template.fragments[-1] = template.fragments[-1][:-1]
+    return template
+
+
+class AudioBundleTemplates:
+    """Precompiled Media / DocumentReference / Bundle skeletons for FHIRConverter.
+
+    ``build`` returns the same resources as convert_audio_metadata_to_fhir
+    together with their JSON text, without re-creating the static parts of
+    the structure or serializing each resource afterwards. One timestamp is
+    used for the whole bundle. The static nested dicts (codings, profiles)
+    are shared between bundles and must be treated as read-only.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        p = _placeholder
+
+        self._media_meta_profile = ["http://hl7.org/fhir/StructureDefinition/Media"]
+        self._media_type = {
+            "coding": [{"system": "http://terminology.hl7.org/CodeSystem/media-type",
+                        "code": "audio", "display": "Audio"}]
+        }
+        self._media_modality = {
+            "coding": [{"system": "http://dicom.nema.org/resources/ontology/DCM",
+                        "code": "AU", "display": "Audio"}]
+        }
+        self._doc_meta_profile = ["http://hl7.org/fhir/StructureDefinition/DocumentReference"]
+        self._doc_type = {
+            "coding": [{"system": "http://loinc.org", "code": "18842-5", "display": "Discharge summary"}]
+        }
+        self._doc_format = {
+            "system": "http://ihe.net/fhir/ihe.formatcode.fhir/CodeSystem/formatcode",
+            "code": "urn:ihe:iti:xds:2017:mimeTypeSufficient",
+            "display": "mimeType Sufficient"
+        }
+
+        self._media = _object_prefix({
+            "resourceType": "Media",
+            "id": p("id"),
+            "meta": {"versionId": "1", "lastUpdated": p("now"), "profile": self._media_meta_profile},
+            "identifier": [{"use": "usual", "system": f"{base_url}/media-id", "value": p("file_name")}],
+            "status": "completed",
+            "type": self._media_type,
+            "modality": self._media_modality,
+            "createdDateTime": p("now"),
+            "issued": p("now"),
+            "content": {"contentType": p("content_type"), "size": p("size"),
+                        "url": p("file_path"), "title": p("file_name")}
+        })
+        self._media_duration = _member_template("duration", p("duration"))
+        self._subject = _member_template("subject", {"reference": p("subject"), "display": "Patient"})
+        self._media_operator = _member_template("operator", {"display": p("operator")})
+        self._media_device = _member_template("deviceName", p("device"))
+        self._media_reason = _member_template("reasonCode", [{"text": p("reason")}])
+
+        self._document = _object_prefix({
+            "resourceType": "DocumentReference",
+            "id": p("id"),
+            "meta": {"versionId": "1", "lastUpdated": p("now"), "profile": self._doc_meta_profile},
+            "identifier": [{"use": "usual", "system": f"{base_url}/document-id", "value": p("doc_value")}],
+            "status": "current",
+            "type": self._doc_type,
+            "category": [{"coding": [{
+                "system": "http://hl7.org/fhir/us/core/CodeSystem/us-core-documentreference-category",
+                "code": p("category_code"),
+                "display": "Audio Recording"
+            }]}],
+            "date": p("now"),
+            "content": [{
+                "attachment": {"contentType": p("content_type"), "url": p("file_path"),
+                               "size": p("size"), "title": p("file_name")},
+                "format": self._doc_format
+            }]
+        })
+
+        self._bundle = JsonTemplate({
+            "resourceType": "Bundle",
+            "id": p("id"),
+            "meta": {"lastUpdated": p("now")},
+            "type": "collection",
+            "entry": [
+                {"resource": p("media"), "fullUrl": p("media_url")},
+                {"resource": p("document"), "fullUrl": p("document_url")}
+            ]
+        }, raw=("media", "document"))
+
+    def build(
+        self,
+        file_name: str,
+        file_path: str,
+        file_size_bytes: int,
+        content_type: str = "audio/mpeg",
+        patient_id: Optional[str] = None,
+        operator_name: Optional[str] = None,
+        duration_seconds: Optional[float] = None,
+        reason: Optional[str] = None,
+        device_name: Optional[str] = "Mobile Audio Recorder",
+        category_code: str = "audio-recording"
+    ) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        Build an audio bundle and its serialized resources
+
+        Returns:
+            (bundle, json_by_id): the bundle dict, and the JSON text of the
+            bundle, Media and DocumentReference keyed by resource id
+        """
+        now = datetime.now().isoformat() + "Z"
+        media_id = str(uuid.uuid4())
+        document_id = str(uuid.uuid4())
+        bundle_id = str(uuid.uuid4())
+        subject = f"Patient/{patient_id}" if patient_id else None
+
+        values = {
+            "id": media_id, "now": now, "file_name": file_name, "file_path": file_path,
+            "content_type": content_type, "size": file_size_bytes, "duration": duration_seconds,
+            "subject": subject, "operator": operator_name, "device": device_name, "reason": reason,
+            "doc_value": f"doc-{file_name}", "category_code": category_code
+        }
+
+        # Media: dict and text built side by side, optional members in legacy order
+        media = {
+            "resourceType": "Media",
+            "id": media_id,
+            "meta": {"versionId": "1", "lastUpdated": now, "profile": self._media_meta_profile},
+            "identifier": [{"use": "usual", "system": f"{self.base_url}/media-id", "value": file_name}],
+            "status": "completed",
+            "type": self._media_type,
+            "modality": self._media_modality,
+            "createdDateTime": now,
+            "issued": now,
+            "content": {"contentType": content_type, "size": file_size_bytes,
+                        "url": file_path, "title": file_name}
+        }
+        media_parts: List[str] = [self._media.render(values)]
+        if duration_seconds:
+            media["duration"] = duration_seconds
+            media_parts.append(self._media_duration.render(values))
+        if subject:
+            media["subject"] = {"reference": subject, "display": "Patient"}
+            media_parts.append(self._subject.render(values))
+        if operator_name:
+            media["operator"] = {"display": operator_name}
+            media_parts.append(self._media_operator.render(values))
+        if device_name:
+            media["deviceName"] = device_name
+            media_parts.append(self._media_device.render(values))
+        if reason:
+            media["reasonCode"] = [{"text": reason}]
+            media_parts.append(self._media_reason.render(values))
+        media_parts.append("}")
+        media_json = "".join(media_parts)
+
+        # DocumentReference
+        values["id"] = document_id
+        document = {
+            "resourceType": "DocumentReference",
+            "id": document_id,
+            "meta": {"versionId": "1", "lastUpdated": now, "profile": self._doc_meta_profile},
+            "identifier": [{"use": "usual", "system": f"{self.base_url}/document-id",
+                            "value": values["doc_value"]}],
+            "status": "current",
+            "type": self._doc_type,
+            "category": [{"coding": [{
+                "system": "http://hl7.org/fhir/us/core/CodeSystem/us-core-documentreference-category",
+                "code": category_code,
+                "display": "Audio Recording"
+            }]}],
+            "date": now,
+            "content": [{
+                "attachment": {"contentType": content_type, "url": file_path,
+                               "size": file_size_bytes, "title": file_name},
+                "format": self._doc_format
+            }]
+        }
+        document_parts = [self._document.render(values)]
+        if subject:
+            document["subject"] = {"reference": subject, "display": "Patient"}
+            document_parts.append(self._subject.render(values))
+        document_parts.append("}")
+        document_json = "".join(document_parts)
+
+        # Bundle, with the resource text spliced in rather than re-serialized
+        media_url = f"{self.base_url}/Media/{media_id}"
+        document_url = f"{self.base_url}/DocumentReference/{document_id}"
+        bundle = {
+            "resourceType": "Bundle",
+            "id": bundle_id,
+            "meta": {"lastUpdated": now},
+            "type": "collection",
+            "entry": [
+                {"resource": media, "fullUrl": media_url},
+                {"resource": document, "fullUrl": document_url}
+            ]
+        }
+        bundle_json = self._bundle.render({
+            "id": bundle_id, "now": now, "media": media_json, "media_url": media_url,
+            "document": document_json, "document_url": document_url
+        })
+
+        return bundle, {bundle_id: bundle_json, media_id: media_json, document_id: document_json}
+
+
+def dumps_bundle(bundle: Dict[str, Any], json_by_id: Dict[str, str], references_only: bool = False) -> str:
+    """
+    Serialize a Bundle without serializing its entry resources again
+
+    Entry resources are spliced in from ``json_by_id`` (resource id -> JSON
+    text). With ``references_only`` the resources are left out entirely and
+    each entry keeps only its fullUrl and other metadata.
+    """
+    entries = []
+    values = {}
+    for index, entry in enumerate(bundle.get("entry") or []):
+        resource = entry.get("resource")
+        if references_only or resource is None:
+            entries.append({key: value for key, value in entry.items() if key != "resource"})
+            continue
+        name = f"resource{index}"
+        values[name] = json_by_id[resource["id"]]
+        entries.append(dict(entry, resource=_placeholder(name)))
+    return JsonTemplate(dict(bundle, entry=entries), raw=tuple(values)).render(values)
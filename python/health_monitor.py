@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from typing import Any, Callable, Dict, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor:
+    """Dependency checks run in the background, served to probes from a cache.
+
+    Each check should be a constant-cost call (a metadata get, a dry run, a
+    ``SELECT 1``), so probe cost does not grow with the data. A monitor thread
+    runs every check each ``interval`` seconds, in parallel, each bounded by
+    ``timeout``; a check still running from an earlier round is not started
+    again. ``snapshot`` only reads the cached results. The service is ready
+    when every critical check has passed within the last ``stale_after``
+    seconds. The monitor thread is (re)started on demand, so a forked worker
+    gets its own.
+    """
+
+    def __init__(self, interval: float = 15.0, timeout: float = 5.0, stale_after: Optional[float] = None):
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = stale_after if stale_after is not None else 3 * interval + timeout
+        self._checks = {}  # check name -> (func, critical)
+        self._results = {}  # check name -> latest result
+        self._running = {}  # check name -> future still in flight
+        self._lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def add_check(self, name: str, func: Callable[[], Any], critical: bool = True):
+        """Register a check; it passes unless it raises"""
+        self._checks[name] = (func, critical)
+
+    def start(self):
+        """Start the monitor thread in this process if it is not running"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            # Fresh executor and state after a fork: the parent's threads did not come along
+            self._pid = os.getpid()
+            self._running = {}
+            self._results = {}
+            self._executor = ThreadPoolExecutor(max_workers=max(len(self._checks), 1),
+                                                thread_name_prefix="health-check")
+            self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except RuntimeError:
+                # The pool refuses new work once the interpreter is shutting down
+                return
+            except Exception as e:
+                logger.error(f"Health check round failed: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def run_once(self):
+        """Run every check that is not still in flight and record the results"""
+        futures = {}
+        for name, (func, _) in self._checks.items():
+            previous = self._running.get(name)
+            if previous is not None and not previous.done():
+                continue
+            futures[name] = self._executor.submit(self._timed, func)
+        self._running.update(futures)
+
+        names = {future: name for name, future in futures.items()}
+        try:
+            for future in as_completed(names, timeout=self.timeout):
+                self._record(names.pop(future), *future.result())
+        except FutureTimeoutError:
+            for name in names.values():
+                self._record(name, False, round(self.timeout * 1000, 2), f"timed out after {self.timeout}s")
+
+    def _record(self, name: str, ok: bool, latency_ms: float, error: Optional[str]):
+        if not ok:
+            logger.warning(f"Health check {name} failed: {error}")
+        self._results[name] = {"ok": ok, "latency_ms": latency_ms, "checked_at": time.time(), "error": error}
+
+    @staticmethod
+    def _timed(func: Callable[[], Any]):
+        start = time.perf_counter()
+        try:
+            func()
+            return True, round((time.perf_counter() - start) * 1000, 2), None
+        except Exception as e:
+            return False, round((time.perf_counter() - start) * 1000, 2), str(e)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cached state of every check and the overall readiness; never calls a dependency"""
+        self.start()
+        now = time.time()
+        checks = {}
+        ready = True
+        for name, (_, critical) in self._checks.items():
+            result = self._results.get(name)
+            if result is None:
+                entry = {"status": "pending", "critical": critical}
+            else:
+                age = now - result["checked_at"]
+                status = "ok" if result["ok"] else "failing"
+                if status == "ok" and age > self.stale_after:
+                    status = "stale"
+                entry = {
+                    "status": status,
+                    "critical": critical,
+                    "latency_ms": result["latency_ms"],
+                    "age_seconds": round(age, 1)
+                }
+                if result["error"]:
+                    entry["error"] = result["error"]
+            if critical and entry["status"] != "ok":
+                ready = False
+            checks[name] = entry
+        return {"ready": ready, "checks": checks}
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def stop(self):
+        self._stop.set()
@@ -1,22 +1,57 @@
 from google.cloud import kms
 from google.cloud import storage
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 import base64
 import logging
+import os
+import struct
+import threading
+import time
+
+# Envelope ciphertext layout (after the text prefix, base64 encoded):
+#   version (1 byte) | wrapped key length (2 bytes, big endian) | wrapped key | nonce (12 bytes) | AES-GCM ciphertext+tag
+ENVELOPE_PREFIX = "env:"
+ENVELOPE_VERSION = 1
+NONCE_SIZE = 12
 
 class KMSManager:
     """Cloud KMS manager for encrypting sensitive healthcare data"""
     
-    def __init__(self, project_id: str, location: str = "us-central1"):
+    def __init__(self, project_id: str, location: str = "us-central1",
+                 envelope_encryption: bool = True,
+                 data_key_ttl: float = 3600,
+                 data_key_max_uses: int = 100000,
+                 unwrapped_key_cache_size: int = 256,
+                 max_decrypt_workers: int = 16,
+                 provision_keys: bool = False):
         self.project_id = project_id
         self.location = location
         self.client = kms.KeyManagementServiceClient()
         self.key_ring_id = "healthcare-audio-keyring"
         self.crypto_key_id = "patient-data-key"
         
-        # Create key ring and key if they don't exist
-        self._ensure_key_setup()
+        # Envelope encryption: a local AES-GCM data key wrapped by the KMS key
+        self.envelope_encryption = envelope_encryption
+        self.data_key_ttl = data_key_ttl
+        self.data_key_max_uses = data_key_max_uses
+        self.unwrapped_key_cache_size = unwrapped_key_cache_size
+        self._data_key = None  # dict with plaintext key, wrapped key, created_at, uses
+        self._unwrapped_keys = OrderedDict()  # wrapped key bytes -> (AESGCM, unwrapped_at)
+        self._key_lock = threading.Lock()
+        self._rotate_lock = threading.Lock()
+        
+        # Bounded pool shared by batch decryption calls
+        self._decrypt_pool = ThreadPoolExecutor(max_workers=max_decrypt_workers,
+                                                thread_name_prefix="kms-decrypt")
+        
+        # Key ring and key are normally provisioned once by `python provision.py kms`
+        if provision_keys:
+            self.ensure_key_setup()
     
-    def _ensure_key_setup(self):
+    def ensure_key_setup(self):
         """Ensure KMS key ring and crypto key exist"""
         try:
             # Create key ring path
@@ -58,14 +93,115 @@ class KMSManager:
             logging.error(f"Error setting up KMS keys: {e}")
             raise
     
+    @property
+    def key_name(self) -> str:
+        """Full resource name of the KMS crypto key"""
+        return f"projects/{self.project_id}/locations/{self.location}/keyRings/{self.key_ring_id}/cryptoKeys/{self.crypto_key_id}"
+    
+    def _current_data_key(self) -> dict:
+        """Return the active data key, generating and wrapping a new one when expired or used up"""
+        data_key = self._take_data_key()
+        if data_key is not None:
+            return data_key
+        
+        # One thread rotates; the KMS wrap runs outside _key_lock so unwraps are not held up
+        with self._rotate_lock:
+            data_key = self._take_data_key()
+            if data_key is not None:
+                return data_key
+            
+            plaintext_key = AESGCM.generate_key(bit_length=256)
+            wrap_response = self.client.encrypt(
+                request={"name": self.key_name, "plaintext": plaintext_key}
+            )
+            data_key = {
+                "aead": AESGCM(plaintext_key),
+                "wrapped": wrap_response.ciphertext,
+                "created_at": time.monotonic(),
+                "uses": 1
+            }
+            with self._key_lock:
+                self._data_key = data_key
+                self._remember_unwrapped_key(data_key["wrapped"], data_key["aead"])
+            logging.info("Generated new envelope data key")
+            return data_key
+    
+    def _take_data_key(self) -> Optional[dict]:
+        """Count one use of the active data key, or return None if it must be rotated"""
+        with self._key_lock:
+            data_key = self._data_key
+            if (data_key is None
+                    or time.monotonic() - data_key["created_at"] >= self.data_key_ttl
+                    or data_key["uses"] >= self.data_key_max_uses):
+                return None
+            data_key["uses"] += 1
+            return data_key
+    
+    def _remember_unwrapped_key(self, wrapped_key: bytes, aead: AESGCM):
+        """Cache an unwrapped data key; caller must hold the key lock"""
+        self._unwrapped_keys[wrapped_key] = (aead, time.monotonic())
+        self._unwrapped_keys.move_to_end(wrapped_key)
+        while len(self._unwrapped_keys) > self.unwrapped_key_cache_size:
+            self._unwrapped_keys.popitem(last=False)
+    
+    def _unwrap_data_key(self, wrapped_key: bytes) -> AESGCM:
+        """Unwrap a data key through KMS, once per distinct wrapped key within the TTL"""
+        with self._key_lock:
+            cached = self._unwrapped_keys.get(wrapped_key)
+            if cached and time.monotonic() - cached[1] < self.data_key_ttl:
+                self._unwrapped_keys.move_to_end(wrapped_key)
+                return cached[0]
+        
+        # Call KMS outside the lock so unwraps of different keys can overlap
+        unwrap_response = self.client.decrypt(
+            request={"name": self.key_name, "ciphertext": wrapped_key}
+        )
+        aead = AESGCM(unwrap_response.plaintext)
+        with self._key_lock:
+            self._remember_unwrapped_key(wrapped_key, aead)
+        return aead
+    
+    def _parse_envelope(self, envelope_b64: str) -> tuple:
+        """Split an envelope ciphertext into (header, wrapped key, nonce, ciphertext)"""
+        payload = base64.b64decode(envelope_b64[len(ENVELOPE_PREFIX):].encode('utf-8'))
+        version, wrapped_len = struct.unpack_from(">BH", payload)
+        if version != ENVELOPE_VERSION:
+            raise ValueError(f"Unsupported envelope version: {version}")
+        
+        header_len = 3 + wrapped_len
+        return (
+            payload[:header_len],
+            payload[3:header_len],
+            payload[header_len:header_len + NONCE_SIZE],
+            payload[header_len + NONCE_SIZE:]
+        )
+    
+    def _envelope_encrypt(self, plaintext_bytes: bytes) -> str:
+        """Encrypt locally with the cached data key and prepend the versioned header"""
+        data_key = self._current_data_key()
+        wrapped = data_key["wrapped"]
+        header = struct.pack(">BH", ENVELOPE_VERSION, len(wrapped)) + wrapped
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = data_key["aead"].encrypt(nonce, plaintext_bytes, header)
+        return ENVELOPE_PREFIX + base64.b64encode(header + nonce + ciphertext).decode('utf-8')
+    
+    def _envelope_decrypt(self, envelope_b64: str) -> str:
+        """Parse the versioned header, unwrap the data key and decrypt locally"""
+        header, wrapped, nonce, ciphertext = self._parse_envelope(envelope_b64)
+        aead = self._unwrap_data_key(wrapped)
+        return aead.decrypt(nonce, ciphertext, header).decode('utf-8')
+    
     def encrypt_sensitive_data(self, plaintext: str) -> str:
         """Encrypt sensitive data like patient IDs, operator names"""
         try:
-            key_name = f"projects/{self.project_id}/locations/{self.location}/keyRings/{self.key_ring_id}/cryptoKeys/{self.crypto_key_id}"
-            
             # Convert string to bytes
             plaintext_bytes = plaintext.encode('utf-8')
             
+            if self.envelope_encryption:
+                return self._envelope_encrypt(plaintext_bytes)
+            
+            key_name = self.key_name
+            
             # Encrypt
             encrypt_response = self.client.encrypt(
                 request={"name": key_name, "plaintext": plaintext_bytes}
@@ -79,9 +215,12 @@ class KMSManager:
             raise
     
     def decrypt_sensitive_data(self, ciphertext_b64: str) -> str:
-        """Decrypt sensitive data"""
+        """Decrypt sensitive data (envelope or direct KMS ciphertext)"""
         try:
-            key_name = f"projects/{self.project_id}/locations/{self.location}/keyRings/{self.key_ring_id}/cryptoKeys/{self.crypto_key_id}"
+            if ciphertext_b64.startswith(ENVELOPE_PREFIX):
+                return self._envelope_decrypt(ciphertext_b64)
+            
+            key_name = self.key_name
             
             # Decode base64 ciphertext
             ciphertext = base64.b64decode(ciphertext_b64.encode('utf-8'))
@@ -97,13 +236,90 @@ class KMSManager:
             logging.error(f"Error decrypting data: {e}")
             raise
     
-    def setup_storage_encryption(self, bucket_name: str):
+    def encrypt_many(self, plaintexts: List[str]) -> List[Dict[str, Optional[str]]]:
+        """
+        Encrypt a batch of values
+        
+        With envelope encryption every value is sealed locally under the
+        current data key (at most one KMS call for the whole batch); direct
+        KMS encryption fans out across the same thread pool as decrypt_many.
+        
+        Returns:
+            One {"ciphertext": ..., "error": ...} dict per input, in input order
+        """
+        if self.envelope_encryption:
+            results = []
+            for plaintext in plaintexts:
+                try:
+                    results.append({"ciphertext": self._envelope_encrypt(plaintext.encode('utf-8')), "error": None})
+                except Exception as e:
+                    logging.error(f"Error encrypting data: {e}")
+                    results.append({"ciphertext": None, "error": str(e) or type(e).__name__})
+            return results
+        
+        futures = [self._decrypt_pool.submit(self.encrypt_sensitive_data, plaintext) for plaintext in plaintexts]
+        results = []
+        for future in futures:
+            try:
+                results.append({"ciphertext": future.result(), "error": None})
+            except Exception as e:
+                results.append({"ciphertext": None, "error": str(e) or type(e).__name__})
+        return results
+    
+    def decrypt_many(self, ciphertexts: List[str]) -> List[Dict[str, Optional[str]]]:
+        """
+        Decrypt a batch of ciphertexts concurrently
+        
+        Identical ciphertexts are decrypted once, distinct envelope data keys are
+        unwrapped once, and remote KMS calls fan out across a bounded thread pool.
+        
+        Returns:
+            One {"plaintext": ..., "error": ...} dict per input, in input order
+        """
+        unique = list(dict.fromkeys(ciphertexts))
+        outcomes = {}
+        
+        # Unwrap every distinct envelope data key in parallel
+        envelopes = {}
+        for ciphertext in unique:
+            if ciphertext.startswith(ENVELOPE_PREFIX):
+                try:
+                    envelopes[ciphertext] = self._parse_envelope(ciphertext)
+                except Exception as e:
+                    outcomes[ciphertext] = {"plaintext": None, "error": str(e)}
+        
+        wrapped_keys = list(dict.fromkeys(parts[1] for parts in envelopes.values()))
+        key_futures = {wrapped: self._decrypt_pool.submit(self._unwrap_data_key, wrapped)
+                       for wrapped in wrapped_keys}
+        
+        # Legacy direct-KMS ciphertexts each need their own remote decrypt
+        legacy_futures = {ciphertext: self._decrypt_pool.submit(self.decrypt_sensitive_data, ciphertext)
+                          for ciphertext in unique
+                          if ciphertext not in envelopes and ciphertext not in outcomes}
+        
+        for ciphertext, (header, wrapped, nonce, body) in envelopes.items():
+            try:
+                aead = key_futures[wrapped].result()
+                plaintext = aead.decrypt(nonce, body, header).decode('utf-8')
+                outcomes[ciphertext] = {"plaintext": plaintext, "error": None}
+            except Exception as e:
+                outcomes[ciphertext] = {"plaintext": None, "error": str(e) or type(e).__name__}
+        
+        for ciphertext, future in legacy_futures.items():
+            try:
+                outcomes[ciphertext] = {"plaintext": future.result(), "error": None}
+            except Exception as e:
+                outcomes[ciphertext] = {"plaintext": None, "error": str(e) or type(e).__name__}
+        
+        return [dict(outcomes[ciphertext]) for ciphertext in ciphertexts]
+    
+    def setup_storage_encryption(self, bucket_name: str, storage_client=None):
         """Configure Cloud Storage bucket to use KMS encryption"""
         try:
-            storage_client = storage.Client()
+            storage_client = storage_client or storage.Client()
             bucket = storage_client.bucket(bucket_name)
             
-            kms_key_name = f"projects/{self.project_id}/locations/{self.location}/keyRings/{self.key_ring_id}/cryptoKeys/{self.crypto_key_id}"
+            kms_key_name = self.key_name
             
             bucket.default_kms_key_name = kms_key_name
             bucket.patch()
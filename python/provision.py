@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+One-time provisioning for the healthcare audio deployment
+
+Creates the Cloud KMS key ring and crypto key, points the audio bucket's
+default encryption at that key, and creates the BigQuery tables. The app no
+longer does any of this at startup; run it once per project (it is safe to
+re-run) before deploying.
+
+Usage:
+    python provision.py all
+    python provision.py kms
+    python provision.py bucket-encryption [--bucket NAME]
+    python provision.py bigquery
+"""
+import argparse
+import logging
+from google.cloud import bigquery, storage
+from generate_token import generate_token
+from kms_manager import KMSManager
+import bigquery_schema
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKET = "healthcare_audio_analyzer_fhir"
+
+def provision_kms(kms_manager: KMSManager):
+    """Create the key ring and crypto key if they do not exist"""
+    kms_manager.ensure_key_setup()
+    print(f"✅ KMS key ready: {kms_manager.key_name}")
+
+def provision_bucket_encryption(kms_manager: KMSManager, storage_client: storage.Client, bucket_name: str):
+    """Set the bucket's default KMS key"""
+    kms_manager.setup_storage_encryption(bucket_name, storage_client=storage_client)
+    print(f"✅ Bucket {bucket_name} encrypts new objects with {kms_manager.key_name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision KMS keys, bucket encryption and BigQuery tables")
+    parser.add_argument("command", choices=["all", "kms", "bucket-encryption", "bigquery"])
+    parser.add_argument("--bucket", default=DEFAULT_BUCKET, help="Audio bucket to configure")
+    args = parser.parse_args()
+
+    credentials, project_id = generate_token()
+    if not credentials or not project_id:
+        raise SystemExit("Failed to initialize Google Cloud credentials")
+
+    try:
+        if args.command in ("all", "kms", "bucket-encryption"):
+            kms_manager = KMSManager(project_id)
+            if args.command in ("all", "kms"):
+                provision_kms(kms_manager)
+            if args.command in ("all", "bucket-encryption"):
+                storage_client = storage.Client(credentials=credentials, project=project_id)
+                provision_bucket_encryption(kms_manager, storage_client, args.bucket)
+
+        if args.command in ("all", "bigquery"):
+            bigquery_schema.ensure_tables(bigquery.Client(credentials=credentials, project=project_id))
+    except Exception as e:
+        logger.error(f"Provisioning failed: {str(e)}")
+        raise
+
+if __name__ == "__main__":
+    main()
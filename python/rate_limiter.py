@@ -0,0 +1,118 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class RateLimiterBackend:
+    """Interface for rate limiter backends.
+
+    Limits use GCRA (generic cell rate algorithm): each key stores a single
+    "theoretical arrival time", so memory per client is constant no matter
+    how many requests it sends.
+    """
+
+    def allow(self, key: str, limit: int, window_seconds: float) -> Tuple[bool, float]:
+        """Record a request for ``key`` and return (allowed, retry_after_seconds)"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _gcra(stored_tat: float, now: float, limit: int, window_seconds: float) -> Tuple[bool, float, float]:
+        """One GCRA step: return (allowed, retry_after, new_tat)"""
+        emission_interval = window_seconds / limit
+        burst_tolerance = window_seconds - emission_interval
+        tat = max(stored_tat, now)
+        if tat - now > burst_tolerance:
+            return False, tat - now - burst_tolerance, stored_tat
+        return True, 0.0, tat + emission_interval
+
+
+class MemoryRateLimiter(RateLimiterBackend):
+    """Per-process GCRA limiter with a bounded, periodically swept key table"""
+
+    def __init__(self, max_keys: int = 100000, sweep_interval: float = 60.0):
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self._tats = OrderedDict()  # key -> theoretical arrival time (monotonic seconds)
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def allow(self, key: str, limit: int, window_seconds: float) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+
+            allowed, retry_after, tat = self._gcra(self._tats.get(key, now), now, limit, window_seconds)
+            if allowed:
+                self._tats[key] = tat
+                self._tats.move_to_end(key)
+                # Bound the table by dropping the least recently seen clients
+                while len(self._tats) > self.max_keys:
+                    self._tats.popitem(last=False)
+            return allowed, retry_after
+
+    def _sweep(self, now: float):
+        """Drop idle keys whose allowance has fully refilled; caller holds the lock"""
+        idle = [key for key, tat in self._tats.items() if tat <= now]
+        for key in idle:
+            del self._tats[key]
+        self._next_sweep = now + self.sweep_interval
+        if idle:
+            logger.debug(f"Rate limiter evicted {len(idle)} idle keys")
+
+
+class SQLiteRateLimiter(RateLimiterBackend):
+    """GCRA limiter whose state lives in a SQLite file.
+
+    Every gunicorn worker on the instance opens the same file, so they enforce
+    one shared limit. This is the local stand-in for a networked shared store.
+    The file outlives reboots, so TATs are wall-clock times: a monotonic clock
+    restarts near zero on boot and would leave stored keys blocked for hours.
+    """
+
+    def __init__(self, path: str = "/tmp/rate-limits.db", sweep_interval: float = 60.0):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tat REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread (and per process, since threads do not survive fork)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def allow(self, key: str, limit: int, window_seconds: float) -> Tuple[bool, float]:
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if time.monotonic() >= self._next_sweep:
+                connection.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,))
+                self._next_sweep = time.monotonic() + self.sweep_interval
+
+            row = connection.execute("SELECT tat FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            # A TAT never legitimately exceeds now + window; clamp ones left by a clock step back
+            stored_tat = min(row[0], now + window_seconds) if row else now
+            allowed, retry_after, tat = self._gcra(stored_tat, now, limit, window_seconds)
+            if allowed:
+                connection.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, tat) VALUES (?, ?)", (key, tat)
+                )
+            connection.execute("COMMIT")
+            return allowed, retry_after
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
@@ -0,0 +1,101 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class StagePipeline:
+    """Run the stages of one request as a dependency graph on a shared thread pool.
+
+    A stage starts as soon as every stage it depends on has finished, and is
+    called with their results as keyword arguments (so stage names must be
+    valid identifiers). Stages run with a copy of the caller's context
+    variables, which carries Flask's request context into the pool threads.
+    The first failure cancels every stage that has not started yet and is
+    re-raised; per-stage timings are kept in ``timings`` either way.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, name: str = "pipeline"):
+        self.executor = executor
+        self.name = name
+        self._stages = {}  # stage name -> (func, dependencies), in insertion order
+        self.timings = {}  # stage name -> {"start_ms", "duration_ms"}
+        self.failed_stage = None
+        self._started = None
+
+    def add(self, name: str, func: Callable[..., Any], depends_on: Iterable[str] = ()) -> str:
+        """Register a stage; dependencies must already be registered, so the graph is acyclic"""
+        depends_on = tuple(depends_on)
+        if name in self._stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        unknown = [dependency for dependency in depends_on if dependency not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages: {', '.join(unknown)}")
+        self._stages[name] = (func, depends_on)
+        return name
+
+    def run(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Run every stage and return {stage name: result}"""
+        self._started = time.perf_counter()
+        deadline = None if timeout is None else self._started + timeout
+        pending = dict(self._stages)
+        running = {}  # future -> stage name
+        results = {}
+
+        def submit_ready():
+            for name, (func, depends_on) in list(pending.items()):
+                if all(dependency in results for dependency in depends_on):
+                    del pending[name]
+                    kwargs = {dependency: results[dependency] for dependency in depends_on}
+                    context = contextvars.copy_context()
+                    running[self.executor.submit(context.run, self._timed, name, func, kwargs)] = name
+
+        submit_ready()
+        while running:
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            done, _ = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                self._cancel(running)
+                self.failed_stage = ", ".join(sorted(running.values()))
+                raise TimeoutError(f"{self.name} timed out waiting for: {self.failed_stage}")
+
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    self.failed_stage = name
+                    self._cancel(running)
+                    logger.error(f"{self.name} stage {name} failed: {str(e)}")
+                    raise
+            submit_ready()
+
+        logger.info(f"{self.name} finished in {self.elapsed_ms():.1f} ms: {self.timings}")
+        return results
+
+    def _timed(self, name: str, func: Callable[..., Any], kwargs: Dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        try:
+            return func(**kwargs)
+        finally:
+            self.timings[name] = {
+                "start_ms": round((start - self._started) * 1000, 2),
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2)
+            }
+
+    @staticmethod
+    def _cancel(running: Dict[Any, str]):
+        """Cancel stages that have not started; running ones finish in the background"""
+        for future in running:
+            future.cancel()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000 if self._started else 0.0
+
+    def server_timing(self) -> str:
+        """Per-stage durations formatted for the Server-Timing response header"""
+        return ", ".join(f"{name};dur={timing['duration_ms']}" for name, timing in self.timings.items())
@@ -1,6 +1,17 @@
 -- Create the data_records table if it doesn't exist
+-- (existing JSON tables are converted by `python data_records_schema.py migrate`)
 CREATE TABLE IF NOT EXISTS data_records (
     id SERIAL PRIMARY KEY,
-    data JSON NOT NULL,
+    data JSONB NOT NULL,
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-); 
\ No newline at end of file
+);
+
+-- Containment filters (data @> '{...}'); jsonb_path_ops only supports @>, and is smaller and faster for it
+CREATE INDEX IF NOT EXISTS data_records_data_path_idx ON data_records USING GIN (data jsonb_path_ops);
+
+-- created_at ranges; rows arrive in created_at order, so a BRIN index stays a few pages in size
+CREATE INDEX IF NOT EXISTS data_records_created_at_brin ON data_records USING BRIN (created_at);
+
+-- Equality filters on frequently queried top-level keys, one expression index per key, e.g.
+--   CREATE INDEX IF NOT EXISTS data_records_data_status_idx ON data_records ((data ->> 'status'));
+-- (`python data_records_schema.py migrate --index-key status` creates these without blocking writes)
@@ -4,24 +4,52 @@ import logging
 import time
 from typing import Dict, List, Optional
 import re
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
+from datetime import datetime
+from rate_limiter import MemoryRateLimiter
 
 class SecurityMiddleware:
     """Security middleware for API protection and Cloud Armor integration"""
     
-    def __init__(self, app=None):
+    def __init__(self, app=None, rate_limiter=None, route_limits=None,
+                 default_limit: int = 100, default_window_minutes: int = 15,
+                 max_scan_chars: int = 2 * 1024 * 1024, route_scan_limits=None, exempt_paths=None):
         self.app = app
-        self.rate_limit_storage = defaultdict(deque)
+        # Paths that skip rate limiting and content checks (health probes)
+        self.exempt_paths = set(exempt_paths or ())
+        # Fixed-memory limiter backend (MemoryRateLimiter per process, SQLiteRateLimiter per host)
+        self.rate_limiter = rate_limiter or MemoryRateLimiter()
+        # Per-route limits: path prefix -> (limit, window_minutes); longest prefix wins
+        self.route_limits = route_limits or {}
+        self.default_limit = default_limit
+        self.default_window_minutes = default_window_minutes
         self.blocked_ips = set()
-        self.suspicious_patterns = [
-            r'<script.*?>',  # XSS attempts
-            r'union.*select',  # SQL injection
-            r'\.\./',  # Path traversal
-            r'<.*?>',  # HTML tags
-            r'javascript:',  # JavaScript protocol
-            r'vbscript:',  # VBScript protocol
-        ]
+        # Rule name -> pattern; specific rules come before the generic HTML tag rule
+        # so the reported rule is the most specific one at a given position
+        self.suspicious_rules = {
+            'xss_script_tag': r'<script.*?>',  # XSS attempts
+            'sql_union_select': r'union.*select',  # SQL injection
+            'path_traversal': r'\.\./',  # Path traversal
+            'html_tag': r'<.*?>',  # HTML tags
+            'javascript_protocol': r'javascript:',  # JavaScript protocol
+            'vbscript_protocol': r'vbscript:',  # VBScript protocol
+        }
+        self.suspicious_patterns = list(self.suspicious_rules.values())
+        # Lowercase literal every match of a rule must contain, used as a cheap prefilter;
+        # a rule without an entry here disables the prefilter
+        self.rule_literals = {
+            'xss_script_tag': '<',
+            'sql_union_select': 'union',
+            'path_traversal': '../',
+            'html_tag': '<',
+            'javascript_protocol': 'javascript:',
+            'vbscript_protocol': 'vbscript:',
+        }
+        self.compile_patterns()
+        
+        # Upper bound on the characters of JSON string content scanned per request
+        self.max_scan_chars = max_scan_chars
+        # Per-route scan caps for bulk endpoints: path prefix -> max chars; longest prefix wins
+        self.route_scan_limits = route_scan_limits or {}
         
         if app:
             self.init_app(app)
@@ -41,15 +69,20 @@ class SecurityMiddleware:
         g.client_ip = self.get_client_ip()
         g.user_agent = request.headers.get('User-Agent', '')
         
+        if request.path in self.exempt_paths:
+            return
+        
         # Check IP blacklist
         if self.is_ip_blocked(g.client_ip):
             logging.warning(f"Blocked request from blacklisted IP: {g.client_ip}")
             return jsonify({'error': 'Access denied'}), 403
         
         # Rate limiting
-        if not self.check_rate_limit(g.client_ip):
+        if not self.check_rate_limit(g.client_ip, route=request.path):
             logging.warning(f"Rate limit exceeded for IP: {g.client_ip}")
-            return jsonify({'error': 'Rate limit exceeded'}), 429
+            response = jsonify({'error': 'Rate limit exceeded'})
+            response.headers['Retry-After'] = str(max(1, int(g.get('rate_limit_retry_after', 1))))
+            return response, 429
         
         # Content validation
         if not self.validate_request_content():
@@ -97,44 +130,71 @@ class SecurityMiddleware:
         # Fallback to remote address
         return request.environ.get('REMOTE_ADDR', '0.0.0.0')
     
+    def resolve_route_limit(self, route: Optional[str]) -> tuple:
+        """Return (route key, limit, window_minutes) for a request path"""
+        if route:
+            matches = [prefix for prefix in self.route_limits if route.startswith(prefix)]
+            if matches:
+                prefix = max(matches, key=len)
+                limit, window_minutes = self.route_limits[prefix]
+                return prefix, limit, window_minutes
+        return "*", self.default_limit, self.default_window_minutes
+    
+    def resolve_scan_limit(self, route: Optional[str]) -> int:
+        """Return the JSON scan cap in characters for a request path"""
+        if route:
+            matches = [prefix for prefix in self.route_scan_limits if route.startswith(prefix)]
+            if matches:
+                return self.route_scan_limits[max(matches, key=len)]
+        return self.max_scan_chars
+    
     def check_rate_limit(self, ip_address: str, 
-                        limit: int = 100, 
-                        window_minutes: int = 15) -> bool:
-        """Implement rate limiting per IP"""
-        
-        now = datetime.now()
-        window_start = now - timedelta(minutes=window_minutes)
+                        limit: Optional[int] = None, 
+                        window_minutes: Optional[int] = None,
+                        route: Optional[str] = None) -> bool:
+        """Implement rate limiting per IP (and per route when route limits are configured)"""
         
-        # Clean old entries
-        while (self.rate_limit_storage[ip_address] and 
-               self.rate_limit_storage[ip_address][0] < window_start):
-            self.rate_limit_storage[ip_address].popleft()
+        route_key, route_limit, route_window = self.resolve_route_limit(route)
+        limit = limit or route_limit
+        window_minutes = window_minutes or route_window
         
-        # Check current count
-        current_requests = len(self.rate_limit_storage[ip_address])
+        allowed, retry_after = self.rate_limiter.allow(
+            f"{ip_address}|{route_key}", limit, window_minutes * 60
+        )
         
-        if current_requests >= limit:
-            # Add to blocked IPs if severely exceeding limits
-            if current_requests > limit * 2:
-                self.blocked_ips.add(ip_address)
-                logging.error(f"IP {ip_address} added to blocklist for excessive requests")
-            return False
+        if not allowed:
+            try:
+                g.rate_limit_retry_after = retry_after
+            except RuntimeError:
+                pass  # Called outside a request context
         
-        # Add current request
-        self.rate_limit_storage[ip_address].append(now)
-        return True
+        return allowed
     
     def is_ip_blocked(self, ip_address: str) -> bool:
         """Check if IP is in blocklist"""
         return ip_address in self.blocked_ips
     
+    def compile_patterns(self):
+        """Compile every suspicious rule into one case-insensitive alternation"""
+        self._rule_names = list(self.suspicious_rules)
+        if all(name in self.rule_literals for name in self._rule_names):
+            self._prefilter = sorted({self.rule_literals[name] for name in self._rule_names})
+        else:
+            self._prefilter = None
+        self._scanner = re.compile(
+            '|'.join(f'(?P<rule{index}>{pattern})'
+                     for index, pattern in enumerate(self.suspicious_rules.values())),
+            re.IGNORECASE
+        )
+    
     def validate_request_content(self) -> bool:
         """Validate request content for malicious patterns"""
         
         # Check URL parameters
         for key, value in request.args.items():
-            if self.contains_malicious_pattern(value):
-                logging.warning(f"Malicious pattern in URL param {key}: {value}")
+            rule = self.match_malicious_pattern(value)
+            if rule:
+                logging.warning(f"Malicious pattern ({rule}) in URL param {key}: {value}")
                 return False
         
         # Check JSON body if present
@@ -142,9 +202,9 @@ class SecurityMiddleware:
             try:
                 json_data = request.get_json()
                 if json_data:
-                    json_str = str(json_data)
-                    if self.contains_malicious_pattern(json_str):
-                        logging.warning(f"Malicious pattern in JSON body")
+                    rule = self.scan_json(json_data, max_chars=self.resolve_scan_limit(request.path))
+                    if rule:
+                        logging.warning(f"Malicious pattern ({rule}) in JSON body")
                         return False
             except Exception:
                 # Invalid JSON
@@ -153,31 +213,72 @@ class SecurityMiddleware:
         # Check form data
         if request.form:
             for key, value in request.form.items():
-                if self.contains_malicious_pattern(value):
-                    logging.warning(f"Malicious pattern in form field {key}: {value}")
+                rule = self.match_malicious_pattern(value)
+                if rule:
+                    logging.warning(f"Malicious pattern ({rule}) in form field {key}: {value}")
                     return False
         
         return True
     
-    def contains_malicious_pattern(self, content: str) -> bool:
-        """Check if content contains malicious patterns"""
-        content_lower = content.lower()
+    def scan_json(self, json_data, max_chars: Optional[int] = None) -> Optional[str]:
+        """
+        Scan only the string leaves (and keys) of a parsed JSON document
         
-        for pattern in self.suspicious_patterns:
-            if re.search(pattern, content_lower, re.IGNORECASE):
-                return True
+        The leaves are joined with newlines, which none of the rules can match
+        across, and scanned in a single pass. Documents with more string content
+        than ``max_chars`` (default max_scan_chars) are rejected rather than
+        partially scanned.
         
-        return False
+        Returns:
+            The name of the matched rule, or None if the document is clean
+        """
+        max_chars = self.max_scan_chars if max_chars is None else max_chars
+        budget = max_chars
+        leaves = []
+        stack = [json_data]
+        while stack:
+            node = stack.pop()
+            node_type = type(node)
+            if node_type is str:
+                budget -= len(node)
+                if budget < 0:
+                    return 'size_limit'
+                leaves.append(node)
+            elif node_type is dict:
+                leaves.extend(node.keys())
+                stack.extend(node.values())
+            elif node_type is list:
+                stack.extend(node)
+        content = '\n'.join(leaves)
+        if len(content) > max_chars:
+            return 'size_limit'
+        return self.match_malicious_pattern(content)
+    
+    def match_malicious_pattern(self, content: str) -> Optional[str]:
+        """Return the name of the first suspicious rule matching content, or None"""
+        if self._prefilter is not None:
+            content_lower = content.lower()
+            if not any(literal in content_lower for literal in self._prefilter):
+                return None
+        
+        match = self._scanner.search(content)
+        if match is None:
+            return None
+        return self._rule_names[int(match.lastgroup[len('rule'):])]
+    
+    def contains_malicious_pattern(self, content: str) -> bool:
+        """Check if content contains malicious patterns"""
+        return self.match_malicious_pattern(content) is not None
     
     def validate_healthcare_request(self) -> bool:
         """Validate healthcare-specific request requirements"""
         
         # Check for required headers in healthcare endpoints
-        if request.path.startswith('/fhir/'):
+        if request.path == '/fhir' or request.path.startswith('/fhir/'):
             # FHIR endpoints should have proper content type
             if request.method == 'POST':
                 content_type = request.headers.get('Content-Type', '')
-                if not content_type.startswith('application/json'):
+                if not content_type.startswith(('application/json', 'application/fhir+json')):
                     return False
         
         # Check file upload restrictions
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ServiceRegistry:
+    """Shared clients constructed lazily, once per process.
+
+    Each service is a named factory that runs on the first ``get`` and whose
+    result is reused afterwards. Factories may ``get`` other services. After a
+    fork (gunicorn workers, ``--preload``) the child drops every instance it
+    inherited - gRPC channels, connection pools and background threads do not
+    survive fork - and builds its own on first use. The inherited objects are
+    kept referenced but never used, so their finalizers cannot close sockets
+    the parent still owns. Construction times and named startup phases are
+    kept for ``report``.
+    """
+
+    def __init__(self):
+        self._factories = {}  # service name -> factory
+        self._closers = {}  # service name -> callable releasing an instance
+        self._locks = {}  # service name -> lock held while the factory runs
+        self._instances = {}
+        self._timings = {}  # service name -> {"init_ms", "thread"}
+        self._errors = {}  # service name -> last construction error
+        self._phases = {}  # phase name -> duration in ms
+        self._inherited = []  # instances built before the last fork
+        self._pid = os.getpid()
+        self._started = time.time()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, name: str, factory: Callable[[], Any],
+                 close: Optional[Callable[[Any], None]] = None) -> "ServiceProxy":
+        """Register a factory and return a proxy that builds the service on first attribute access"""
+        if name in self._factories:
+            raise ValueError(f"Duplicate service: {name}")
+        self._factories[name] = factory
+        if close is not None:
+            self._closers[name] = close
+        self._locks[name] = threading.RLock()
+        return ServiceProxy(self, name)
+
+    def get(self, name: str) -> Any:
+        """Return the service, constructing it in this process if needed"""
+        instance = self._instances.get(name, _MISSING)
+        if instance is not _MISSING:
+            return instance
+        if name not in self._factories:
+            raise KeyError(f"Unknown service: {name}")
+
+        # Per-service locks: a slow factory does not hold up unrelated services
+        with self._locks[name]:
+            instance = self._instances.get(name, _MISSING)
+            if instance is not _MISSING:
+                return instance
+            start = time.perf_counter()
+            try:
+                instance = self._factories[name]()
+            except Exception as e:
+                self._errors[name] = str(e)
+                logger.error(f"Failed to initialize service {name}: {str(e)}")
+                raise
+            self._timings[name] = {
+                "init_ms": round((time.perf_counter() - start) * 1000, 2),
+                "thread": threading.current_thread().name
+            }
+            self._errors.pop(name, None)
+            self._instances[name] = instance
+            logger.info(f"Initialized service {name} in {self._timings[name]['init_ms']} ms")
+            return instance
+
+    def is_initialized(self, name: str) -> bool:
+        return name in self._instances
+
+    def warm(self, names: Optional[Iterable[str]] = None) -> threading.Thread:
+        """Construct services on a background thread so the first request does not pay for them"""
+        names = list(self._factories if names is None else names)
+
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    # Left unbuilt; the first real use retries and raises
+                    logger.warning(f"Warm-up of service {name} failed: {e}")
+
+        thread = threading.Thread(target=run, name="service-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def record_phase(self, name: str, duration_ms: float):
+        """Record a named startup phase, e.g. the time to import the app module"""
+        self._phases[name] = round(duration_ms, 2)
+
+    def close_all(self):
+        """Release this process's instances that have a close hook, most recently built first"""
+        for name in reversed(list(self._instances)):
+            close = self._closers.get(name)
+            if close is None:
+                continue
+            try:
+                close(self._instances.pop(name))
+            except Exception as e:
+                logger.warning(f"Error closing service {name}: {e}")
+
+    def _after_fork(self):
+        """Forget the parent's instances; locks may have been held by threads that no longer exist"""
+        self._inherited = list(self._instances.values())
+        self._instances = {}
+        self._timings = {}
+        self._errors = {}
+        self._locks = {name: threading.RLock() for name in self._factories}
+        self._pid = os.getpid()
+        self._started = time.time()
+
+    def report(self) -> Dict[str, Any]:
+        """Startup phases and per-service construction state for this process"""
+        return {
+            "pid": self._pid,
+            "uptime_seconds": round(time.time() - self._started, 1),
+            "phases": dict(self._phases),
+            "services": {
+                name: dict(
+                    self._timings.get(name, {}),
+                    initialized=name in self._instances,
+                    **({"error": self._errors[name]} if name in self._errors else {})
+                )
+                for name in self._factories
+            }
+        }
+
+
+class ServiceProxy:
+    """Module-level stand-in for a registered service; attribute access resolves it lazily"""
+
+    __slots__ = ("_registry", "_name")
+
+    def __init__(self, registry: ServiceRegistry, name: str):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._registry.get(self._name), attr)
+
+    def __repr__(self) -> str:
+        state = "initialized" if self._registry.is_initialized(self._name) else "lazy"
+        return f"<ServiceProxy {self._name} ({state})>"
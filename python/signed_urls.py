@@ -0,0 +1,165 @@
+import binascii
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+from urllib.parse import quote
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SIGNING_HOST = "storage.googleapis.com"
+SIGNING_ALGORITHM = "GOOG4-RSA-SHA256"
+MAX_EXPIRATION = 7 * 24 * 3600  # V4 signed URLs are valid for at most 7 days
+
+
+class SignedUrlFactory:
+    """Mint V4 signed URLs for one bucket without per-call client work.
+
+    The service-account signer is loaded once and URLs are signed in-process
+    (one RSA signature each, no network). Credentials without a local private
+    key fall back to ``Blob.generate_signed_url`` on cached blob handles.
+    GET URLs can optionally be reused for ``read_cache_ttl`` seconds; the
+    cache TTL is capped at half the URL lifetime so a cached URL always has
+    plenty of validity left when handed out.
+    """
+
+    def __init__(self, storage_client, bucket_name: str, credentials=None,
+                 read_cache_ttl: float = 300, max_cache_entries: int = 10000):
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.credentials = credentials or getattr(storage_client, "_credentials", None)
+        self.read_cache_ttl = read_cache_ttl
+        self.max_cache_entries = max_cache_entries
+
+        # Preload the signer; service-account credentials sign locally
+        self._signer = getattr(self.credentials, "signer", None)
+        self._signer_email = getattr(self.credentials, "signer_email", None) or \
+            getattr(self.credentials, "service_account_email", None)
+        if self._signer is None or not self._signer_email:
+            logger.warning("Credentials cannot sign locally; signed URLs will use the client library")
+            self._signer = None
+
+        self._bucket = None
+        self._blobs = OrderedDict()  # blob name -> Blob handle (fallback path only)
+        self._cache = OrderedDict()  # (blob, method, expiration, content_type) -> (url, reuse_until)
+        self._lock = threading.Lock()
+        self.stats = {"signed": 0, "cache_hits": 0}
+
+    def sign(self, blob_name: str, method: str = "GET", expiration: int = 3600,
+             content_type: Optional[str] = None) -> str:
+        """Return a V4 signed URL for ``blob_name``"""
+        return self.sign_many([blob_name], method, expiration, content_type)[blob_name]
+
+    def sign_many(self, blob_names: Iterable[str], method: str = "GET", expiration: int = 3600,
+                  content_type: Optional[str] = None) -> Dict[str, str]:
+        """Return {blob_name: signed URL} for many objects, sharing one timestamp"""
+        method = method.upper()
+        expiration = int(min(expiration, MAX_EXPIRATION))
+        cache_ttl = min(self.read_cache_ttl, expiration / 2) if method == "GET" else 0
+        now = time.monotonic()
+        signed_at = datetime.now(timezone.utc)
+
+        urls = {}
+        for blob_name in blob_names:
+            if blob_name in urls:
+                continue
+            key = (blob_name, method, expiration, content_type)
+            if cache_ttl:
+                url = self._cached(key, now)
+                if url is not None:
+                    urls[blob_name] = url
+                    continue
+
+            if self._signer is not None:
+                url = self._sign_v4(blob_name, method, expiration, content_type, signed_at)
+            else:
+                url = self._blob(blob_name).generate_signed_url(
+                    version="v4",
+                    expiration=expiration,
+                    method=method,
+                    content_type=content_type,
+                    credentials=self.credentials
+                )
+            urls[blob_name] = url
+
+            with self._lock:
+                self.stats["signed"] += 1
+                if cache_ttl:
+                    self._cache[key] = (url, now + cache_ttl)
+                    self._cache.move_to_end(key)
+                    while len(self._cache) > self.max_cache_entries:
+                        self._cache.popitem(last=False)
+        return urls
+
+    def _cached(self, key, now: float) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            url, reuse_until = entry
+            if now >= reuse_until:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return url
+
+    def _sign_v4(self, blob_name: str, method: str, expiration: int,
+                 content_type: Optional[str], signed_at: datetime) -> str:
+        """Build and sign the V4 canonical request locally"""
+        request_timestamp = signed_at.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = signed_at.strftime("%Y%m%d")
+        credential_scope = f"{datestamp}/auto/storage/goog4_request"
+
+        headers = {"host": SIGNING_HOST}
+        if content_type:
+            headers["content-type"] = content_type
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{name}:{headers[name]}\n" for name in sorted(headers))
+
+        query = {
+            "X-Goog-Algorithm": SIGNING_ALGORITHM,
+            "X-Goog-Credential": f"{self._signer_email}/{credential_scope}",
+            "X-Goog-Date": request_timestamp,
+            "X-Goog-Expires": str(expiration),
+            "X-Goog-SignedHeaders": signed_headers,
+        }
+        canonical_query = "&".join(
+            f"{quote(name, safe='~')}={quote(value, safe='~')}" for name, value in sorted(query.items())
+        )
+        path = f"/{self.bucket_name}/{quote(blob_name, safe='/~')}"
+
+        canonical_request = "\n".join([
+            method, path, canonical_query, canonical_headers, signed_headers, "UNSIGNED-PAYLOAD"
+        ])
+        string_to_sign = "\n".join([
+            SIGNING_ALGORITHM,
+            request_timestamp,
+            credential_scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+        ])
+        signature = binascii.hexlify(self._signer.sign(string_to_sign.encode("utf-8"))).decode("ascii")
+        return f"https://{SIGNING_HOST}{path}?{canonical_query}&X-Goog-Signature={signature}"
+
+    def _blob(self, blob_name: str):
+        """Cached Blob handle for the library fallback"""
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = self.storage_client.bucket(self.bucket_name)
+            blob = self._blobs.get(blob_name)
+            if blob is None:
+                blob = self._bucket.blob(blob_name)
+                self._blobs[blob_name] = blob
+                while len(self._blobs) > self.max_cache_entries:
+                    self._blobs.popitem(last=False)
+            else:
+                self._blobs.move_to_end(blob_name)
+            return blob
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, cached_urls=len(self._cache), local_signing=self._signer is not None)
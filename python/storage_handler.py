@@ -3,16 +3,65 @@ import logging
 import json
 import os
 import base64
+import hashlib
 from datetime import datetime
+from types import SimpleNamespace
 from google.oauth2 import service_account
 from fhir_converter import FHIRConverter
+from fhir_templates import dumps_bundle
+from bigquery_writer import BufferedBigQueryWriter
+from fhir_cache import FHIRResourceCache
+from composite_upload import ParallelCompositeUploader
+from signed_urls import SignedUrlFactory
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Display fields of the medical-records listing, projected from fhir_resource inside
+# BigQuery (mirrors FHIRConverter.extract_display_fields; the last matching entry wins)
+MEDICAL_RECORD_DISPLAY_SQL = {
+    "practitioner_name": """(
+        SELECT name FROM (
+            SELECT pos, TRIM(CONCAT(
+                ARRAY_TO_STRING(ARRAY(
+                    SELECT JSON_VALUE(given)
+                    FROM UNNEST(JSON_QUERY_ARRAY(entry, '$.resource.name[0].given')) AS given
+                ), ' '),
+                ' ',
+                IFNULL(JSON_VALUE(entry, '$.resource.name[0].family'), '')
+            )) AS name
+            FROM UNNEST(JSON_QUERY_ARRAY(fhir_resource, '$.entry')) AS entry WITH OFFSET pos
+            WHERE JSON_VALUE(entry, '$.resource.resourceType') = 'Practitioner'
+        )
+        WHERE name != ''
+        ORDER BY pos DESC
+        LIMIT 1
+    )""",
+    "reason_text": """(
+        SELECT reason FROM (
+            SELECT pos, CASE JSON_VALUE(entry, '$.resource.resourceType')
+                WHEN 'DiagnosticReport' THEN COALESCE(
+                    NULLIF(JSON_VALUE(entry, '$.resource.code.text'), ''),
+                    NULLIF(JSON_VALUE(entry, '$.resource.conclusion'), ''))
+                WHEN 'Media' THEN NULLIF(JSON_VALUE(entry, '$.resource.reasonCode[0].text'), '')
+            END AS reason
+            FROM UNNEST(JSON_QUERY_ARRAY(fhir_resource, '$.entry')) AS entry WITH OFFSET pos
+        )
+        WHERE reason IS NOT NULL
+        ORDER BY pos DESC
+        LIMIT 1
+    )"""
+}
+
 class StorageHandler:
-    def __init__(self, bucket_name="healthcare_audio_analyzer_fhir", credentials=None):
+    def __init__(self, bucket_name="healthcare_audio_analyzer_fhir", credentials=None,
+                 buffered_writes=True, max_batch_rows=500, max_batch_latency=1.0, on_row_error=None,
+                 resource_cache_bytes=64 * 1024 * 1024, resource_cache_path=None,
+                 composite_threshold=32 * 1024 * 1024, composite_part_size=16 * 1024 * 1024,
+                 composite_workers=8, signed_url_cache_ttl=300, fhir_templates=True,
+                 bundle_storage="embedded", display_columns=False,
+                 storage_client=None, bigquery_client=None, confirm_writes=True):
         self.bucket_name = bucket_name
         
         # Initialize credentials
@@ -35,13 +84,13 @@ class StorageHandler:
                 logger.warning("No SERVICE_ACCOUNT_KEY environment variable found, using default credentials")
                 self.credentials = None
         
-        # Initialize clients with credentials
+        # Initialize clients with credentials, reusing the caller's clients when given
         if self.credentials:
-            self.storage_client = storage.Client(credentials=self.credentials)
-            self.bigquery_client = bigquery.Client(credentials=self.credentials)
+            self.storage_client = storage_client or storage.Client(credentials=self.credentials)
+            self.bigquery_client = bigquery_client or bigquery.Client(credentials=self.credentials)
         else:
-            self.storage_client = storage.Client()
-            self.bigquery_client = bigquery.Client()
+            self.storage_client = storage_client or storage.Client()
+            self.bigquery_client = bigquery_client or bigquery.Client()
         
         # Use existing dataset and table
         self.dataset_id = "healthcare_audio_data"
@@ -49,20 +98,143 @@ class StorageHandler:
         self.fhir_table_id = "fhir_resources"
         
         # Initialize FHIR converter
-        self.fhir_converter = FHIRConverter()
+        self.fhir_converter = FHIRConverter(use_templates=fhir_templates)
+        
+        # How audio Bundle rows are stored:
+        #   "embedded"   - the full Bundle, entry resources included
+        #   "references" - entries keep only their fullUrl; the resources are
+        #                  stored in their own rows and re-attached on search
+        if bundle_storage not in ("embedded", "references"):
+            raise ValueError(f"Unknown bundle_storage: {bundle_storage}")
+        self.bundle_storage = bundle_storage
+        
+        # Write practitioner_name / reason_text columns so listings skip fhir_resource
+        # (requires `python bigquery_schema.py add-display-columns`)
+        self.display_columns = display_columns
+        
+        # Point-lookup cache of stored (immutable) FHIR resources
+        self.resource_cache = FHIRResourceCache(
+            max_memory_bytes=resource_cache_bytes,
+            disk_path=resource_cache_path
+        )
+        
+        # Signed URLs are minted in-process with the preloaded service-account signer
+        self.url_factory = SignedUrlFactory(
+            self.storage_client,
+            self.bucket_name,
+            credentials=self.credentials,
+            read_cache_ttl=signed_url_cache_ttl
+        )
+        
+        # Large files are uploaded as parallel parts and composed in GCS
+        self.composite_uploader = ParallelCompositeUploader(
+            self.storage_client,
+            self.bucket_name,
+            threshold=composite_threshold,
+            part_size=composite_part_size,
+            max_workers=composite_workers
+        )
+        
+        # Background write buffer for streaming inserts (None = synchronous inserts).
+        # With confirm_writes the store_* methods wait until BigQuery has accepted their
+        # rows (still coalesced with other requests' rows), so a returned success is
+        # durable. Without it they return once the rows are buffered, and rejected rows
+        # are only reported to on_row_error.
+        self.confirm_writes = confirm_writes
+        self.on_row_error = on_row_error
+        self.bq_writer = None
+        if buffered_writes:
+            self.bq_writer = BufferedBigQueryWriter(
+                self.bigquery_client,
+                max_batch_rows=max_batch_rows,
+                max_latency=max_batch_latency,
+                on_row_error=self._row_failed,
+                on_rows_written=self._rows_written
+            )
+
+    def _insert_row(self, table_ref, row_data):
+        """Write one row through _insert_rows, raising if BigQuery rejected it"""
+        if self._insert_rows(table_ref, [row_data]):
+            raise Exception(f"Failed to insert data into BigQuery table {table_ref}")
+
+    def _insert_rows(self, table_ref, rows, synchronous=False, skip_invalid_rows=False):
+        """
+        Write several rows to one table in a single call
+        
+        ``synchronous`` bypasses the write buffer with a call of its own, for
+        callers that need ``skip_invalid_rows=False`` (BigQuery rejects the
+        whole request if any row is invalid). Otherwise rows go through the
+        write buffer, and with confirm_writes the call waits for the outcome.
+        
+        Returns:
+            Indices of rows BigQuery rejected (always empty for unconfirmed
+            buffered writes, whose failures only reach on_row_error)
+        """
+        if not rows:
+            return []
+        if self.bq_writer and not synchronous:
+            if self.confirm_writes:
+                failed = self.bq_writer.write(table_ref, rows)
+                if failed:
+                    logger.error(f"BigQuery rejected rows {failed} of {len(rows)} in {table_ref}")
+                return failed
+            self.bq_writer.enqueue_many(table_ref, rows)
+            return []
+        
+        errors = self.bigquery_client.insert_rows_json(table_ref, rows, skip_invalid_rows=skip_invalid_rows)
+        if errors:
+            logger.error(f"Errors inserting into BigQuery table {table_ref}: {errors}")
+        failed = sorted({error["index"] for error in errors or []})
+        # Without skip_invalid_rows any error means BigQuery stored none of the rows
+        if not errors or skip_invalid_rows:
+            rejected = set(failed)
+            self._rows_written(table_ref, [row for index, row in enumerate(rows) if index not in rejected])
+        return failed
+
+    def _insert_tables(self, writes):
+        """
+        Write rows to several tables, with one confirmed wait when confirm_writes is on
+        
+        Returns:
+            For each (table_ref, rows) pair, the indices of the rows BigQuery rejected
+        """
+        if self.bq_writer and self.confirm_writes:
+            results = self.bq_writer.write_many(writes)
+            for (table_ref, rows), failed in zip(writes, results):
+                if failed:
+                    logger.error(f"BigQuery rejected rows {failed} of {len(rows)} in {table_ref}")
+            return results
+        return [self._insert_rows(table_ref, rows) for table_ref, rows in writes]
+
+    def _rows_written(self, table_ref, rows):
+        """BigQuery accepted these rows: only now may FHIR resources enter the point-lookup cache"""
+        if table_ref == f"{self.dataset_id}.{self.fhir_table_id}":
+            for row_data in rows:
+                self._cache_fhir_row(row_data)
+
+    def _row_failed(self, table_ref, row_data, errors):
+        """BigQuery rejected a buffered row: make sure no cache tier serves it, then report it"""
+        if table_ref == f"{self.dataset_id}.{self.fhir_table_id}" and row_data.get("resource_id"):
+            self.resource_cache.evict(row_data["resource_type"], row_data["resource_id"])
+        if self.on_row_error:
+            self.on_row_error(table_ref, row_data, errors)
+        else:
+            logger.error(f"Errors inserting row into {table_ref}: {errors}")
+
+    def flush_writes(self):
+        """Write any rows still held in the write buffer"""
+        if self.bq_writer:
+            self.bq_writer.flush()
+
+    def close(self):
+        """Drain the write buffer and stop its flusher thread"""
+        if self.bq_writer:
+            self.bq_writer.close()
 
     def generate_upload_url(self, file_name, content_type="audio/wav", expiration=3600):
         """Generate a signed URL for uploading a file to GCS"""
         try:
-            bucket = self.storage_client.bucket(self.bucket_name)
-            blob = bucket.blob(file_name)
-            
-            url = blob.generate_signed_url(
-                version="v4",
-                expiration=expiration,
-                method="PUT",
-                content_type=content_type
-            )
+            url = self.url_factory.sign(file_name, method="PUT", expiration=expiration, content_type=content_type)
             
             logger.info(f"Generated upload URL for file: {file_name}")
             return url
@@ -70,27 +242,89 @@ class StorageHandler:
             logger.error(f"Error generating upload URL: {str(e)}")
             raise
 
+    def upload_file(self, file_obj, blob_name, content_type=None):
+        """Upload a file object to the bucket, in parallel parts when it is large"""
+        try:
+            return self.composite_uploader.upload(file_obj, blob_name, content_type=content_type)
+        except Exception as e:
+            logger.error(f"Error uploading file {blob_name}: {str(e)}")
+            raise
+
+    def _audio_metadata_row(self, file_name, file_data, file_size):
+        """Row for the audio_files table, matching the existing schema"""
+        return {
+            "file_name": file_name,
+            "file_path": file_data,  # Store as file_path (URL or GCS path)
+            "upload_timestamp": datetime.now().isoformat(),
+            "file_size_bytes": file_size  # Store as file_size_bytes
+        }
+
+    def _fhir_row(self, fhir_resource, patient_id=None, file_name=None, fhir_json=None):
+        """Row for the fhir_resources table; pass ``fhir_json`` to reuse an existing serialization"""
+        if fhir_json is None:
+            fhir_json = json.dumps(fhir_resource)
+        row_data = {
+            "resource_type": fhir_resource.get("resourceType"),
+            "resource_id": fhir_resource.get("id"),
+            "fhir_resource": fhir_json,
+            "created_at": datetime.now().isoformat(),
+            "patient_id": patient_id,
+            "file_name": file_name
+        }
+        if self.display_columns:
+            practitioner_name, reason = self.fhir_converter.extract_display_fields(fhir_resource)
+            row_data["practitioner_name"] = practitioner_name
+            row_data["reason_text"] = reason
+        return row_data
+
+    def _audio_fhir_rows(self, file_name, file_data, file_size, file_type, patient_id=None,
+                         operator_name=None, duration_seconds=None, reason=None):
+        """
+        Build an audio FHIR bundle and its fhir_resources rows
+        
+        Each resource is serialized exactly once; the Bundle row reuses that
+        text (or, with bundle_storage="references", leaves it out).
+        
+        Returns:
+            (bundle, rows) with the Bundle row first
+        """
+        fhir_bundle, json_by_id = self.fhir_converter.convert_audio_metadata_to_fhir_with_json(
+            file_name=file_name,
+            file_path=file_data,
+            file_size_bytes=file_size,
+            content_type=file_type,
+            patient_id=patient_id,
+            operator_name=operator_name,
+            duration_seconds=duration_seconds,
+            reason=reason
+        )
+        
+        bundle_json = json_by_id[fhir_bundle["id"]]
+        if self.bundle_storage == "references":
+            bundle_json = dumps_bundle(fhir_bundle, json_by_id, references_only=True)
+        
+        rows = [self._fhir_row(fhir_bundle, patient_id, file_name, bundle_json)]
+        for entry in fhir_bundle.get("entry", []):
+            resource = entry.get("resource")
+            if resource:
+                rows.append(self._fhir_row(resource, patient_id, file_name, json_by_id[resource["id"]]))
+        return fhir_bundle, rows
+
+    def _cache_fhir_row(self, row_data):
+        """Populate the point-lookup cache from a row BigQuery has accepted"""
+        if row_data["resource_type"] and row_data["resource_id"]:
+            self.resource_cache.put(row_data["resource_type"], row_data["resource_id"],
+                                    row_data["fhir_resource"].encode('utf-8'))
+
     def store_audio_file_metadata(self, file_name, file_data, file_size, file_type, user_id=None, analysis_status="pending"):
         """Store audio file metadata in BigQuery using the existing schema"""
         try:
             # Prepare the row data to match the existing table schema
-            row_data = {
-                "file_name": file_name,
-                "file_path": file_data,  # Store as file_path (URL or GCS path)
-                "upload_timestamp": datetime.now().isoformat(),
-                "file_size_bytes": file_size  # Store as file_size_bytes
-            }
+            row_data = self._audio_metadata_row(file_name, file_data, file_size)
 
             # Insert the row into BigQuery
             table_ref = f"{self.dataset_id}.{self.table_id}"
-            errors = self.bigquery_client.insert_rows_json(
-                table_ref,
-                [row_data]
-            )
-
-            if errors:
-                logger.error(f"Errors inserting into BigQuery: {errors}")
-                raise Exception(f"Failed to insert data into BigQuery: {errors}")
+            self._insert_row(table_ref, row_data)
 
             logger.info(f"Successfully stored metadata for file: {file_name}")
             return True
@@ -103,25 +337,11 @@ class StorageHandler:
         """Store FHIR resource in BigQuery"""
         try:
             # Prepare the row data for FHIR resources table
-            row_data = {
-                "resource_type": fhir_resource.get("resourceType"),
-                "resource_id": fhir_resource.get("id"),
-                "fhir_resource": json.dumps(fhir_resource),
-                "created_at": datetime.now().isoformat(),
-                "patient_id": patient_id,
-                "file_name": file_name
-            }
+            row_data = self._fhir_row(fhir_resource, patient_id, file_name)
 
             # Insert the row into BigQuery FHIR table
             table_ref = f"{self.dataset_id}.{self.fhir_table_id}"
-            errors = self.bigquery_client.insert_rows_json(
-                table_ref,
-                [row_data]
-            )
-
-            if errors:
-                logger.error(f"Errors inserting FHIR resource into BigQuery: {errors}")
-                raise Exception(f"Failed to insert FHIR resource into BigQuery: {errors}")
+            self._insert_row(table_ref, row_data)
 
             logger.info(f"Successfully stored FHIR resource: {fhir_resource.get('resourceType')}/{fhir_resource.get('id')}")
             return True
@@ -130,6 +350,36 @@ class StorageHandler:
             logger.error(f"Error storing FHIR resource: {str(e)}")
             raise
 
+    def store_audio_fhir_resources(
+        self,
+        file_name,
+        file_data,
+        file_size,
+        file_type,
+        patient_id=None,
+        operator_name=None,
+        duration_seconds=None,
+        reason=None
+    ):
+        """Create the FHIR bundle for an audio file and store it with its resources; returns the bundle"""
+        try:
+            # Create the FHIR bundle, serializing each resource once
+            fhir_bundle, rows = self._audio_fhir_rows(
+                file_name, file_data, file_size, file_type, patient_id,
+                operator_name, duration_seconds, reason
+            )
+            
+            # Store the Bundle and its resources with one multi-row insert
+            failed = self._insert_rows(f"{self.dataset_id}.{self.fhir_table_id}", rows)
+            if failed:
+                raise Exception(f"Failed to insert FHIR resources into BigQuery: rows {failed}")
+            
+            return fhir_bundle
+            
+        except Exception as e:
+            logger.error(f"Error storing FHIR resources for {file_name}: {str(e)}")
+            raise
+
     def store_audio_file_with_fhir(
         self, 
         file_name, 
@@ -143,29 +393,21 @@ class StorageHandler:
     ):
         """Store audio file metadata and create FHIR resources"""
         try:
-            # Store traditional metadata
-            self.store_audio_file_metadata(file_name, file_data, file_size, file_type)
-            
-            # Create FHIR bundle
-            fhir_bundle = self.fhir_converter.convert_audio_metadata_to_fhir(
-                file_name=file_name,
-                file_path=file_data,
-                file_size_bytes=file_size,
-                content_type=file_type,
-                patient_id=patient_id,
-                operator_name=operator_name,
-                duration_seconds=duration_seconds,
-                reason=reason
+            # Create the FHIR bundle and its resources, serializing each resource once
+            fhir_bundle, fhir_rows = self._audio_fhir_rows(
+                file_name, file_data, file_size, file_type, patient_id,
+                operator_name, duration_seconds, reason
             )
             
-            # Store FHIR Bundle
-            self.store_fhir_resource(fhir_bundle, patient_id, file_name)
-            
-            # Store individual resources from the bundle
-            for entry in fhir_bundle.get("entry", []):
-                resource = entry.get("resource")
-                if resource:
-                    self.store_fhir_resource(resource, patient_id, file_name)
+            # Both tables' rows go out together, so a confirmed write waits once
+            failed_audio, failed_fhir = self._insert_tables([
+                (f"{self.dataset_id}.{self.table_id}", [self._audio_metadata_row(file_name, file_data, file_size)]),
+                (f"{self.dataset_id}.{self.fhir_table_id}", fhir_rows)
+            ])
+            if failed_audio:
+                raise Exception(f"Failed to insert data into BigQuery table {self.dataset_id}.{self.table_id}")
+            if failed_fhir:
+                raise Exception(f"Failed to insert FHIR resources into BigQuery: rows {failed_fhir}")
             
             logger.info(f"Successfully stored audio file with FHIR resources: {file_name}")
             return {
@@ -178,53 +420,452 @@ class StorageHandler:
             logger.error(f"Error storing audio file with FHIR: {str(e)}")
             raise
 
-    def get_fhir_resources(self, patient_id=None, resource_type=None, file_name=None):
-        """Retrieve FHIR resources from BigQuery"""
+    def store_audio_files_with_fhir_batch(self, files):
+        """
+        Store many audio files with their FHIR resources
+        
+        Every bundle is built in one pass, then each table receives a single
+        multi-row insert, made synchronously so each rejected row is mapped
+        back to its file. ``files`` holds dicts with the keyword arguments of
+        store_audio_file_with_fhir.
+        
+        Returns:
+            One {"success", "fhir_bundle", "error"} dict per file, in input order
+        """
+        results = []
+        audio_rows, audio_owners = [], []
+        fhir_rows, fhir_owners = [], []
+        
+        for index, item in enumerate(files):
+            try:
+                fhir_bundle, rows = self._audio_fhir_rows(
+                    item["file_name"], item["file_data"], item["file_size"], item["file_type"],
+                    item.get("patient_id"), item.get("operator_name"),
+                    item.get("duration_seconds"), item.get("reason")
+                )
+            except Exception as e:
+                logger.error(f"Error building FHIR resources for {item.get('file_name')}: {str(e)}")
+                results.append({"success": False, "fhir_bundle": None, "error": str(e)})
+                continue
+            
+            results.append({"success": True, "fhir_bundle": fhir_bundle, "error": None})
+            audio_rows.append(self._audio_metadata_row(item["file_name"], item["file_data"], item["file_size"]))
+            audio_owners.append(index)
+            fhir_rows.extend(rows)
+            fhir_owners.extend([index] * len(rows))
+        
+        try:
+            failed_audio = self._insert_rows(f"{self.dataset_id}.{self.table_id}", audio_rows,
+                                             synchronous=True, skip_invalid_rows=True)
+            failed_fhir = self._insert_rows(f"{self.dataset_id}.{self.fhir_table_id}", fhir_rows,
+                                            synchronous=True, skip_invalid_rows=True)
+        except Exception as e:
+            logger.error(f"Error storing audio file batch: {str(e)}")
+            raise
+        
+        for row_index in failed_audio:
+            results[audio_owners[row_index]].update(success=False, error="BigQuery rejected audio_files row")
+        for row_index in failed_fhir:
+            results[fhir_owners[row_index]].update(success=False, error="BigQuery rejected fhir_resources row")
+        
+        stored = sum(1 for result in results if result["success"])
+        logger.info(f"Stored {stored}/{len(files)} audio files with FHIR resources in one batch")
+        return results
+
+    @staticmethod
+    def subject_patient_id(fhir_resource):
+        """Patient id from the subject reference ("Patient/<id>"), or None"""
+        reference = (fhir_resource.get("subject") or {}).get("reference") or ""
+        return reference.split("/", 1)[1] if reference.startswith("Patient/") else None
+
+    def _with_encrypted_subject(self, fhir_resource, encrypted_patient_id):
+        """Copy of a resource whose subject reference names the encrypted patient id"""
+        if self.subject_patient_id(fhir_resource) is None:
+            return fhir_resource
+        if not encrypted_patient_id:
+            raise ValueError(f"No encrypted patient id for {fhir_resource.get('resourceType')}/"
+                             f"{fhir_resource.get('id')}; refusing to store a plaintext subject")
+        subject = dict(fhir_resource["subject"], reference=f"Patient/{encrypted_patient_id}")
+        return dict(fhir_resource, subject=subject)
+
+    def store_fhir_resources(self, fhir_resources, patient_ids=None, atomic=True):
+        """
+        Store many client-supplied FHIR resources with one multi-row insert
+        
+        ``patient_ids`` are the already-encrypted patient ids, one per resource
+        (see subject_patient_id); the patient_id column never holds plaintext,
+        and subject.reference is rewritten to "Patient/<encrypted id>" in the
+        stored JSON, as on the registration path. The insert bypasses the write buffer so the outcome is known. With
+        ``atomic`` a single invalid row makes BigQuery reject every row, as a
+        transaction Bundle requires; otherwise valid rows are kept.
+        
+        Returns:
+            Indices of the resources that were not stored
+        """
+        patient_ids = patient_ids or [None] * len(fhir_resources)
+        rows = [
+            self._fhir_row(self._with_encrypted_subject(fhir_resource, patient_id), patient_id)
+            for fhir_resource, patient_id in zip(fhir_resources, patient_ids)
+        ]
+        
+        try:
+            failed = self._insert_rows(f"{self.dataset_id}.{self.fhir_table_id}", rows,
+                                       synchronous=True, skip_invalid_rows=not atomic)
+        except Exception as e:
+            logger.error(f"Error storing FHIR resources: {str(e)}")
+            raise
+        
+        if atomic and failed:
+            failed = list(range(len(rows)))
+        
+        logger.info(f"Stored {len(rows) - len(failed)}/{len(rows)} FHIR resources in one insert")
+        return failed
+
+    def _fhir_filters(self, patient_id=None, resource_type=None, file_name=None):
+        """Build WHERE conditions and query parameters for FHIR resource lookups"""
+        where_conditions = []
+        query_parameters = []
+        
+        if patient_id:
+            where_conditions.append("patient_id = @patient_id")
+            query_parameters.append(bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id))
+        
+        if resource_type:
+            where_conditions.append("resource_type = @resource_type")
+            query_parameters.append(bigquery.ScalarQueryParameter("resource_type", "STRING", resource_type))
+        
+        if file_name:
+            where_conditions.append("file_name = @file_name")
+            query_parameters.append(bigquery.ScalarQueryParameter("file_name", "STRING", file_name))
+        
+        return where_conditions, query_parameters
+
+    @staticmethod
+    def _filters_fingerprint(patient_id, resource_type, file_name):
+        """Short hash binding a page token to the search it was issued for"""
+        filters = json.dumps([patient_id, resource_type, file_name])
+        return hashlib.sha256(filters.encode('utf-8')).hexdigest()[:16]
+
+    def encode_page_token(self, created_at, resource_id, patient_id=None, resource_type=None, file_name=None):
+        """Opaque keyset cursor pointing just past (created_at, resource_id)"""
+        cursor = {
+            "c": created_at.isoformat(),
+            "r": resource_id,
+            "f": self._filters_fingerprint(patient_id, resource_type, file_name)
+        }
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('utf-8').rstrip("=")
+
+    def decode_page_token(self, page_token, patient_id=None, resource_type=None, file_name=None):
+        """Decode a page token, raising ValueError if it is malformed or from another search"""
+        try:
+            padded = page_token + "=" * (-len(page_token) % 4)
+            cursor = json.loads(base64.urlsafe_b64decode(padded.encode('utf-8')))
+            created_at = datetime.fromisoformat(cursor["c"])
+            resource_id = cursor["r"]
+            fingerprint = cursor["f"]
+        except Exception:
+            raise ValueError("Invalid page token")
+        
+        if fingerprint != self._filters_fingerprint(patient_id, resource_type, file_name):
+            raise ValueError("Page token does not match the search parameters")
+        
+        return created_at, resource_id
+
+    def query_fhir_rows(self, patient_id=None, resource_type=None, file_name=None, limit=50, page_token=None):
+        """
+        Run a keyset-paginated FHIR resource query, newest first
+        
+        The query job completes before this returns, so errors surface here;
+        the returned BigQuery row iterator then fetches rows page by page.
+        Each row has resource_type, resource_id, fhir_resource (raw JSON string)
+        and created_at.
+        """
+        where_conditions, query_parameters = self._fhir_filters(patient_id, resource_type, file_name)
+        
+        if page_token:
+            cursor_created_at, cursor_resource_id = self.decode_page_token(
+                page_token, patient_id, resource_type, file_name
+            )
+            where_conditions.append(
+                "(created_at < @cursor_created_at OR "
+                "(created_at = @cursor_created_at AND resource_id < @cursor_resource_id))"
+            )
+            query_parameters.append(bigquery.ScalarQueryParameter("cursor_created_at", "TIMESTAMP", cursor_created_at))
+            query_parameters.append(bigquery.ScalarQueryParameter("cursor_resource_id", "STRING", cursor_resource_id))
+        
+        query_parameters.append(bigquery.ScalarQueryParameter("page_limit", "INT64", limit))
+        
+        where_clause = f"WHERE {' AND '.join(where_conditions)}" if where_conditions else ""
+        
+        query = f"""
+        SELECT resource_type, resource_id, fhir_resource, created_at
+        FROM `{self.dataset_id}.{self.fhir_table_id}`
+        {where_clause}
+        ORDER BY created_at DESC, resource_id DESC
+        LIMIT @page_limit
+        """
+        
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        return self.bigquery_client.query(query, job_config=job_config).result(page_size=500)
+
+    def search_fhir_resources(self, patient_id=None, resource_type=None, file_name=None, count=50, page_token=None):
+        """
+        Retrieve one page of FHIR resources, newest first
+        
+        Pages are keyset-paginated on (created_at, resource_id), so the cost of a
+        page does not depend on how deep into the result set it is.
+        
+        Returns:
+            (resources, next_page_token); next_page_token is None on the last page
+        """
         try:
-            # Build query based on filters
-            where_conditions = []
-            query_parameters = []
+            # Fetch one extra row to learn whether another page exists
+            rows = list(self.query_fhir_rows(patient_id, resource_type, file_name, count + 1, page_token))
             
-            if patient_id:
-                where_conditions.append("patient_id = @patient_id")
-                query_parameters.append(bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id))
+            next_page_token = None
+            if len(rows) > count:
+                rows = rows[:count]
+                last = rows[-1]
+                next_page_token = self.encode_page_token(
+                    last.created_at, last.resource_id, patient_id, resource_type, file_name
+                )
             
-            if resource_type:
-                where_conditions.append("resource_type = @resource_type")
-                query_parameters.append(bigquery.ScalarQueryParameter("resource_type", "STRING", resource_type))
+            resources = [
+                {
+                    "resource_id": row.resource_id,
+                    "fhir_resource": json.loads(row.fhir_resource) if row.fhir_resource else None,
+                    "created_at": row.created_at.isoformat() if row.created_at else None
+                }
+                for row in rows
+            ]
+            self._hydrate_bundles([res["fhir_resource"] for res in resources if res["fhir_resource"]])
             
-            if file_name:
-                where_conditions.append("file_name = @file_name")
-                query_parameters.append(bigquery.ScalarQueryParameter("file_name", "STRING", file_name))
+            return resources, next_page_token
             
-            where_clause = f"WHERE {' AND '.join(where_conditions)}" if where_conditions else ""
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error searching FHIR resources: {str(e)}")
+            raise
+
+    def hydrate_fhir_rows(self, rows):
+        """
+        Stored JSON strings for a page of rows, references-mode Bundles re-attached
+        
+        With bundle_storage="embedded" (and for every non-Bundle row) the stored
+        text is returned untouched. Otherwise the page's Bundles are hydrated
+        together: cache first, then one batched lookup for the rest.
+        """
+        texts = [row.fhir_resource for row in rows]
+        if self.bundle_storage == "embedded":
+            return texts
+        
+        bundles = {
+            position: json.loads(text)
+            for position, (row, text) in enumerate(zip(rows, texts))
+            if row.resource_type == "Bundle" and text
+        }
+        if bundles:
+            self._hydrate_bundles(list(bundles.values()))
+            for position, bundle in bundles.items():
+                texts[position] = json.dumps(bundle)
+        return texts
+
+    def _hydrate_bundles(self, fhir_resources):
+        """Re-attach entry resources to Bundles stored with bundle_storage="references" (in place)"""
+        missing = {}  # (resource_type, resource_id) -> entries waiting for it
+        for fhir_resource in fhir_resources:
+            if fhir_resource.get("resourceType") != "Bundle":
+                continue
+            for entry in fhir_resource.get("entry") or []:
+                if "resource" in entry or "/" not in entry.get("fullUrl", ""):
+                    continue
+                resource_type, resource_id = entry["fullUrl"].rsplit("/", 2)[-2:]
+                missing.setdefault((resource_type, resource_id), []).append(entry)
+        if not missing:
+            return
+        
+        found = {}
+        for key in missing:
+            cached = self.resource_cache.get(*key)
+            if cached is not None:
+                found[key] = cached[0]
+        
+        remaining = [resource_id for (_, resource_id) in missing.keys() - found.keys()]
+        if remaining:
+            query = f"""
+            SELECT resource_type, resource_id, fhir_resource
+            FROM `{self.dataset_id}.{self.fhir_table_id}`
+            WHERE resource_id IN UNNEST(@resource_ids)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("resource_ids", "STRING", remaining)]
+            )
+            for row in self.bigquery_client.query(query, job_config=job_config).result():
+                if row.fhir_resource:
+                    body = row.fhir_resource.encode('utf-8')
+                    self.resource_cache.put(row.resource_type, row.resource_id, body)
+                    found[(row.resource_type, row.resource_id)] = body
+        
+        for key, entries in missing.items():
+            if key in found:
+                resource = json.loads(found[key])
+                for entry in entries:
+                    entry["resource"] = resource
+
+    def existing_fhir_resources(self, keys):
+        """
+        Which (resource_type, resource_id) pairs are already stored
+        
+        Stored resources are immutable (the point-lookup cache relies on it),
+        so callers use this to refuse writes that would add a second version.
+        """
+        keys = set(keys)
+        existing = {key for key in keys if self.resource_cache.get(*key) is not None}
+        remaining = sorted({resource_id for (_, resource_id) in keys - existing})
+        if not remaining:
+            return existing
+        
+        try:
+            query = f"""
+            SELECT DISTINCT resource_type, resource_id
+            FROM `{self.dataset_id}.{self.fhir_table_id}`
+            WHERE resource_id IN UNNEST(@resource_ids)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("resource_ids", "STRING", remaining)]
+            )
+            for row in self.bigquery_client.query(query, job_config=job_config).result():
+                if (row.resource_type, row.resource_id) in keys:
+                    existing.add((row.resource_type, row.resource_id))
+            return existing
+        except Exception as e:
+            logger.error(f"Error checking for existing FHIR resources: {str(e)}")
+            raise
+
+    def list_medical_records(self, limit=20):
+        """
+        Newest records with a patient, with display fields extracted in BigQuery
+        
+        Only small scalar columns are returned: the materialized display columns
+        when display_columns is on, otherwise JSON_VALUE projections of
+        fhir_resource (the raw resource is never transferred). Bundles stored
+        with bundle_storage="references" have no entry resources to project,
+        so rows left without display fields are filled from hydrated Bundles.
+        """
+        try:
+            if self.display_columns:
+                display_fields = "practitioner_name, reason_text"
+            else:
+                display_fields = ",\n".join(
+                    f"{expression} AS {column}" for column, expression in MEDICAL_RECORD_DISPLAY_SQL.items()
+                )
             
             query = f"""
-            SELECT resource_type, resource_id, fhir_resource, created_at, patient_id, file_name
+            SELECT
+                file_name,
+                patient_id,
+                resource_type,
+                resource_id,
+                created_at,
+                {display_fields}
             FROM `{self.dataset_id}.{self.fhir_table_id}`
-            {where_clause}
+            WHERE patient_id IS NOT NULL
             ORDER BY created_at DESC
+            LIMIT @limit
             """
             
-            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
-            query_job = self.bigquery_client.query(query, job_config=job_config)
-            results = query_job.result()
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ScalarQueryParameter("limit", "INT64", limit)]
+            )
+            rows = list(self.bigquery_client.query(query, job_config=job_config).result())
+            if self.bundle_storage == "references":
+                rows = self._fill_display_fields(rows)
+            return rows
             
-            fhir_resources = []
-            for row in results:
-                fhir_resources.append({
-                    "resource_type": row.resource_type,
-                    "resource_id": row.resource_id,
-                    "fhir_resource": json.loads(row.fhir_resource) if row.fhir_resource else None,
-                    "created_at": row.created_at.isoformat() if row.created_at else None,
-                    "patient_id": row.patient_id,
-                    "file_name": row.file_name
-                })
+        except Exception as e:
+            logger.error(f"Error listing medical records: {str(e)}")
+            raise
+
+    def _fill_display_fields(self, rows):
+        """Display fields for Bundle rows the SQL projection left empty, read from hydrated Bundles"""
+        bundle_ids = sorted({
+            row.resource_id for row in rows
+            if row.resource_type == "Bundle" and not row.practitioner_name and not row.reason_text
+        })
+        if not bundle_ids:
+            return rows
+        
+        bundles = {}
+        remaining = []
+        for resource_id in bundle_ids:
+            cached = self.resource_cache.get("Bundle", resource_id)
+            if cached is not None:
+                bundles[resource_id] = json.loads(cached[0])
+            else:
+                remaining.append(resource_id)
+        if remaining:
+            query = f"""
+            SELECT resource_id, fhir_resource
+            FROM `{self.dataset_id}.{self.fhir_table_id}`
+            WHERE resource_type = 'Bundle' AND resource_id IN UNNEST(@resource_ids)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("resource_ids", "STRING", remaining)]
+            )
+            for row in self.bigquery_client.query(query, job_config=job_config).result():
+                if row.fhir_resource:
+                    bundles.setdefault(row.resource_id, json.loads(row.fhir_resource))
+        self._hydrate_bundles(list(bundles.values()))
+        
+        filled = []
+        for row in rows:
+            bundle = bundles.get(row.resource_id) if row.resource_type == "Bundle" else None
+            if bundle is None or row.practitioner_name or row.reason_text:
+                filled.append(row)
+                continue
+            practitioner_name, reason = self.fhir_converter.extract_display_fields(bundle)
+            filled.append(SimpleNamespace(**dict(row.items(), practitioner_name=practitioner_name,
+                                                 reason_text=reason)))
+        return filled
+
+    def get_fhir_resource_json(self, resource_type, resource_id):
+        """
+        Read-through lookup of a single stored FHIR resource
+        
+        Returns:
+            (json bytes, etag) exactly as stored, or None if the resource does not exist
+        """
+        cached = self.resource_cache.get(resource_type, resource_id)
+        if cached is not None:
+            return cached
+        
+        try:
+            query = f"""
+            SELECT fhir_resource
+            FROM `{self.dataset_id}.{self.fhir_table_id}`
+            WHERE resource_type = @resource_type AND resource_id = @resource_id
+            ORDER BY created_at
+            LIMIT 1
+            """
+            
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("resource_type", "STRING", resource_type),
+                    bigquery.ScalarQueryParameter("resource_id", "STRING", resource_id)
+                ]
+            )
             
-            return fhir_resources
+            results = list(self.bigquery_client.query(query, job_config=job_config).result())
+            if not results or not results[0].fhir_resource:
+                return None
+            
+            body = results[0].fhir_resource.encode('utf-8')
+            etag = self.resource_cache.put(resource_type, resource_id, body)
+            return body, etag
             
         except Exception as e:
-            logger.error(f"Error retrieving FHIR resources: {str(e)}")
+            logger.error(f"Error retrieving FHIR resource {resource_type}/{resource_id}: {str(e)}")
             raise
 
     def update_analysis_status(self, file_name, status, result=None):
@@ -294,20 +935,20 @@ class StorageHandler:
     def get_signed_url(self, blob_name, expiration=3600):
         """Generate a signed URL for a file in the bucket"""
         try:
-            bucket = self.storage_client.bucket(self.bucket_name)
-            blob = bucket.blob(blob_name)
-            
-            url = blob.generate_signed_url(
-                version="v4",
-                expiration=expiration,
-                method="GET"
-            )
-            
-            return url
+            return self.url_factory.sign(blob_name, method="GET", expiration=expiration)
         except Exception as e:
             logger.error(f"Error generating signed URL: {str(e)}")
             raise
 
+    def get_signed_urls(self, blob_names, method="GET", expiration=3600, content_type=None):
+        """Generate signed URLs for many files at once; returns {blob_name: url}"""
+        try:
+            return self.url_factory.sign_many(blob_names, method=method, expiration=expiration,
+                                              content_type=content_type)
+        except Exception as e:
+            logger.error(f"Error generating signed URLs: {str(e)}")
+            raise
+
     def list_files(self, prefix=None):
         """List files in the bucket with optional prefix"""
         try:
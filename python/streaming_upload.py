@@ -0,0 +1,257 @@
+import base64
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import google_crc32c
+import requests
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# GCS requires every non-final resumable chunk to be a multiple of 256 KiB
+GCS_CHUNK_ALIGNMENT = 256 * 1024
+
+
+class UnknownUpload(KeyError):
+    """Raised for an upload ID that was never started, has finished or has expired"""
+
+
+class UploadTooLarge(Exception):
+    """Raised when a streamed upload exceeds the configured maximum size"""
+
+
+class UploadOffsetMismatch(Exception):
+    """Raised when a client resumes from an offset GCS has not committed"""
+
+    def __init__(self, committed_offset: int):
+        super().__init__(f"Upload must resume from offset {committed_offset}")
+        self.committed_offset = committed_offset
+
+
+class StreamingUploadManager:
+    """Stream request bodies into GCS resumable upload sessions in fixed-size chunks.
+
+    Only one chunk is held in memory per request. CRC32C and MD5 are computed
+    incrementally over the bytes GCS has committed, and checked against the
+    object metadata when the upload completes. Uploads interrupted mid-way are
+    resumed by the client from the last committed offset. Sessions idle for
+    ``session_ttl`` seconds are dropped and their GCS sessions cancelled.
+    """
+
+    def __init__(self, storage_client, bucket_name: str,
+                 chunk_size: int = 8 * 1024 * 1024,
+                 max_size: int = 2 * 1024 * 1024 * 1024,
+                 session_ttl: float = 6 * 3600,
+                 request_timeout=(10, 120)):
+        if chunk_size % GCS_CHUNK_ALIGNMENT:
+            raise ValueError(f"chunk_size must be a multiple of {GCS_CHUNK_ALIGNMENT}")
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.session_ttl = session_ttl
+        # (connect, read) seconds for each request to a session URL
+        self.request_timeout = request_timeout
+        # Session URLs are capabilities; requests to them need no other auth
+        self._http = requests.Session()
+        self._sessions = {}  # upload_id -> session state
+        self._lock = threading.Lock()
+
+    def start(self, blob_name: str, content_type: str = "application/octet-stream",
+              metadata: Optional[Dict[str, Any]] = None) -> str:
+        """Open a resumable session for ``blob_name`` and return its upload ID"""
+        bucket = self.storage_client.bucket(self.bucket_name)
+        blob = bucket.blob(blob_name)
+        session_url = blob.create_resumable_upload_session(content_type=content_type, client=self.storage_client)
+
+        self._sweep_expired()
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[upload_id] = {
+                "session_url": session_url,
+                "blob_name": blob_name,
+                "content_type": content_type,
+                "metadata": metadata or {},
+                "offset": 0,
+                "crc32c": google_crc32c.Checksum(),
+                "md5": hashlib.md5(),
+                "verify": True,
+                "last_used": time.monotonic(),
+                "lock": threading.Lock()
+            }
+        logger.info(f"Started streaming upload {upload_id} for {blob_name}")
+        return upload_id
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if session is None or time.monotonic() - session["last_used"] > self.session_ttl:
+                return None
+            session["last_used"] = time.monotonic()
+            return session
+
+    def _sweep_expired(self):
+        """Drop idle sessions and cancel them in GCS; sessions mid-request are left alone"""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for upload_id, session in list(self._sessions.items()):
+                if now - session["last_used"] <= self.session_ttl:
+                    continue
+                if not session["lock"].acquire(blocking=False):
+                    continue
+                session["lock"].release()
+                expired.append((upload_id, self._sessions.pop(upload_id)))
+        for upload_id, session in expired:
+            logger.info(f"Expiring idle streaming upload {upload_id}")
+            self._abort(upload_id, session)
+
+    def status(self, upload_id: str) -> Dict[str, Any]:
+        """Committed offset of an upload, as reported by GCS"""
+        session = self._require(upload_id)
+        with session["lock"]:
+            return {"upload_id": upload_id, "blob_name": session["blob_name"],
+                    "committed_offset": self._query_offset(session)}
+
+    def write(self, upload_id: str, stream, offset: int = 0, final: bool = False) -> Dict[str, Any]:
+        """
+        Copy ``stream`` into the upload starting at ``offset``
+
+        Full chunks are sent as they fill. When ``final`` is false, a trailing
+        partial chunk is not sent (GCS only accepts aligned chunks mid-upload);
+        the returned committed_offset tells the client where to resume.
+
+        Returns:
+            {"committed_offset": ..., "complete": bool, "object": metadata when complete}
+        """
+        session = self._require(upload_id)
+        with session["lock"]:
+            if offset != session["offset"]:
+                # The client may be behind after an interruption; trust GCS, not our counter
+                committed = self._query_offset(session)
+                if committed != session["offset"]:
+                    # Bytes we never saw were committed; the running checksums no longer apply
+                    session["verify"] = False
+                    session["offset"] = committed
+                if offset != session["offset"]:
+                    raise UploadOffsetMismatch(session["offset"])
+
+            buffer = bytearray()
+            while True:
+                data = stream.read(self.chunk_size - len(buffer))
+                if data:
+                    buffer.extend(data)
+                    if session["offset"] + len(buffer) > self.max_size:
+                        self._abort(upload_id, session)
+                        raise UploadTooLarge(f"Upload exceeds maximum size of {self.max_size} bytes")
+                    if len(buffer) < self.chunk_size:
+                        continue
+                    # Keep anything GCS did not commit and send it again with the next chunk
+                    start = session["offset"]
+                    self._send(session, bytes(buffer), final=False)
+                    del buffer[:session["offset"] - start]
+                    continue
+
+                # End of this request's body
+                if final:
+                    return self._finish(upload_id, session, bytes(buffer))
+                aligned = len(buffer) - len(buffer) % GCS_CHUNK_ALIGNMENT
+                if aligned:
+                    self._send(session, bytes(buffer[:aligned]), final=False)
+                return {"committed_offset": session["offset"], "complete": False}
+
+    def cancel(self, upload_id: str):
+        """Abandon an upload and delete its GCS session"""
+        session = self._require(upload_id)
+        with session["lock"]:
+            self._abort(upload_id, session)
+
+    def _require(self, upload_id: str) -> Dict[str, Any]:
+        session = self.get(upload_id)
+        if session is None:
+            raise UnknownUpload(upload_id)
+        return session
+
+    def _send(self, session: Dict[str, Any], chunk: bytes, final: bool) -> requests.Response:
+        """PUT one chunk at the current offset and advance the running checksums"""
+        start = session["offset"]
+        total = str(start + len(chunk)) if final else "*"
+        if chunk:
+            content_range = f"bytes {start}-{start + len(chunk) - 1}/{total}"
+        else:
+            content_range = f"bytes */{total}"
+
+        response = self._http.put(session["session_url"], data=chunk, headers={"Content-Range": content_range},
+                                  timeout=self.request_timeout)
+        if response.status_code not in (200, 201, 308):
+            raise Exception(f"GCS rejected chunk at offset {start}: {response.status_code} {response.text}")
+
+        committed = start + len(chunk) if response.status_code in (200, 201) else self._range_end(response)
+        if committed != start + len(chunk):
+            # Partial commit: GCS kept fewer bytes than sent; hash only what it kept
+            chunk = chunk[:max(committed - start, 0)]
+        session["crc32c"].update(chunk)
+        session["md5"].update(chunk)
+        session["offset"] = start + len(chunk)
+        return response
+
+    def _finish(self, upload_id: str, session: Dict[str, Any], tail: bytes) -> Dict[str, Any]:
+        """Send the final chunk and verify the object's checksums"""
+        response = self._send(session, tail, final=True)
+        if response.status_code not in (200, 201):
+            raise Exception(f"GCS did not finalize upload {upload_id}: {response.status_code}")
+
+        obj = response.json()
+        crc32c = base64.b64encode(session["crc32c"].digest()).decode("utf-8")
+        md5 = base64.b64encode(session["md5"].digest()).decode("utf-8")
+        if session["verify"]:
+            if obj.get("crc32c") and obj["crc32c"] != crc32c:
+                raise Exception(f"CRC32C mismatch for {session['blob_name']}")
+            if obj.get("md5Hash") and obj["md5Hash"] != md5:
+                raise Exception(f"MD5 mismatch for {session['blob_name']}")
+        else:
+            # Fall back to the checksums GCS computed itself
+            crc32c = obj.get("crc32c")
+            md5 = obj.get("md5Hash")
+
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+        logger.info(f"Completed streaming upload {upload_id}: {session['offset']} bytes")
+        return {
+            "committed_offset": session["offset"],
+            "complete": True,
+            "object": {"name": obj.get("name"), "size": int(obj.get("size", session["offset"])),
+                       "crc32c": crc32c, "md5": md5},
+            "blob_name": session["blob_name"],
+            "metadata": session["metadata"]
+        }
+
+    def _query_offset(self, session: Dict[str, Any]) -> int:
+        """Ask GCS how many bytes it has committed for a session"""
+        response = self._http.put(session["session_url"], data=b"", headers={"Content-Range": "bytes */*"},
+                                  timeout=self.request_timeout)
+        if response.status_code in (200, 201):
+            return int(response.json().get("size", session["offset"]))
+        if response.status_code != 308:
+            raise Exception(f"Could not query upload status: {response.status_code}")
+        return self._range_end(response)
+
+    @staticmethod
+    def _range_end(response: requests.Response) -> int:
+        """Committed byte count from a 308 response's Range header ("bytes=0-N")"""
+        byte_range = response.headers.get("Range")
+        if not byte_range:
+            return 0
+        return int(byte_range.split("-")[-1]) + 1
+
+    def _abort(self, upload_id: str, session: Dict[str, Any]):
+        try:
+            self._http.delete(session["session_url"], timeout=self.request_timeout)
+        except Exception as e:
+            logger.warning(f"Could not cancel GCS session for upload {upload_id}: {e}")
+        with self._lock:
+            self._sessions.pop(upload_id, None)